@@ -1,16 +1,24 @@
-from nst_zoo.nst_main import main
+from nst_zoo.batch_processing.worker import Worker, run_batch
+from nst_zoo.batch_processing.scheduling import affinity_batches
+from nst_zoo.batch_processing.result_index import result_index
 from nst_zoo.config import NSTConfig
 
+import os
 import json
+import socket
 import itertools
+from concurrent.futures import ProcessPoolExecutor
 import click
-from redis import Redis
+
+# torch, the models and redis are imported by the commands which use them, so that the others (and --help) do
+# not pay for them
 redis_connection = None
 
 
 def _get_redis_connection(host, port):
     global redis_connection
     if not redis_connection:
+        from redis import Redis
         redis_connection = Redis(host=host, port=port)
     return redis_connection
 
@@ -45,13 +53,30 @@ def cli():
     type=str,
     help="Redis name to lpop trials from"
 )
-def process_from_queue(host, port, name):
+@click.option(
+    "--worker-id",
+    envvar="NST_WORKER_ID",
+    type=str,
+    default=None,
+    help="Stable id of this worker (defaults to hostname-pid); a restarted worker resumes its claimed trials"
+)
+@click.option(
+    "--prefetch",
+    type=int,
+    default=4,
+    help="Number of trials claimed per round trip"
+)
+@click.option(
+    "--visibility-timeout",
+    type=int,
+    default=300,
+    help="Seconds without heartbeat after which a worker's claimed trials are re-queued"
+)
+def process_from_queue(host, port, name, worker_id, prefetch, visibility_timeout):
     redis = _get_redis_connection(host, port)
-    config_kwargs = redis.lpop(name)
-
-    while config_kwargs:
-        main(NSTConfig(**json.loads(config_kwargs)))
-        config_kwargs = _get_redis_connection(host, port)
+    worker = Worker(redis, name, worker_id=worker_id, prefetch=prefetch, visibility_timeout=visibility_timeout)
+    processed = worker.run()
+    click.echo(f"{processed} trials processed, see {worker.results_key} for results")
 
 
 @cli.command()
@@ -84,14 +109,48 @@ def process_from_queue(host, port, name):
     type=str,
     help="Redis name to lpop trials from"
 )
-def send_to_queue(config_filepath, host, port, name):
+@click.option(
+    "--batch-size",
+    "-b",
+    type=int,
+    default=8,
+    help="Maximum number of trials sharing a model and style target queued as one entry (0 to queue trials alone)"
+)
+@click.option(
+    "--rerun",
+    is_flag=True,
+    help="Also queue trials already completed according to the result index (NST_RESULT_INDEX)"
+)
+def send_to_queue(config_filepath, host, port, name, batch_size, rerun):
     with open(config_filepath, "r") as fd:
         configs = json.load(fd)
+    trials = _pending_trials(_parameter_grid(configs), rerun)
+    if not trials:
+        click.echo(0)
+        return
+    if batch_size:
+        # heaviest batches first: lpush + rpop means the first entry pushed is the first one claimed
+        entries = [json.dumps(i) for i in affinity_batches(trials, batch_size)]
+    else:
+        entries = [json.dumps(i) for i in trials]
     redis = _get_redis_connection(host, port)
     click.echo(
-        redis.lpush(name, *[json.dumps(i) for i in _parameter_grid(configs)])
+        redis.lpush(name, *entries)
     )
 
+def _pending_trials(trials, rerun=False):
+    """
+    Trials not completed according to result_index (all of them when rerun)
+    """
+    trials = list(trials)
+    if rerun or not result_index.path:
+        return trials
+    pending = [i for i in trials if result_index.completed(NSTConfig(**i)) is None]
+    if len(pending) < len(trials):
+        click.echo(f"skipping {len(trials) - len(pending)} completed trials", err=True)
+    return pending
+
+
 def _parameter_grid(param_grid):
     """
     Inspired by sklearn.model_selection.ParameterGrid
@@ -107,6 +166,158 @@ def _parameter_grid(param_grid):
             yield params
 
 
+@cli.command()
+@click.option(
+    "--config-filepath",
+    "-fp",
+    default="nst_zoo/batch_processing/data/config.json"
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=None,
+    help="Number of worker processes (defaults to the number of cores)"
+)
+@click.option(
+    "--threads-per-worker",
+    "-t",
+    type=int,
+    default=None,
+    help="torch threads of each worker (defaults to the number of cores divided by the number of workers)"
+)
+@click.option(
+    "--rerun",
+    is_flag=True,
+    help="Also run trials already completed according to the result index (NST_RESULT_INDEX)"
+)
+def run_local(config_filepath, workers, threads_per_worker, rerun):
+    """
+    Run the parameter grid of a config file on a local process pool, without Redis
+    """
+    import torch
+    with open(config_filepath, "r") as fd:
+        configs = json.load(fd)
+    trials = _pending_trials(_parameter_grid(configs), rerun)
+    if not trials:
+        click.echo("0 trials done, 0 failed")
+        return
+
+    cores = os.cpu_count() or 1
+    workers = workers or min(cores, len(trials)) or 1
+    threads_per_worker = threads_per_worker or max(1, cores // workers)
+
+    failures = 0
+    # at least two batches per worker, so that the short ones can even out the load at the end
+    batches = affinity_batches(trials, batch_size=max(1, len(trials) // (2 * workers)))
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=torch.set_num_threads,
+            initargs=(threads_per_worker,)
+    ) as executor:
+        # batches of trials sharing a model and style target, heaviest first; map yields in submission order,
+        # so progress is reported in that order
+        results = itertools.chain.from_iterable(executor.map(run_batch, batches))
+        for i, result in enumerate(results, start=1):
+            if result["status"] == "failed":
+                failures += 1
+                click.echo(f"[{i}/{len(trials)}] failed after {result['seconds']:.1f}s: {result['error']}", err=True)
+            else:
+                click.echo(
+                    f"[{i}/{len(trials)}] {result['output_filepath']} in {result['seconds']:.1f}s "
+                    f"({result['n_evals']} evaluations, {result['stop_reason']})"
+                )
+    click.echo(f"{len(trials) - failures} trials done, {failures} failed")
+
+
+@cli.command()
+@click.option(
+    "--host",
+    "-h",
+    required=True,
+    envvar="NST_REDIS_HOST",
+    type=str,
+    help="Redis host where list of trials exists"
+)
+@click.option(
+    "--port",
+    "-p",
+    required=True,
+    envvar="NST_REDIS_PORT",
+    type=int,
+    help="Redis port where list of trials exists"
+)
+@click.option(
+    "--name",
+    "-n",
+    required=True,
+    envvar="NST_REDIS_NAME",
+    type=str,
+    help="Redis name to lpop trials from"
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=None,
+    help="Number of worker processes to fork (defaults to the number of cores)"
+)
+@click.option(
+    "--preload",
+    multiple=True,
+    help="model/pool loaded once in shared memory before forking, e.g. resnet152/avg (repeatable)"
+)
+@click.option(
+    "--threads-per-worker",
+    "-t",
+    type=int,
+    default=None,
+    help="torch threads of each worker (defaults to the number of cores divided by the number of workers)"
+)
+@click.option(
+    "--worker-id",
+    envvar="NST_WORKER_ID",
+    type=str,
+    default=None,
+    help="Prefix of the workers' ids (defaults to hostname-pid); worker i is <prefix>-<i>"
+)
+@click.option(
+    "--prefetch",
+    type=int,
+    default=4,
+    help="Number of trials claimed per round trip"
+)
+@click.option(
+    "--visibility-timeout",
+    type=int,
+    default=300,
+    help="Seconds without heartbeat after which a worker's claimed trials are re-queued"
+)
+def supervise(host, port, name, workers, preload, threads_per_worker, worker_id, prefetch, visibility_timeout):
+    """
+    Fork queue workers sharing the memory of the preloaded backbones, restarting the ones which crash
+    """
+    from nst_zoo.batch_processing.supervisor import Supervisor, parse_models
+    from redis import Redis
+    cores = os.cpu_count() or 1
+    workers = workers or cores
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+
+    def work(index):
+        # a connection of its own: sockets must not be shared across a fork
+        redis = Redis(host=host, port=port)
+        worker = Worker(
+            redis, name, worker_id=f"{worker_id}-{index}", prefetch=prefetch, visibility_timeout=visibility_timeout
+        )
+        worker.run()
+
+    supervisor = Supervisor(
+        work, workers, models=parse_models(preload), threads_per_worker=threads_per_worker or max(1, cores // workers)
+    )
+    restarts = supervisor.run()
+    click.echo(f"{workers} workers done, {sum(restarts.values())} restarts")
+
+
 @cli.command()
 @click.option(
     "--host",
@@ -0,0 +1,85 @@
+from nst_zoo.config import NSTConfig, RESULT_INDEX
+
+import os
+import json
+import time
+import sqlite3
+from contextlib import closing
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from nst_zoo.optimization import StoppingCriteria
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    config_hash TEXT PRIMARY KEY,
+    output_filepath TEXT NOT NULL,
+    final_loss REAL,
+    n_evals INTEGER,
+    seconds REAL,
+    finished REAL,
+    config TEXT
+)
+"""
+
+
+class ResultIndex:
+    """
+    SQLite index of finished trials, keyed by NSTConfig._md5
+
+    Notes
+    -----
+    - A trial is complete when it is recorded and its output file still exists, so deleting an output reruns it
+    - A connection is opened per call (WAL journal, busy timeout), so the index can be shared by forked workers
+      and several processes on one machine
+    - Disabled (nothing is complete, nothing is recorded) when no path is given
+    """
+    def __init__(self, path: Optional[str] = RESULT_INDEX, timeout: float = 30.):
+        self.path = path
+        self.timeout = timeout
+        if path:
+            with closing(self._connect()) as connection, connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def get(self, config_hash: str) -> Optional[dict]:
+        if not self.path:
+            return None
+        with closing(self._connect()) as connection:
+            connection.row_factory = sqlite3.Row
+            row = connection.execute("SELECT * FROM results WHERE config_hash = ?", (config_hash,)).fetchone()
+        return dict(row) if row else None
+
+    def completed(self, nst_config: NSTConfig) -> Optional[dict]:
+        """
+        The record of a finished trial whose output still exists, None otherwise
+        """
+        record = self.get(nst_config._md5())
+        if record is None or not os.path.exists(record["output_filepath"]):
+            return None
+        return record
+
+    def record(self, nst_config: NSTConfig, stopping: "StoppingCriteria") -> None:
+        if not self.path:
+            return
+        config = {k: v for k, v in vars(nst_config).items() if k != "layers"}
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    nst_config._md5(),
+                    nst_config.output_filepath,
+                    stopping.best_loss,
+                    stopping.n_evals,
+                    stopping.seconds,
+                    time.time(),
+                    json.dumps(config, sort_keys=True),
+                )
+            )
+
+
+# process-wide index used by the workers and send-to-queue
+result_index = ResultIndex()
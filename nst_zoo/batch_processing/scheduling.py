@@ -0,0 +1,46 @@
+import json
+from collections import OrderedDict
+from typing import Iterable, List
+
+# trials sharing these fields share a backbone and style image (see model_cache and gram_cache), and can be
+# optimized together by nst_main.main_batched, whose _BATCH_SHARED_FIELDS they are (without importing torch)
+AFFINITY_FIELDS = (
+    "model", "pool", "style_img", "optimization_method", "optimization_kwargs",
+    "image_size", "pyramid_levels", "pyramid_evals", "precision", "channels_last", "checkpoint_segments",
+    "max_evals", "tolerance_change", "patience", "max_seconds"
+)
+
+
+def affinity_key(trial: dict) -> str:
+    return json.dumps([trial.get(i) for i in AFFINITY_FIELDS], sort_keys=True)
+
+
+def trial_cost(trial: dict) -> float:
+    """
+    Rough relative cost of a trial: evaluations times pixels
+    """
+    max_evals = trial.get("max_evals") or 200
+    image_size = trial.get("image_size") or 256
+    return max_evals * image_size ** 2
+
+
+def affinity_batches(trials: Iterable[dict], batch_size: int = 8) -> List[List[dict]]:
+    """
+    Group trials by their expensive shared state, heaviest batches first
+
+    Notes
+    -----
+    - A worker processing a batch builds the model and computes the target gram matrices once for all of its trials
+    - Groups larger than batch_size are split, so that a large group can still be spread over several workers
+    - Batches are ordered by decreasing total cost, so the longest batches start first and the short ones
+      fill the gaps at the end of a run
+    """
+    groups = OrderedDict()
+    for trial in trials:
+        groups.setdefault(affinity_key(trial), []).append(trial)
+
+    batches = []
+    for group in groups.values():
+        step = batch_size or len(group)
+        batches.extend(group[i:i + step] for i in range(0, len(group), step))
+    return sorted(batches, key=lambda batch: sum(trial_cost(i) for i in batch), reverse=True)
@@ -0,0 +1,117 @@
+from nst_zoo.model_cache import model_cache
+from nst_zoo.models import model_nbytes
+
+import os
+import time
+import signal
+import multiprocessing
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+
+
+def parse_models(models: List[str]) -> List[Tuple[str, str]]:
+    """
+    (model, pool) of every "model/pool" (or "model", with avg pooling) string
+    """
+    parsed = []
+    for i in models:
+        name, _, pool = i.partition("/")
+        parsed.append((name, pool or "avg"))
+    return parsed
+
+
+def share_models(models: List[Tuple[str, str]]) -> int:
+    """
+    Load backbones into the process-wide model_cache with their parameters and buffers in shared memory, return
+    their size in bytes
+
+    Notes
+    -----
+    - Processes forked afterwards find the backbones in their model_cache and map the same pages, instead of each
+      building a copy. Backbones are frozen, so the pages are only ever read.
+    - The cache is grown to hold at least these backbones, so that they are not evicted before the fork
+    """
+    model_cache.max_models = max(model_cache.max_models, len(models))
+    nbytes = 0
+    for name, pool in models:
+        backbone = model_cache.get(name, pool).share_memory()
+        nbytes += model_nbytes(backbone)
+    return nbytes
+
+
+class Supervisor:
+    """
+    Fork `workers` processes running `target(worker_index)` after loading the shared backbones once, and restart the
+    ones which die
+
+    Notes
+    -----
+    - Memory per additional worker is its activations and gram matrices, rather than a copy of every backbone
+    - A worker exiting with status 0 (e.g. a Worker finding the queue empty) is done; any other exit (a crash, the OOM
+      killer) restarts it with the same index, so that a Worker with a stable id resumes its claimed trials, at most
+      `max_restarts` times per index
+    - Trials with channels_last convert the backbone's weights, which gives their worker a private copy of them
+    - CUDA cannot be used across a fork, so backbones are only shared on CPU
+    """
+    def __init__(
+            self,
+            target: Callable[[int], None],
+            workers: int,
+            models: Optional[List[Tuple[str, str]]] = None,
+            threads_per_worker: Optional[int] = None,
+            max_restarts: int = 3,
+            poll_interval: float = 1.
+    ):
+        self.target = target
+        self.workers = workers
+        self.models = models or []
+        self.threads_per_worker = threads_per_worker
+        self.max_restarts = max_restarts
+        self.poll_interval = poll_interval
+        self.restarts = {i: 0 for i in range(workers)}
+        self._context = multiprocessing.get_context("fork")
+        self._processes: Dict[int, multiprocessing.Process] = {}
+
+    def start(self, index: int):
+        process = self._context.Process(target=self._run, args=(index,), name=f"nst-worker-{index}", daemon=False)
+        process.start()
+        self._processes[index] = process
+
+    def _run(self, index: int):
+        if self.threads_per_worker:
+            torch.set_num_threads(self.threads_per_worker)
+        self.target(index)
+
+    def run(self) -> Dict[int, int]:
+        """
+        Supervise the workers until all of them are done (or gave up), return the number of restarts per worker
+        """
+        if self.models and torch.cuda.is_available():
+            raise RuntimeError("Backbones can only be shared between forked workers on CPU")
+        share_models(self.models)
+        for index in range(self.workers):
+            self.start(index)
+        try:
+            while self._processes:
+                for index, process in list(self._processes.items()):
+                    if process.is_alive():
+                        continue
+                    process.join()
+                    del self._processes[index]
+                    if process.exitcode != 0 and self.restarts[index] < self.max_restarts:
+                        self.restarts[index] += 1
+                        self.start(index)
+                if self._processes:
+                    time.sleep(self.poll_interval)
+        finally:
+            self.stop()
+        return self.restarts
+
+    def stop(self):
+        for process in self._processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        for process in self._processes.values():
+            process.join()
+        self._processes.clear()
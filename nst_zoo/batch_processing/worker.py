@@ -0,0 +1,256 @@
+from nst_zoo.config import NSTConfig
+from nst_zoo.batch_processing.result_index import result_index
+
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Callable, List, Optional
+
+
+def run_trial(config_kwargs: dict) -> dict:
+    """
+    Run one trial, turning any exception into a "failed" result so that one trial cannot take down the others
+
+    Notes
+    -----
+    Trials already completed according to result_index are "skipped" instead, with the recorded results
+    """
+    started = time.perf_counter()
+    try:
+        nst_config = NSTConfig(**config_kwargs)
+        record = result_index.completed(nst_config)
+        if record is not None:
+            return _skipped(record)
+        # imported on the first trial run rather than with the worker, which only needs redis to start
+        from nst_zoo.nst_main import main
+        stopping = main(nst_config)
+        result_index.record(nst_config, stopping)
+    except Exception:
+        return {"status": "failed", "seconds": time.perf_counter() - started, "error": traceback.format_exc()}
+    return _done(nst_config, stopping, time.perf_counter() - started)
+
+
+def run_batch(trials: List[dict]) -> List[dict]:
+    """
+    Run trials in this process, so that they share its model and gram caches, return their results in order
+
+    Notes
+    -----
+    - Trials which can share a batch (see nst_main.batch_key) are optimized together by main_batched, one
+      forward/backward pass per step for all of them; the others run one after the other with run_trial
+    - A batch that fails is run again trial by trial, so that one bad trial cannot fail the others
+    - A batch's loss is the sum of its images' losses, so batched trials are recorded without a best_loss
+    """
+    results = [None] * len(trials)
+    batches = OrderedDict()
+    for i, config_kwargs in enumerate(trials):
+        try:
+            nst_config = NSTConfig(**config_kwargs)
+            record = result_index.completed(nst_config)
+        except Exception:
+            results[i] = run_trial(config_kwargs)  # reports the failure
+            continue
+        if record is not None:
+            results[i] = _skipped(record)
+            continue
+        from nst_zoo.nst_main import batch_key
+        key = batch_key(nst_config)
+        batches.setdefault(i if key is None else key, []).append((i, nst_config))
+
+    for batch in batches.values():
+        if len(batch) > 1:
+            batch_results = _run_batched([nst_config for _, nst_config in batch])
+            if batch_results is not None:
+                for (i, _), result in zip(batch, batch_results):
+                    results[i] = result
+                continue
+        for i, _ in batch:
+            results[i] = run_trial(trials[i])
+    return results
+
+
+def _run_batched(nst_configs: List[NSTConfig]) -> Optional[List[dict]]:
+    """
+    Results of configurations optimized together by main_batched, None when the batch failed
+    """
+    from nst_zoo.nst_main import main_batched
+    started = time.perf_counter()
+    try:
+        stopping = replace(main_batched(nst_configs), best_loss=None)
+    except Exception:
+        return None
+    seconds = time.perf_counter() - started
+    for nst_config in nst_configs:
+        result_index.record(nst_config, stopping)
+    return [_done(nst_config, stopping, seconds, batch_size=len(nst_configs)) for nst_config in nst_configs]
+
+
+def _done(nst_config: NSTConfig, stopping, seconds: float, batch_size: int = 1) -> dict:
+    result = {
+        "status": "done",
+        "seconds": seconds,
+        "output_filepath": nst_config.output_filepath,
+        "n_evals": stopping.n_evals,
+        "stop_reason": stopping.stop_reason,
+    }
+    if batch_size > 1:
+        result["batch_size"] = batch_size
+    return result
+
+
+def _skipped(record: dict) -> dict:
+    return {
+        "status": "skipped",
+        "seconds": record["seconds"],
+        "output_filepath": record["output_filepath"],
+        "n_evals": record["n_evals"],
+        "stop_reason": "already done",
+    }
+
+
+class Worker:
+    """
+    Reliable consumer of a Redis list of trials
+
+    Notes
+    -----
+    Keys used for a queue `name`:
+    - `name`: pending trials. send-to-queue pushes on the left and workers take from the right. An entry is either one
+      trial or a JSON list of trials sharing a model and style target (see scheduling.affinity_batches), which are
+      processed together.
+    - `name:processing:<worker_id>`: trials claimed by a worker. A trial is atomically moved there when it is
+      claimed (RPOPLPUSH) and only removed once its result is stored, so a trial is never lost with its worker.
+    - `name:heartbeat:<worker_id>`: refreshed every heartbeat_interval and expiring after visibility_timeout.
+      Trials claimed by a worker whose heartbeat expired are pushed back to `name` by the next worker to look.
+    - `name:results`: hash of trial id (md5 of the trial's JSON) to its status ("running", "done", "skipped",
+      "failed"), worker, attempts and timings
+    - `name:attempts`: hash of entry id to the number of times it was claimed. Entries claimed more than max_attempts
+      times (e.g. because they keep killing their worker) are marked as failed instead of being run again.
+
+    A worker blocks for its first trial (BRPOPLPUSH), then prefetches up to `prefetch - 1` more in a single pipelined
+    round trip. Trials left in its own processing list (same worker_id, e.g. after a restart) are processed first.
+    """
+    def __init__(
+            self,
+            redis,
+            name: str,
+            worker_id: Optional[str] = None,
+            prefetch: int = 4,
+            visibility_timeout: int = 300,
+            heartbeat_interval: Optional[float] = None,
+            block_timeout: int = 5,
+            max_attempts: int = 3,
+            run_trial: Optional[Callable[[dict], dict]] = None,
+            run_batch: Callable[[List[dict]], List[dict]] = run_batch
+    ):
+        self.redis = redis
+        self.name = name
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.prefetch = max(1, prefetch)
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = heartbeat_interval or visibility_timeout / 3
+        self.block_timeout = block_timeout
+        self.max_attempts = max_attempts
+        # a run_trial, when given, runs the trials of an entry one by one instead
+        self.run_batch = run_batch if run_trial is None else lambda trials: [run_trial(i) for i in trials]
+
+        self.processing_key = f"{name}:processing:{self.worker_id}"
+        self.heartbeat_key = f"{name}:heartbeat:{self.worker_id}"
+        self.results_key = f"{name}:results"
+        self.attempts_key = f"{name}:attempts"
+        self._stop = threading.Event()
+
+    def run(self, stop_when_empty: bool = True) -> int:
+        """
+        Process trials until the queue is empty (or forever), return the number of trials processed
+        """
+        processed = 0
+        self.heartbeat()
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat.start()
+        try:
+            claimed = self.pending()
+            while True:
+                if not claimed:
+                    self.requeue_dead_workers()
+                    claimed = self.claim()
+                if not claimed and stop_when_empty:
+                    break
+                for payload in claimed:
+                    processed += self.process(payload)
+                claimed = []
+        finally:
+            self._stop.set()
+            heartbeat.join()
+            self.redis.delete(self.heartbeat_key)
+        return processed
+
+    def pending(self) -> List[bytes]:
+        """
+        Trials already claimed by this worker id, oldest first
+        """
+        return list(reversed(self.redis.lrange(self.processing_key, 0, -1)))
+
+    def claim(self) -> List[bytes]:
+        first = self.redis.brpoplpush(self.name, self.processing_key, timeout=self.block_timeout)
+        if first is None:
+            return []
+        pipe = self.redis.pipeline()
+        for _ in range(self.prefetch - 1):
+            pipe.rpoplpush(self.name, self.processing_key)
+        return [first] + [i for i in pipe.execute() if i is not None]
+
+    def process(self, payload: bytes) -> int:
+        """
+        Run the trial or batch of trials of a queue entry, return the number of trials
+        """
+        attempts = self.redis.hincrby(self.attempts_key, hashlib.md5(payload).hexdigest(), 1)
+        trials = json.loads(payload)
+        if isinstance(trials, dict):
+            trials = [trials]
+
+        # same id whether the trial was queued alone or in a batch
+        trial_ids = [hashlib.md5(json.dumps(trial).encode('utf-8')).hexdigest() for trial in trials]
+        record = {"worker": self.worker_id, "attempts": attempts, "started": time.time()}
+        if attempts > self.max_attempts:
+            results = [{"status": "failed", "error": f"gave up after {self.max_attempts} attempts"} for _ in trials]
+        else:
+            pipe = self.redis.pipeline()
+            for trial_id in trial_ids:
+                pipe.hset(self.results_key, trial_id, json.dumps({**record, "status": "running"}))
+            pipe.execute()
+            # the trials of an entry share a model and style target, and run together (see run_batch)
+            results = self.run_batch(trials)
+
+        for trial_id, result in zip(trial_ids, results):
+            self.redis.hset(self.results_key, trial_id, json.dumps({**record, **result, "finished": time.time()}))
+        # acknowledge: the entry is only forgotten once the results of all its trials are stored
+        self.redis.lrem(self.processing_key, 1, payload)
+        return len(trials)
+
+    def heartbeat(self):
+        self.redis.set(self.heartbeat_key, time.time(), ex=self.visibility_timeout)
+
+    def requeue_dead_workers(self) -> int:
+        """
+        Push the trials of workers without a live heartbeat back to the queue, return how many were re-queued
+        """
+        requeued = 0
+        prefix = f"{self.name}:processing:"
+        for key in self.redis.scan_iter(match=f"{prefix}*"):
+            worker_id = key.decode()[len(prefix):] if isinstance(key, bytes) else key[len(prefix):]
+            if worker_id == self.worker_id or self.redis.exists(f"{self.name}:heartbeat:{worker_id}"):
+                continue
+            while self.redis.rpoplpush(key, self.name) is not None:
+                requeued += 1
+        return requeued
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            self.heartbeat()
@@ -0,0 +1,319 @@
+from nst_zoo import models, loss
+from nst_zoo.image_processing import BaseProcessor, noise_of_same_type
+from nst_zoo.loss import NSTLoss
+from nst_zoo.models import get_activations
+from nst_zoo.optimization import optimize, StoppingCriteria
+from nst_zoo.telemetry import Telemetry, MemorySink, set_telemetry, peak_memory
+
+import json
+import time
+import itertools
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+
+import click
+import torch
+
+STYLE_IMG = "nst_zoo/data/style/vangogh_starry_night.jpg"
+
+# Conv2d exists as a module in every architecture (e.g. inception and googlenet use functional ReLUs)
+DEFAULT_LAYERS = ['{"Conv2d": [0]}', '{"Conv2d": [0, 2, 4]}']
+DEFAULT_GRAM_CLASSES = ["GramMatrix", "NormalizedGramMatrix"]
+# approximations of GramMatrix (see loss.SubsampledGramMatrix), benchmarked against it for speed and error
+APPROXIMATE_GRAM_CLASSES = ["RandomProjectionGramMatrix", "SubsampledGramMatrix"]
+DEFAULT_OPTIMIZATION_KWARGS = {
+    "LBFGS": {"line_search_fn": "strong_wolfe"},
+    "Adam": {"lr": 0.05},
+}
+
+
+@dataclass
+class BenchmarkCase:
+    model: str
+    layers: Dict
+    gram_class: str
+    image_size: int
+    optimization_method: str
+    pool: str = "avg"
+    max_evals: int = 20
+    target_ratio: float = 0.1  # time to target = time until the loss drops to this fraction of the first loss
+    precision: str = "fp32"
+    channels_last: bool = False
+    checkpoint_segments: int = 0
+    gram_kwargs: Optional[Dict] = None
+
+
+# fields changing how a case runs rather than what it computes, compared against their defaults by against_reference
+MODE_FIELDS = ("precision", "channels_last", "checkpoint_segments")
+
+
+def run_case(case: BenchmarkCase) -> dict:
+    """
+    Optimize once with randomly initialized weights (no download needed), return throughput, time to target loss
+    and peak memory
+    """
+    torch.manual_seed(0)
+    sink = MemorySink()
+    previous = set_telemetry(Telemetry(sink))
+    try:
+        model = getattr(models, case.model)(layers=case.layers, pooling=case.pool, pretrained=False)
+        models.set_execution_mode(model, case.precision, case.channels_last)
+        if case.checkpoint_segments:
+            models._add_hooks_to_model(model, case.layers, case.checkpoint_segments)
+        style_img = BaseProcessor(case.image_size).preprocess(STYLE_IMG)
+        gram_class = loss.get_gram_class(case.gram_class, case.gram_kwargs)
+        nst_loss = NSTLoss(
+            style_targets=[gram_class()(i) for i in get_activations(model, style_img)],
+            style_gram_class=gram_class
+        )
+        noise_img = noise_of_same_type(style_img)
+        gram_error = _gram_error(model, style_img, noise_img, gram_class)
+        optimization_fn = getattr(torch.optim, case.optimization_method)
+        optimizer = optimization_fn([noise_img], **DEFAULT_OPTIMIZATION_KWARGS.get(case.optimization_method, {}))
+
+        stopping = StoppingCriteria(max_evals=case.max_evals)
+        started = time.time()
+        optimize(optimizer, noise_img, model, nst_loss, stopping=stopping)
+    finally:
+        set_telemetry(previous)
+
+    iterations = [i for i in sink.records if i["type"] == "iteration"]
+    return {
+        **asdict(case),
+        "n_evals": stopping.n_evals,
+        "seconds": stopping.seconds,
+        "evals_per_second": stopping.n_evals / stopping.seconds,
+        "time_to_target": _time_to_target(iterations, started, case.target_ratio),
+        "first_loss": iterations[0]["loss"],
+        "best_loss": stopping.best_loss,
+        **gram_error,
+        **peak_memory(),
+    }
+
+
+def _gram_error(model, style_img, image, gram_class) -> dict:
+    """
+    Relative error of the loss and cosine similarity of the gradient of an approximate gram class (see
+    loss.SubsampledGramMatrix) against the exact class it approximates, at `image`; empty for exact classes
+    """
+    exact_class = getattr(gram_class(), "approximates", None)
+    if exact_class is None:
+        return {}
+    losses, gradients = [], []
+    for cls in (exact_class, gram_class):
+        nst_loss = NSTLoss(
+            style_targets=[cls()(i) for i in get_activations(model, style_img)], style_gram_class=cls
+        )
+        probe = image.detach().clone().requires_grad_()
+        value = nst_loss(generated_style_activations=get_activations(model, probe))
+        value.backward()
+        losses.append(float(value))
+        gradients.append(probe.grad.view(-1))
+    return {
+        "gram_loss_error": abs(losses[1] - losses[0]) / losses[0],
+        "gram_gradient_cosine": float(torch.nn.functional.cosine_similarity(gradients[0], gradients[1], dim=0)),
+    }
+
+
+def _time_to_target(iterations: List[dict], started: float, target_ratio: float) -> Optional[float]:
+    """
+    Seconds from `started` until the loss reaches target_ratio times the first loss
+    """
+    target = iterations[0]["loss"] * target_ratio
+    return next((i["time"] - started for i in iterations if i["loss"] <= target), None)
+
+
+def against_reference(results: List[dict]) -> List[dict]:
+    """
+    Add the speedup, memory ratio and loss deviations of every case relative to the same case run in the default mode
+    (fp32, contiguous, without checkpoints)
+    """
+    fields = BenchmarkCase.__dataclass_fields__
+
+    def key(result):
+        return json.dumps({k: result[k] for k in fields if k not in MODE_FIELDS}, sort_keys=True)
+
+    references = {key(i): i for i in results if all(i[k] == fields[k].default for k in MODE_FIELDS)}
+    for result in results:
+        reference = references.get(key(result))
+        if reference is None or reference is result:
+            continue
+        result["speedup"] = result["evals_per_second"] / reference["evals_per_second"]
+        result["peak_rss_ratio"] = result["peak_rss_mb"] / reference["peak_rss_mb"]
+        # the first loss is computed on the same image, so it isolates the error of the forward pass
+        result["first_loss_deviation"] = abs(result["first_loss"] - reference["first_loss"]) / reference["first_loss"]
+        result["best_loss_deviation"] = abs(result["best_loss"] - reference["best_loss"]) / reference["best_loss"]
+    return results
+
+
+def against_exact_gram(results: List[dict]) -> List[dict]:
+    """
+    Add the speedup of every case with an approximate gram class relative to the same case with the exact GramMatrix,
+    next to its gram_loss_error and gram_gradient_cosine
+    """
+    fields = BenchmarkCase.__dataclass_fields__
+
+    def key(result):
+        return json.dumps({k: result[k] for k in fields if k not in ("gram_class", "gram_kwargs")}, sort_keys=True)
+
+    references = {key(i): i for i in results if i["gram_class"] == "GramMatrix" and not i["gram_kwargs"]}
+    for result in results:
+        reference = references.get(key(result))
+        if reference is None or "gram_loss_error" not in result:
+            continue
+        result["gram_speedup"] = result["evals_per_second"] / reference["evals_per_second"]
+    return results
+
+
+def run_isolated(case: BenchmarkCase) -> dict:
+    """
+    run_case in a fresh process, so that peak memory is not inherited from previous cases
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_case, case).result()
+
+
+def compare(baseline: dict, current: dict, tolerance: float = .1) -> List[str]:
+    """
+    Cases that got slower or used more memory than `tolerance` (relative) between two result files
+    """
+    def key(result):
+        # results written before a field existed ran with its default
+        fields = BenchmarkCase.__dataclass_fields__
+        return json.dumps({k: result.get(k, fields[k].default) for k in fields}, sort_keys=True)
+
+    previous = {key(i): i for i in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        if result["evals_per_second"] < before["evals_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{key(result)}: {before['evals_per_second']:.2f} -> {result['evals_per_second']:.2f} evals/s"
+            )
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(
+                f"{key(result)}: {before['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB peak RSS"
+            )
+    return regressions
+
+
+def _describe(result: dict) -> str:
+    description = (
+        f"{result['model']} {json.dumps(result['layers'])} {result['gram_class']} {result['image_size']}px "
+        f"{result['optimization_method']} {result['precision']}"
+    )
+    if result["channels_last"]:
+        description += " channels_last"
+    if result["checkpoint_segments"]:
+        description += f" {result['checkpoint_segments']} checkpoint segments"
+    if result.get("gram_kwargs"):
+        description += f" {json.dumps(result['gram_kwargs'])}"
+    return description
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group(name="nst-benchmark")
+def cli():
+    return
+
+
+@cli.command()
+@click.option("--model", "-m", "model_names", multiple=True, default=list(models.ARCHITECTURES))
+@click.option("--layers", "-l", "layer_specs", multiple=True, default=DEFAULT_LAYERS, help="JSON layer spec")
+@click.option("--gram-class", "-g", "gram_classes", multiple=True, default=DEFAULT_GRAM_CLASSES)
+@click.option("--image-size", "-s", "image_sizes", multiple=True, type=int, default=[128])
+@click.option("--optimizer", "-o", "optimization_methods", multiple=True, default=list(DEFAULT_OPTIMIZATION_KWARGS))
+@click.option("--precision", "-p", "precisions", multiple=True, type=click.Choice(models.PRECISIONS), default=["fp32"])
+@click.option(
+    "--layout", "layouts", multiple=True, type=click.Choice(["contiguous", "channels_last"]), default=["contiguous"]
+)
+@click.option(
+    "--checkpoint-segments", "checkpoint_segments", multiple=True, type=int, default=[0], help="0 for no checkpoints"
+)
+@click.option(
+    "--gram-kwargs", "gram_kwargs_specs", multiple=True,
+    help='JSON arguments of the approximate gram classes, e.g. {"rank": 128} or {"sample_rate": 0.25}'
+)
+@click.option("--max-evals", type=int, default=20)
+@click.option("--out", "-fp", "out_filepath", default="bench_output.json")
+def run(
+        model_names, layer_specs, gram_classes, image_sizes, optimization_methods, precisions, layouts,
+        checkpoint_segments, gram_kwargs_specs, max_evals, out_filepath
+):
+    results = []
+    # arguments only apply to the approximate gram classes, the others run once
+    gram_variants = [
+        (gram_class, gram_kwargs)
+        for gram_class in gram_classes
+        for gram_kwargs in (
+            [json.loads(i) for i in gram_kwargs_specs] or [None] if gram_class in APPROXIMATE_GRAM_CLASSES else [None]
+        )
+    ]
+    grid = itertools.product(
+        model_names, layer_specs, gram_variants, image_sizes, optimization_methods, precisions, layouts,
+        checkpoint_segments
+    )
+    for model, layers, (gram_class, gram_kwargs), image_size, optimization_method, precision, layout, segments in grid:
+        case = BenchmarkCase(
+            model, json.loads(layers), gram_class, image_size, optimization_method, max_evals=max_evals,
+            precision=precision, channels_last=layout == "channels_last", checkpoint_segments=segments,
+            gram_kwargs=gram_kwargs
+        )
+        try:
+            result = run_isolated(case)
+        except Exception as e:
+            click.echo(f"{asdict(case)} failed: {e!r}", err=True)
+            continue
+        click.echo(
+            f"{_describe(result)}: {result['evals_per_second']:.2f} evals/s, {result['peak_rss_mb']:.0f} MB"
+        )
+        results.append(result)
+
+    for result in against_reference(results):
+        if "speedup" in result:
+            click.echo(
+                f"{_describe(result)} vs default: {result['speedup']:.2f}x speed, "
+                f"{result['peak_rss_ratio']:.2f}x peak RSS, first loss {result['first_loss_deviation']:.2%} off, "
+                f"best loss {result['best_loss_deviation']:.2%} off"
+            )
+    for result in against_exact_gram(results):
+        if "gram_speedup" in result:
+            click.echo(
+                f"{_describe(result)} vs GramMatrix: {result['gram_speedup']:.2f}x speed, "
+                f"loss {result['gram_loss_error']:.2%} off, gradient cosine {result['gram_gradient_cosine']:.3f}"
+            )
+
+    with open(out_filepath, "w") as fd:
+        json.dump({"commit": _commit(), "torch": torch.__version__, "results": results}, fd, indent=2)
+
+
+@cli.command(name="compare")
+@click.argument("baseline_filepath")
+@click.argument("current_filepath")
+@click.option("--tolerance", "-t", type=float, default=.1, help="relative slowdown or memory growth to report")
+def compare_command(baseline_filepath, current_filepath, tolerance):
+    with open(baseline_filepath, "r") as fd:
+        baseline = json.load(fd)
+    with open(current_filepath, "r") as fd:
+        current = json.load(fd)
+
+    regressions = compare(baseline, current, tolerance)
+    for regression in regressions:
+        click.echo(regression)
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    cli()
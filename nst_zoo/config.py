@@ -7,6 +7,50 @@ from typing import List, Optional, Dict
 
 CUDA = int(os.getenv("CUDA", 0))
 
+# backbones kept alive per process (see model_cache), 0 MB means no memory ceiling
+MODEL_CACHE_SIZE = int(os.getenv("NST_MODEL_CACHE_SIZE", 2))
+MODEL_CACHE_MB = int(os.getenv("NST_MODEL_CACHE_MB", 0))
+
+# target gram matrices are cached on disk when a directory is given (see gram_cache)
+GRAM_CACHE_DIR = os.getenv("NST_GRAM_CACHE_DIR")
+GRAM_CACHE_MB = int(os.getenv("NST_GRAM_CACHE_MB", 1024))
+GRAM_CACHE_MEMORY_ENTRIES = int(os.getenv("NST_GRAM_CACHE_MEMORY_ENTRIES", 8))
+
+# per-iteration telemetry is written as JSON lines when a path is given (see telemetry)
+TELEMETRY_PATH = os.getenv("NST_TELEMETRY_PATH")
+TELEMETRY_SAMPLE_EVERY = int(os.getenv("NST_TELEMETRY_SAMPLE_EVERY", 1))
+
+# optimizations are snapshotted every NST_SNAPSHOT_SECONDS when a directory is given, and resumed from their
+# latest snapshot when restarted (see snapshots)
+SNAPSHOT_DIR = os.getenv("NST_SNAPSHOT_DIR")
+SNAPSHOT_SECONDS = float(os.getenv("NST_SNAPSHOT_SECONDS", 60))
+
+# pretrained weights are memory-mapped from this directory instead of going through torchvision when given
+# (see weight_store)
+WEIGHT_STORE = os.getenv("NST_WEIGHT_STORE")
+
+# finished trials are recorded in (and skipped thanks to) an SQLite file when a path is given (see result_index)
+RESULT_INDEX = os.getenv("NST_RESULT_INDEX")
+
+# stylization service (see service): requests waiting beyond NST_SERVICE_QUEUE_SIZE are rejected, and requests which
+# can share a batch are coalesced for up to NST_SERVICE_BATCH_WINDOW_MS, NST_SERVICE_MAX_BATCH at a time
+SERVICE_QUEUE_SIZE = int(os.getenv("NST_SERVICE_QUEUE_SIZE", 16))
+SERVICE_MAX_BATCH = int(os.getenv("NST_SERVICE_MAX_BATCH", 8))
+SERVICE_BATCH_WINDOW_MS = float(os.getenv("NST_SERVICE_BATCH_WINDOW_MS", 50))
+
+
+def merge_layers(*layer_dicts: dict) -> dict:
+    """
+    Union of several layer specifications, e.g. {"ReLU": [0]} and {"ReLU": [0, 2]} -> {"ReLU": [0, 2]}
+
+    Indices keep the order in which they first appear, so a single specification is returned unchanged
+    """
+    merged = {}
+    for layers in layer_dicts:
+        for layer_name, indices in layers.items():
+            merged[layer_name] = list(dict.fromkeys(merged.get(layer_name, []) + list(indices)))
+    return merged
+
 
 @dataclass
 class NSTConfig:
@@ -24,30 +68,60 @@ class NSTConfig:
     content_layers: Optional[Dict] = field(default_factory=lambda: {})
     alpha: Optional[float] = None  # total_loss = alpha*content_loss + (1-alpha)*style_loss
 
+    # starting point of the generated image (see nst_main.initial_image): "noise" (default), "content", "blurred"
+    # (content) or "previous", the image at init_img (output_filepath by default) when it exists
+    initialization: Optional[str] = None
+    init_img: Optional[str] = None
+
+    # image size (shorter side, 256 by default) and coarse-to-fine optimization (see nst_main._pyramid)
+    image_size: Optional[int] = None
+    pyramid_levels: Optional[int] = None
+    pyramid_evals: Optional[List[int]] = None
+
+    # images larger than tile_size go through the network in overlapping tiles (see tiling), 64 pixels of overlap
+    # by default
+    tile_size: Optional[int] = None
+    tile_overlap: Optional[int] = None
+
+    # execution mode of the frozen backbone (see models.set_execution_mode): "bf16" runs it in bfloat16 autocast,
+    # channels_last in NHWC memory format. Gram matrices and losses stay in fp32
+    precision: Optional[str] = None
+    channels_last: Optional[bool] = None
+    # gradient checkpointing of the layers between hooked ones, in this many segments (see models._nst_pipeline)
+    checkpoint_segments: Optional[int] = None
+
     # loss
     style_gram_class: Optional[str] = None
+    # arguments of the gram class, e.g. {"rank": 256} for RandomProjectionGramMatrix (see loss)
+    style_gram_kwargs: Optional[Dict] = None
 
     # optimization
     optimization_method: str = "LBFGS"
     optimization_kwargs: Dict = field(default_factory=lambda: {"line_search_fn": "strong_wolfe"})
 
+    # stopping criteria (see optimization.StoppingCriteria), max_evals defaults to 200
+    max_evals: Optional[int] = None
+    tolerance_change: Optional[float] = None
+    patience: Optional[int] = None
+    max_seconds: Optional[float] = None
+
     save_as: Optional[str] = "english"  # convenient to save as hash if running many trials
     output_filepath: Optional[str] = ""
 
     def __post_init__(self):
-        print(vars(self))
         """
-        combine style_image and content_image names if output_filepath is not specified
+        combine content_img and style_img names if output_filepath is not specified
+
+        layers is the union of the style and content layers, which the model is hooked on
         """
-        self.layers = {**self.style_layers, **self.content_layers}
+        self.layers = merge_layers(self.style_layers or {}, self.content_layers or {})
 
         if not self.output_filepath:
             if self.save_as == "hash":
                 self.output_filepath = self._md5() + ".jpg"
             else:
-                content_name = os.path.basename(self.content_image).split('.')[0]
-                style_name = os.path.basename(self.style_image).split('.')[0]
-                self.output_filepath = f"nst_zoo/data/generated/{content_name}_{style_name}.jpg"
+                names = [os.path.basename(i).split('.')[0] for i in (self.content_img, self.style_img) if i]
+                self.output_filepath = f"nst_zoo/data/generated/{'_'.join(names)}.jpg"
 
     def _md5(self):
         """
@@ -0,0 +1,309 @@
+from nst_zoo import models, loss
+from nst_zoo.config import CUDA, NSTConfig, merge_layers
+from nst_zoo.gram_cache import gram_cache
+from nst_zoo.image_processing import BaseProcessor
+from nst_zoo.loss import NSTLoss, content_loss
+from nst_zoo.model_cache import model_cache
+from nst_zoo.models import get_activations
+from nst_zoo.telemetry import get_telemetry
+
+import os
+import json
+import glob
+import time
+import uuid
+import random
+from typing import Iterator, List, Optional
+
+import click
+import torch
+from torch import nn
+from torch.nn import functional
+
+# bump whenever the architecture or the content of a saved network changes
+NETWORK_VERSION = 1
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+class _ConvLayer(nn.Sequential):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, upsample=False, norm=True, relu=True):
+        layers = [nn.Upsample(scale_factor=2, mode="nearest")] if upsample else []
+        layers += [nn.ReflectionPad2d(kernel_size // 2), nn.Conv2d(in_channels, out_channels, kernel_size, stride)]
+        if norm:
+            layers.append(nn.InstanceNorm2d(out_channels, affine=True))
+        if relu:
+            layers.append(nn.ReLU(inplace=True))
+        super(_ConvLayer, self).__init__(*layers)
+
+
+class _ResidualBlock(nn.Module):
+    def __init__(self, channels):
+        super(_ResidualBlock, self).__init__()
+        self.layers = nn.Sequential(_ConvLayer(channels, channels, 3), _ConvLayer(channels, channels, 3, relu=False))
+
+    def forward(self, input):
+        return input + self.layers(input)
+
+
+class TransformerNet(nn.Module):
+    """
+    Image transformation network of Johnson et al. 2016: downsampling convolutions, residual blocks, then upsampling
+    convolutions, with instance normalization
+
+    Notes
+    -----
+    - Takes and returns preprocessed images (see image_processing.BaseProcessor), of any size
+    - `channels` is the width of the first layer (32 in the paper), the following ones are 2x and 4x as wide
+    """
+    def __init__(self, channels: int = 32, residual_blocks: int = 5):
+        super(TransformerNet, self).__init__()
+        self.channels = channels
+        self.residual_blocks = residual_blocks
+        self.layers = nn.Sequential(
+            _ConvLayer(3, channels, 9),
+            _ConvLayer(channels, channels * 2, 3, stride=2),
+            _ConvLayer(channels * 2, channels * 4, 3, stride=2),
+            *[_ResidualBlock(channels * 4) for _ in range(residual_blocks)],
+            _ConvLayer(channels * 4, channels * 2, 3, upsample=True),
+            _ConvLayer(channels * 2, channels, 3, upsample=True),
+            _ConvLayer(channels, 3, 9, norm=False, relu=False),
+        )
+
+    def forward(self, input):
+        output = self.layers(input)
+        if output.shape[-2:] != input.shape[-2:]:
+            # sizes which are not a multiple of 4 do not survive the two downsampling layers exactly
+            output = functional.interpolate(output, size=input.shape[-2:], mode="bilinear", align_corners=False)
+        return output
+
+
+def save_network(net: TransformerNet, fp: str, nst_config: Optional[NSTConfig] = None) -> None:
+    """
+    Save a trained network along with the configuration it was trained for, atomically
+    """
+    directory = os.path.dirname(os.path.abspath(fp))
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, f".tmp-{uuid.uuid4().hex}")
+    with open(tmp, "wb") as fd:
+        torch.save({
+            "version": NETWORK_VERSION,
+            "channels": net.channels,
+            "residual_blocks": net.residual_blocks,
+            "state_dict": net.state_dict(),
+            "config": {k: v for k, v in vars(nst_config).items() if k != "layers"} if nst_config else None,
+        }, fd)
+    os.replace(tmp, fp)
+
+
+def load_network(fp: str) -> TransformerNet:
+    saved = torch.load(fp, map_location="cpu")
+    if saved.get("version") != NETWORK_VERSION:
+        raise ValueError(f"{fp} was saved by an incompatible version of {__name__}")
+    net = TransformerNet(saved["channels"], saved["residual_blocks"])
+    net.load_state_dict(saved["state_dict"])
+    net.eval()
+    if torch.cuda.is_available():
+        net.cuda(device=CUDA)
+    return net
+
+
+def content_image_paths(paths: List[str]) -> List[str]:
+    """
+    Image files among paths, directories being replaced by the images they contain
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                i for i in glob.glob(os.path.join(path, "**", "*"), recursive=True)
+                if i.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        else:
+            files.append(path)
+    if not files:
+        raise ValueError(f"No content images found in {paths}")
+    return files
+
+
+def _random_crop(image: torch.Tensor, size: int) -> torch.Tensor:
+    top = random.randint(0, image.shape[2] - size)
+    left = random.randint(0, image.shape[3] - size)
+    return image[:, :, top:top + size, left:left + size]
+
+
+def _crop_batches(bp: BaseProcessor, paths: List[str], size: int, batch_size: int) -> Iterator[torch.Tensor]:
+    """
+    Endless batches of random crops of the images at paths
+
+    Every epoch goes through the images in a new random order, decoding each of them once: a batch is cropped from
+    the next batch_size images, or, when fewer are left (or there are fewer images than that), from the ones it
+    has, cropped several times
+    """
+    while True:
+        order = random.sample(paths, len(paths))
+        for start in range(0, len(order), batch_size):
+            images = [bp.preprocess(path) for path in order[start:start + batch_size]]
+            yield torch.cat([_random_crop(images[i % len(images)], size) for i in range(batch_size)])
+
+
+def target_grams(model: nn.Module, style_img: torch.Tensor, positions: List[int], gram_class) -> List[torch.Tensor]:
+    """
+    Gram matrices of the style image's activations at positions, from a single forward pass without autograd
+    """
+    with torch.no_grad():
+        activations = get_activations(model, style_img)
+    return [gram_class()(activations[i]) for i in positions]
+
+
+def fit(
+        net: TransformerNet,
+        model: nn.Module,
+        nst_loss: NSTLoss,
+        style_positions: List[int],
+        content_positions: List[int],
+        batches,
+        iterations: int,
+        lr: float = 1e-3,
+        alpha: Optional[float] = None
+) -> List[float]:
+    """
+    Train net so that its outputs minimize nst_loss while keeping the content of its inputs, return the losses
+
+    Notes
+    -----
+    - model must be hooked on the style and the content layers, whose activations are found at style_positions and
+      content_positions
+    - batches yields preprocessed content images
+    - total loss = alpha * content loss + (1 - alpha) * style loss, or their sum without alpha, as in NSTLoss
+    """
+    telemetry = get_telemetry()
+    optimizer = torch.optim.Adam(net.parameters(), lr=lr)
+    net.train()
+    losses = []
+    for iteration, content in zip(range(iterations), batches):
+        telemetry.begin()
+        optimizer.zero_grad()
+        with torch.no_grad():
+            content_activations = get_activations(model, content)
+        generated_activations = get_activations(model, net(content))
+
+        style = nst_loss(generated_style_activations=[generated_activations[i] for i in style_positions])
+        content_term = sum(content_loss(
+            [generated_activations[i] for i in content_positions],
+            [content_activations[i] for i in content_positions]
+        ))
+        total = alpha * content_term + (1 - alpha) * style if alpha else content_term + style
+        with telemetry.timer("backward"):
+            total.backward()
+        optimizer.step()
+        losses.append(float(total))
+        telemetry.end(loss=losses[-1], iteration=iteration)
+    net.eval()
+    return losses
+
+
+def train(
+        nst_config: NSTConfig,
+        content_images: List[str],
+        iterations: int = 2000,
+        batch_size: int = 4,
+        lr: float = 1e-3,
+        channels: int = 32,
+        residual_blocks: int = 5
+) -> TransformerNet:
+    """
+    Train a TransformerNet for the style of nst_config and save it to nst_config.output_filepath
+
+    Uses the same backbone (model_cache), target gram matrices (gram_cache) and style loss (NSTLoss) as main(),
+    on random image_size crops of the content images. nst_config needs content_layers for the content loss.
+    """
+    if not nst_config.content_layers:
+        raise ValueError("Training a feed-forward network requires content_layers")
+    paths = content_image_paths(content_images)
+    size = nst_config.image_size or 256
+    bp = BaseProcessor(size)
+    layers = merge_layers(nst_config.style_layers, nst_config.content_layers)
+
+    get_telemetry().start_run(nst_config._md5())
+    get_telemetry().event("config", **vars(nst_config))
+    with model_cache.hooked(
+            nst_config.model, nst_config.pool, layers, nst_config.precision, nst_config.channels_last,
+            nst_config.checkpoint_segments
+    ) as model:
+        style_positions = models.layer_positions(layers, nst_config.style_layers)
+        gram_class = loss.get_gram_class(nst_config.style_gram_class, nst_config.style_gram_kwargs)
+        style_img = bp.preprocess(nst_config.style_img)
+        target_style_grams = gram_cache.get_or_compute(
+            gram_cache.key(
+                nst_config.style_img, nst_config.model, nst_config.pool, nst_config.style_layers,
+                nst_config.style_gram_class, processor=bp, precision=nst_config.precision,
+                gram_kwargs=nst_config.style_gram_kwargs
+            ),
+            lambda: target_grams(model, style_img, style_positions, gram_class)
+        )
+        nst_loss = NSTLoss(
+            style_targets=target_style_grams,
+            style_weights=nst_config.style_layer_weights,
+            style_gram_class=gram_class
+        )
+
+        net = TransformerNet(channels, residual_blocks)
+        if torch.cuda.is_available():
+            net.cuda(device=CUDA)
+        batches = _crop_batches(bp, paths, size, batch_size)
+        fit(
+            net, model, nst_loss, style_positions, models.layer_positions(layers, nst_config.content_layers),
+            batches, iterations, lr=lr, alpha=nst_config.alpha
+        )
+
+    save_network(net, nst_config.output_filepath, nst_config)
+    return net
+
+
+def stylize(net: TransformerNet, image, image_size: Optional[int] = None) -> torch.Tensor:
+    """
+    Stylized version of an image (path or unprocessed c x h x w tensor) with a single forward pass, as a
+    preprocessed image
+    """
+    bp = BaseProcessor(image_size)
+    with torch.no_grad():
+        return net(bp.preprocess(image))
+
+
+@click.group(name="nst-feedforward")
+def cli():
+    return
+
+
+@cli.command(name="train")
+@click.option("--config-filepath", "-fp", required=True, help="JSON NSTConfig; output_filepath is the network's path")
+@click.option("--content", "-c", "content_images", multiple=True, required=True, help="Image file or directory")
+@click.option("--iterations", "-i", type=int, default=2000)
+@click.option("--batch-size", "-b", type=int, default=4)
+@click.option("--lr", type=float, default=1e-3)
+@click.option("--channels", type=int, default=32, help="Width of the network's first layer")
+@click.option("--residual-blocks", type=int, default=5)
+def train_command(config_filepath, content_images, iterations, batch_size, lr, channels, residual_blocks):
+    with open(config_filepath, "r") as fd:
+        nst_config = NSTConfig(**json.load(fd))
+    started = time.perf_counter()
+    train(nst_config, list(content_images), iterations, batch_size, lr, channels, residual_blocks)
+    click.echo(f"{nst_config.output_filepath} trained in {time.perf_counter() - started:.0f}s")
+
+
+@cli.command(name="stylize")
+@click.option("--network", "-n", "network_filepath", required=True)
+@click.option("--content-img", "-c", required=True)
+@click.option("--output", "-o", "output_filepath", required=True)
+@click.option("--image-size", "-s", type=int, default=None, help="Shorter side of the output (256 by default)")
+def stylize_command(network_filepath, content_img, output_filepath, image_size):
+    net = load_network(network_filepath)
+    started = time.perf_counter()
+    stylized = stylize(net, content_img, image_size)
+    click.echo(f"stylized in {(time.perf_counter() - started) * 1000:.0f}ms")
+    BaseProcessor(image_size).save(stylized, fp=output_filepath)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,180 @@
+from .config import CUDA, GRAM_CACHE_DIR, GRAM_CACHE_MB, GRAM_CACHE_MEMORY_ENTRIES
+from .image_processing import BaseProcessor
+
+import os
+import json
+import shutil
+import hashlib
+import uuid
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+# bump whenever the meaning of a cached entry changes (e.g. the order of the gram matrices)
+CACHE_VERSION = 2
+
+# temporary directories older than this were abandoned by a dead worker
+STALE_SECONDS = 3600
+
+
+def preprocessing_tag(processor: BaseProcessor = BaseProcessor) -> str:
+    """
+    Version tag of the cache, which changes along with BaseProcessor.preprocessing_steps
+    """
+    steps = repr([repr(i) for i in processor.preprocessing_steps])
+    return hashlib.md5(f"{CACHE_VERSION}:{steps}".encode('utf-8')).hexdigest()
+
+
+class StyleGramCache:
+    """
+    Content-addressed, on-disk cache of target style gram matrices
+
+    Notes
+    -----
+    - Entries are keyed by a hash of the style image's bytes, the model, the pooling mode, the layers, the gram class,
+      the precision and the preprocessing_tag of the processor, so stale entries are never read once the
+      preprocessing changes
+    - Each entry is a directory holding one .npy file per layer, which is memory-mapped when read
+    - Entries are written to a temporary directory and renamed into place, and evicted by renaming them away before
+      deleting them, so several workers can share one directory without ever reading a partial entry
+    - The least recently used entries are evicted once the directory holds more than max_mb
+    - The last `memory_entries` entries used are also kept in memory, so consecutive trials sharing a style target
+      (see batch_processing.scheduling) only compute it once, even without a directory
+    """
+    def __init__(
+            self,
+            directory: Optional[str] = GRAM_CACHE_DIR,
+            max_mb: int = GRAM_CACHE_MB,
+            memory_entries: int = GRAM_CACHE_MEMORY_ENTRIES
+    ):
+        self.directory = directory
+        self.max_mb = max_mb
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(
+            self,
+            style_img: Union[str, torch.Tensor],
+            model: str,
+            pool: str,
+            layers: dict,
+            gram_class: str,
+            processor: BaseProcessor = BaseProcessor,
+            precision: Optional[str] = None,
+            gram_kwargs: Optional[dict] = None,
+            tiling: Optional[Tuple[int, int]] = None
+    ) -> str:
+        if isinstance(style_img, str):
+            with open(style_img, "rb") as fd:
+                image_bytes = fd.read()
+        else:
+            image_bytes = style_img.detach().cpu().numpy().tobytes()
+
+        params = [model, pool, layers, gram_class, preprocessing_tag(processor)]
+        if precision and precision != "fp32":
+            # reduced precision targets differ slightly from fp32 ones, whose keys are left unchanged
+            params.append(precision)
+        if gram_kwargs:
+            params.append(gram_kwargs)
+        if tiling:
+            # (tile_size, overlap): tiled targets differ from whole-image ones (see tiling.tiled_grams)
+            params.append(["tiling", *tiling])
+        params = json.dumps(params, sort_keys=True)
+        return hashlib.sha256(image_bytes + params.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[List[torch.Tensor]]:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        grams = self._get_from_disk(key)
+        if grams is not None:
+            self._remember(key, grams)
+        return grams
+
+    def _get_from_disk(self, key: str) -> Optional[List[torch.Tensor]]:
+        if not self.directory:
+            return None
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, "meta.json"), "r") as fd:
+                meta = json.load(fd)
+            # copy-on-write mapping: pages are shared between processes until written to
+            grams = [
+                torch.from_numpy(np.load(os.path.join(entry, f"{i}.npy"), mmap_mode="c"))
+                for i in range(meta["n_layers"])
+            ]
+            os.utime(entry)  # recency for eviction
+        except (OSError, ValueError, KeyError):
+            # missing, or evicted while being read
+            return None
+
+        if torch.cuda.is_available():
+            return [i.cuda(device=CUDA) for i in grams]
+        return grams
+
+    def put(self, key: str, grams: List[torch.Tensor]) -> None:
+        self._remember(key, grams)
+        if not self.directory:
+            return
+        tmp = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        for i, gram in enumerate(grams):
+            np.save(os.path.join(tmp, f"{i}.npy"), gram.detach().cpu().numpy())
+        with open(os.path.join(tmp, "meta.json"), "w") as fd:
+            json.dump({"n_layers": len(grams)}, fd)
+
+        try:
+            os.rename(tmp, os.path.join(self.directory, key))
+        except OSError:
+            # another worker stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._evict()
+
+    def get_or_compute(self, key: str, compute: Callable[[], List[torch.Tensor]]) -> List[torch.Tensor]:
+        grams = self.get(key)
+        if grams is None:
+            grams = compute()
+            self.put(key, grams)
+        return grams
+
+    def _remember(self, key: str, grams: List[torch.Tensor]):
+        self._memory[key] = grams
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("."):
+                # leftovers of workers which died while writing or evicting
+                if time.time() - os.path.getmtime(path) > STALE_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, i)) for i in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_mb * 2 ** 20:
+                break
+            trash = os.path.join(self.directory, f".evicted-{uuid.uuid4().hex}")
+            try:
+                os.rename(path, trash)
+            except OSError:
+                continue  # already evicted by another worker
+            shutil.rmtree(trash, ignore_errors=True)
+            self._memory.pop(os.path.basename(path), None)
+            total -= size
+
+
+# process-wide cache used by nst_main
+gram_cache = StyleGramCache()
@@ -1,8 +1,9 @@
 from .config import CUDA
 
-from typing import Union
+from typing import Optional, Union
 
 import torch
+from torch.nn import functional
 from torchvision import transforms
 from torchvision.utils import save_image
 from torch.autograd import Variable
@@ -16,6 +17,10 @@ class BaseProcessor:
     Notes
     -----
     Oddly enough, the image scale size seems to have a large effect on the output
+
+    Parameters
+    ----------
+    size: shorter side of preprocessed images, the 256 of preprocessing_steps when not given
     """
     preprocessing_steps = [
         transforms.Scale(256),  # arbitrarily chosen
@@ -32,6 +37,10 @@ class BaseProcessor:
         )
     ]
 
+    def __init__(self, size: Optional[int] = None):
+        if size:
+            self.preprocessing_steps = [transforms.Scale(size)] + BaseProcessor.preprocessing_steps[1:]
+
     def preprocess(self, img: Union[str, torch.Tensor, Variable]) -> Variable:
         if isinstance(img, str):
             img = transforms.ToTensor()(Image.open(img))
@@ -63,3 +72,29 @@ def noise_of_same_type(tensor):
         torch.randn(size=tensor.size(), dtype=tensor.dtype),
         requires_grad=True
     )
+
+
+def blur(tensor, sigma: float = 4.):
+    """
+    Gaussian blur (standard deviation in pixels) of a (b, c, h, w) image, as a new image to optimize
+    """
+    radius = max(1, int(3 * sigma))
+    x = torch.arange(-radius, radius + 1, dtype=tensor.dtype, device=tensor.device)
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    kernel = kernel / kernel.sum()
+    channels = tensor.shape[1]
+    blurred = tensor.detach()
+    # separable: rows then columns, with reflected borders
+    passes = ((kernel.view(1, 1, 1, -1), (radius, radius, 0, 0)), (kernel.view(1, 1, -1, 1), (0, 0, radius, radius)))
+    for weight, padding in passes:
+        blurred = functional.pad(blurred, padding, mode="reflect")
+        blurred = functional.conv2d(blurred, weight.expand(channels, 1, -1, -1), groups=channels)
+    return Variable(blurred, requires_grad=True)
+
+
+def resize_like(tensor, like):
+    """
+    Bilinear resize of tensor to the height and width of like, as a new image to optimize
+    """
+    resized = functional.interpolate(tensor.detach(), size=like.shape[-2:], mode="bilinear", align_corners=False)
+    return Variable(resized, requires_grad=True)
@@ -1,32 +1,119 @@
-from typing import List
+import sys
+from functools import partial
+from typing import List, Optional
 
 import torch.nn as nn
 import torch
 
+from .telemetry import get_telemetry
+
 
 class GramMatrix(nn.Module):
     """
     Base Gram Matrix calculation as per Gatys et al. 2015
+
+    Gram classes expose `features`, the (b, c, n) matrix F such that G = F F^T / n, which lets FusedStyleLoss
+    skip building the gram matrix through autograd
     """
-    def forward(self, input):
+    def features(self, input):
         b, c, h, w = input.size()
-        F = input.view(b, c, h*w)
+        return input.view(b, c, h*w)
+
+    def forward(self, input):
+        F = self.features(input)
         G = torch.bmm(F, F.transpose(1, 2))
-        G = G.div_(h*w)
+        G = G.div_(F.shape[2])
         return G
 
 
-class NormalizedGramMatrix(nn.Module):
+class NormalizedGramMatrix(GramMatrix):
     """
     I have found that normalizing the tensor before calculating the gram matrices leads to better convergence.
     """
-    def forward(self, input):
+    def features(self, input):
         b, c, h, w = input.size()
         F = input.view(b, c, h*w)
-        F = normalize_by_stddev(F)
-        G = torch.bmm(F, F.transpose(1, 2))
-        G = G.div_(h*w)
-        return G
+        return normalize_by_stddev(F)
+
+
+class SubsampledGramMatrix(GramMatrix):
+    """
+    Unbiased estimate of GramMatrix from a random `sample_rate` fraction of the spatial positions
+
+    Notes
+    -----
+    - A new sample is drawn on every call, so the loss is stochastic (and biased upwards by the variance of the
+      estimate): better suited to first order optimizers (e.g. Adam) than to LBFGS line searches
+    - Activations which do not require gradients (e.g. the style image's, for the targets) are not subsampled, so the
+      targets are exact
+    - seed makes the samples reproducible
+    """
+    approximates = GramMatrix
+
+    def __init__(self, sample_rate: float = .25, seed: Optional[int] = None):
+        super(SubsampledGramMatrix, self).__init__()
+        if not 0 < sample_rate <= 1:
+            raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate}")
+        self.sample_rate = sample_rate
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def subsample(self, F):
+        n = F.shape[2]
+        if self.sample_rate == 1 or not F.requires_grad:
+            return F
+        positions = torch.randperm(n, generator=self.generator)[:max(1, round(n * self.sample_rate))]
+        return F.index_select(2, positions.to(F.device))
+
+    def features(self, input):
+        return self.subsample(super(SubsampledGramMatrix, self).features(input))
+
+
+class RandomProjectionGramMatrix(SubsampledGramMatrix):
+    """
+    Gram matrix of `rank` random combinations of the channels, P F with P a fixed (rank, c) Gaussian matrix, optionally
+    over a subsample of the positions (see SubsampledGramMatrix)
+
+    Notes
+    -----
+    - The loss compares rank x rank matrices P G P^T instead of c x c ones, for about rank / c of the multiply-adds
+      of GramMatrix on wide layers. Their distance estimates the exact one (Johnson-Lindenstrauss): P is scaled by
+      1 / sqrt(c) so that the loss estimates GramMatrix's, and the style weights keep their meaning.
+    - P only depends on the seed and the number of channels, so targets cached by gram_cache in another process match
+    - Layers with at most `rank` channels are left exact
+    """
+    def __init__(self, rank: int = 256, sample_rate: Optional[float] = None, seed: int = 0):
+        super(RandomProjectionGramMatrix, self).__init__(sample_rate or 1., seed=seed)
+        self.rank = rank
+        self.seed = seed
+        self._projections = {}
+
+    def projection(self, channels: int, like: torch.Tensor) -> torch.Tensor:
+        key = (channels, like.device, like.dtype)
+        if key not in self._projections:
+            generator = torch.Generator().manual_seed(self.seed)
+            P = torch.randn(self.rank, channels, generator=generator) / channels ** .5
+            self._projections[key] = P.to(device=like.device, dtype=like.dtype)
+        return self._projections[key]
+
+    def features(self, input):
+        F = super(RandomProjectionGramMatrix, self).features(input)
+        channels = F.shape[1]
+        if channels <= self.rank:
+            return F
+        return torch.matmul(self.projection(channels, F), F)
+
+
+def get_gram_class(name: str, kwargs: Optional[dict] = None):
+    """
+    Gram class `name`, with kwargs (e.g. the rank of RandomProjectionGramMatrix) bound so that it is still built
+    without arguments
+    """
+    gram_class = getattr(sys.modules[__name__], name)
+    return partial(gram_class, **kwargs) if kwargs else gram_class
 
 
 def normalize_by_stddev(tensor):
@@ -61,8 +148,104 @@ def style_loss(
     -------
     list of loss corresponding with each activation that was passed
     """
-    generated_gram_matrices = [gram_class()(i) for i in generated_activations]
-    return [nn.MSELoss()(generated, target) for generated, target in zip(generated_gram_matrices, style_gram_matrices)]
+    gram, mse = gram_class(), nn.MSELoss()
+    return [mse(gram(generated), target) for generated, target in zip(generated_activations, style_gram_matrices)]
+
+
+def content_loss(
+        generated_activations: List[torch.Tensor],
+        content_activations: List[torch.Tensor]
+) -> List[torch.Tensor]:
+    """
+    Calculate MSE of generated activations vs the content image's activations at the same layers
+
+    Parameters
+    ----------
+    - generated_activations: list of generated activations
+
+    - content_activations: list of target activations, broadcast along the batch dimension of the generated ones
+
+    Returns
+    -------
+    list of loss corresponding with each activation that was passed
+    """
+    mse = nn.MSELoss()
+    return [
+        mse(generated, content.expand_as(generated))
+        for generated, content in zip(generated_activations, content_activations)
+    ]
+
+
+class _GramMSE(torch.autograd.Function):
+    """
+    scale * ||F F^T / n - target||^2, with a hand-written backward exploiting the symmetry of the gram matrix:
+    d/dF = 4 * scale / n * (G - target) F, a single bmm where autograd needs one for F and one for F^T
+
+    The difference G - target is computed in place in the gram matrix's buffer, which is the only c x c
+    temporary of the forward pass, and reused by the backward pass.
+
+    The forward pass deliberately uses the full matrix rather than its upper triangle: torch has no symmetric
+    rank-k product, so the bmm costs the same either way, and gathering the triangle (diagonal + 2 * strict upper
+    triangle) is 10-45x slower than one dot product over the contiguous buffer. The backward pass needs all of
+    G - target anyway.
+    """
+    @staticmethod
+    def forward(ctx, F, target, scale):
+        n = F.shape[2]
+        D = torch.bmm(F, F.transpose(1, 2)).div_(n).sub_(target)
+        flat = D.view(-1)
+        ctx.save_for_backward(F, D)
+        ctx.scale = scale
+        return torch.dot(flat, flat) * scale
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        F, D = ctx.saved_tensors
+        grad_F = torch.bmm(D, F).mul_(grad_output * 4 * ctx.scale / F.shape[2])
+        return grad_F, None, None
+
+
+class FusedStyleLoss(nn.Module):
+    """
+    Weighted sum of every layer's gram matrix MSE (same value as weighting the output of style_loss), as one scalar
+
+    Notes
+    -----
+    - The gram module, the per-layer weights and the MSE normalization are set up once rather than on every step
+    - Gram classes exposing `features` (see GramMatrix) go through _GramMSE, others fall back to autograd
+    - Pass breakdown=True to also get the (detached) weighted loss of each layer
+    """
+    def __init__(
+            self,
+            style_targets: List[torch.Tensor],
+            style_weights: List[float] = None,
+            gram_class: nn.Module = GramMatrix
+    ):
+        super(FusedStyleLoss, self).__init__()
+        if not style_weights:
+            style_weights = [1 / len(style_targets) for _ in style_targets]
+        self.style_targets = style_targets
+        self.gram = gram_class()
+        self.fused = hasattr(self.gram, "features")
+        # MSE is a mean over the c x c entries of every gram matrix in the batch
+        self.scales = [weight / target[0].numel() for weight, target in zip(style_weights, style_targets)]
+
+    def forward(self, generated_activations: List[torch.Tensor], breakdown: bool = False):
+        total = 0
+        losses = []
+        for generated, target, scale in zip(generated_activations, self.style_targets, self.scales):
+            if self.fused:
+                layer_loss = _GramMSE.apply(self.gram.features(generated), target, scale / generated.shape[0])
+            else:
+                layer_loss = nn.functional.mse_loss(self.gram(generated), target.expand(generated.shape[0], -1, -1))
+                layer_loss = layer_loss * scale * target[0].numel()
+            total = total + layer_loss
+            if breakdown:
+                losses.append(layer_loss.detach())
+
+        if breakdown:
+            return total, losses
+        return total
 
 
 class NSTLoss(nn.Module):
@@ -71,9 +254,10 @@ class NSTLoss(nn.Module):
 
     Notes
     -----
-    - Currently just supports style loss.
-    - Stores target gram activations in self, to avoid re-calculating on every forward pass
+    - Stores target gram matrices and content activations in self, to avoid re-calculating on every forward pass
+    - Content losses default to content_loss with uniform content_weights
     - Also stores style_weights and style_loss_fn in self for convenience
+    - Without a style_loss_fn, style loss goes through FusedStyleLoss
     """
     def __init__(
             self,
@@ -92,8 +276,11 @@ class NSTLoss(nn.Module):
         self.alpha=alpha
 
     def _init_content(self, content_targets, content_weights, content_loss_fn):
-        if content_targets or content_weights or content_loss_fn:
-            raise NotImplementedError
+        self.content_targets = content_targets
+        if content_targets and not content_weights:
+            content_weights = [1 / len(content_targets) for _ in content_targets]
+        self.content_weights = content_weights
+        self.content_loss_fn = content_loss_fn or content_loss
 
     def _init_style(self, style_targets, style_weights, style_loss_fn, style_gram_class):
         self.style_targets = style_targets
@@ -102,6 +289,8 @@ class NSTLoss(nn.Module):
         self.style_weights = style_weights
         self.style_loss_fn = style_loss_fn
         self.style_gram_class = style_gram_class
+        if style_loss_fn is None:
+            self.fused_style_loss = FusedStyleLoss(style_targets, style_weights, style_gram_class)
 
     def forward(self, generated_style_activations=None, generated_content_activations=None):
         """
@@ -112,17 +301,30 @@ class NSTLoss(nn.Module):
         generated_content_activations: activations from given layers in a given model
 
 
-        Todo
-        ----
-        - Implement structured logging instead of print statements
+        Notes
+        -----
+        - Per-layer style losses are recorded in the telemetry (see telemetry.Telemetry) of sampled iterations
         """
 
         content_losses = []
         style_losses = []
 
-        if generated_style_activations:
+        if generated_style_activations and self.style_loss_fn is None:
+            telemetry = get_telemetry()
+            with telemetry.timer("gram"):
+                if telemetry.sampled:
+                    style_loss, breakdown = self.fused_style_loss(generated_style_activations, breakdown=True)
+                    telemetry.update(style_losses=[float(i) for i in breakdown])
+                else:
+                    style_loss = self.fused_style_loss(generated_style_activations)
+            style_losses = [style_loss]
+        elif generated_style_activations:
             style_losses = self.style_loss_fn(generated_style_activations, self.style_targets, self.style_gram_class)
             style_losses = [weight * loss for weight, loss in zip(self.style_weights, style_losses)]
+            telemetry = get_telemetry()
+            if telemetry.sampled:
+                # float() waits for the device, so only sampled iterations pay for it
+                telemetry.update(style_losses=[float(i) for i in style_losses])
 
         if generated_content_activations:
             content_losses = self.content_loss_fn(generated_content_activations, self.content_targets)
@@ -130,6 +332,28 @@ class NSTLoss(nn.Module):
 
         if self.alpha:
             return (sum(content_losses) * self.alpha) + (sum(style_losses) * (1-self.alpha))
-        print([float(i) for i in style_losses])
         return sum(content_losses) + sum(style_losses)
 
+
+class BatchedNSTLoss(nn.Module):
+    """
+    Sum of independent NSTLoss terms, one per generated image stacked along the batch dimension.
+
+    Notes
+    -----
+    - Expects activations for the union of every trial's layers; `layer_positions[i]` selects the
+      activations which belong to the i-th trial
+    - Each trial only sees its own slice of the batch, so gram classes that compute statistics across the batch
+      (e.g. NormalizedGramMatrix) behave exactly as they do for a single image
+    """
+    def __init__(self, losses: List[NSTLoss], layer_positions: List[List[int]]):
+        super(BatchedNSTLoss, self).__init__()
+        self.losses = nn.ModuleList(losses)
+        self.layer_positions = layer_positions
+
+    def forward(self, generated_style_activations=None, generated_content_activations=None):
+        total = 0
+        for i, (nst_loss, positions) in enumerate(zip(self.losses, self.layer_positions)):
+            activations = [generated_style_activations[p][i:i + 1] for p in positions]
+            total = total + nst_loss(generated_style_activations=activations)
+        return total
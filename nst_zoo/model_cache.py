@@ -0,0 +1,99 @@
+from .config import MODEL_CACHE_SIZE, MODEL_CACHE_MB
+from . import models
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Tuple
+
+from torch import nn
+
+
+class ModelCache:
+    """
+    Keep frozen backbones alive between trials, keyed by (model, pool)
+
+    Notes
+    -----
+    - Building a model means loading pretrained weights, swapping the pooling layers and moving it to the device,
+      which costs far more than a typical trial's setup. The cache pays for it once per process.
+    - Backbones are stored without hooks. Use `hooked` to attach a trial's layers, which are detached again
+      when the trial ends, so hooks never pile up on a shared model.
+    - Least recently used backbones are evicted once there are more than `max_models`, or once they take more than
+      `max_mb` (the most recent backbone is always kept).
+    - A hooked backbone must only be used by one trial at a time.
+    - The cache itself can be read from other threads (e.g. `keys` for the service's metrics) while a trial runs
+    """
+    def __init__(self, max_models: int = MODEL_CACHE_SIZE, max_mb: int = MODEL_CACHE_MB):
+        self.max_models = max_models
+        self.max_mb = max_mb
+        self._backbones = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, model: str, pool: str = "avg") -> nn.Module:
+        key = (model, pool)
+        with self._lock:
+            if key in self._backbones:
+                self._backbones.move_to_end(key)
+                return self._backbones[key]
+        # built outside of the lock, which would otherwise block readers for as long as loading the weights takes
+        backbone = models.backbone(model, pool)
+        with self._lock:
+            backbone = self._backbones.setdefault(key, backbone)
+            self._backbones.move_to_end(key)
+            self._evict()
+        return backbone
+
+    def keys(self) -> List[Tuple[str, str]]:
+        """
+        (model, pool) of the cached backbones, least recently used first
+        """
+        with self._lock:
+            return list(self._backbones)
+
+    @contextmanager
+    def hooked(
+            self,
+            model: str,
+            pool: str,
+            layers: dict,
+            precision: str = "fp32",
+            channels_last: bool = False,
+            checkpoint_segments: int = None
+    ):
+        """
+        Yield the cached backbone with hooks on `layers`, in the given execution mode (see models.set_execution_mode)
+        and optionally checkpointed, detaching the hooks and checkpoints and restoring the default mode on exit
+        """
+        backbone = self.get(model, pool)
+        models.validate_layers(backbone, layers)
+        models.set_execution_mode(backbone, precision, channels_last)
+        models._add_hooks_to_model(backbone, layers, checkpoint_segments)
+        try:
+            yield backbone
+        finally:
+            models.remove_hooks(backbone)
+            models.set_execution_mode(backbone)
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            backbones = list(self._backbones.values())
+        return sum(models.model_nbytes(i) for i in backbones)
+
+    def clear(self):
+        with self._lock:
+            self._backbones.clear()
+
+    def _evict(self):
+        def over_limit():
+            if len(self._backbones) > self.max_models:
+                return True
+            return bool(self.max_mb) and self.nbytes > self.max_mb * 2 ** 20
+
+        while len(self._backbones) > 1 and over_limit():
+            self._backbones.popitem(last=False)
+
+
+# process-wide cache used by nst_main
+model_cache = ModelCache()
@@ -1,8 +1,13 @@
-from torchvision import models
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 import torch
+import inspect
 from collections import Counter
-from .config import CUDA
+from contextlib import nullcontext
+from functools import reduce
+from .config import CUDA, merge_layers
+from .telemetry import get_telemetry
+from .weight_store import weight_store, uninitialized, PRETRAINED_KWARGS
 
 
 def validate_layers(model: nn.Module, layers:dict):
@@ -28,200 +33,492 @@ def validate_layers(model: nn.Module, layers:dict):
         raise IndexError(f"{invalid_indices} indices are too large for {type(model).__name__} layers")
 
 
-def _add_hooks_to_model(model: nn.Module, layers: dict) -> nn.Module:
+def layer_keys(layers: dict) -> list:
     """
-    Utility function
-
+    (layer name, index) pairs in config order, which is the order of the list returned by get_activations,
+    e.g. {"ReLU": [4, 0], "Conv2d": [1]} -> [("ReLU", 4), ("ReLU", 0), ("Conv2d", 1)]
     """
-    layer_counter = {k: 0 for k in layers.keys()}
-    for _, module in model.named_modules():
-        layer_name = type(module).__name__
-        if layer_name in layers.keys():
-            if layer_counter[layer_name] in layers[layer_name]:
-                module.register_forward_hook(_hook)
-            layer_counter[layer_name] += 1
-    return model
-
-
-def _hook(module, input, output):
-    setattr(module, "_value_hook", output)
-
-
-def _replace_max_with_avg(model):
-    for i, named_module in enumerate(model.named_modules()):
-        name, module = named_module
-        if type(module).__name__ == "MaxPool2d":
-            replacement = torch.nn.AvgPool2d(
-                kernel_size=module.kernel_size,
-                stride=module.stride,
-                padding=module.padding,
-            )
-            attr, index = name.split('.')
-            getattr(model, attr)[int(index)] = replacement
-    return model
+    return list(dict.fromkeys((layer_name, index) for layer_name, indices in layers.items() for index in indices))
 
 
-def _nst_pipeline(model, layers, pooling):
+def layer_positions(layers: dict, subset: dict) -> list:
     """
-    todo - replace pooling if kwarg
+    Positions (within the list returned by get_activations for a model hooked with `layers`) of the
+    activations requested by `subset`, which must be contained in `layers`
     """
-    validate_layers(model, layers)
-    if pooling=="avg":
-        model = _replace_max_with_avg(model)
-
-    model = _add_hooks_to_model(model, layers)
-    for param in model.parameters():
-        param.requires_grad = False
-    if torch.cuda.is_available():
-        model.cuda(device=CUDA)
-    return model
+    keys = layer_keys(layers)
+    return [keys.index(key) for key in layer_keys(subset)]
 
 
-def get_activations(model, image):
+class _SlotHook:
     """
-    do a forward pass (ignore the output), then return the _value_hooks
+    Forward hook writing a module's output into a fixed slot of its collector
     """
-    _ = model(image)
-    return [getattr(module, "_value_hook") for name, module in model.named_modules() if hasattr(module, "_value_hook")]
+    __slots__ = ("slots", "index")
 
+    def __init__(self, slots: list, index: int):
+        self.slots = slots
+        self.index = index
 
-def alexnet(layers, pooling="avg"):
-    return _nst_pipeline(models.alexnet(pretrained=True), layers, pooling)
+    def __call__(self, module, input, output):
+        self.slots[self.index] = output
 
 
-def densenet121(layers, pooling="avg"):
-    return _nst_pipeline(models.densenet121(pretrained=True), layers, pooling)
-
-
-def densenet161(layers, pooling="avg"):
-    return _nst_pipeline(models.densenet161(pretrained=True), layers, pooling)
-
-
-def densenet169(layers, pooling="avg"):
-    return _nst_pipeline(models.densenet169(pretrained=True), layers, pooling)
-
-
-def densenet201(layers, pooling="avg"):
-    return _nst_pipeline(models.densenet201(pretrained=True), layers, pooling)
-
-
-def googlenet(layers, pooling="avg"):
-    return _nst_pipeline(models.googlenet(pretrained=True), layers, pooling)
-
-
-def inception_v3(layers, pooling="avg"):
-    return _nst_pipeline(models.inception_v3(pretrained=True), layers, pooling)
-
-
-def mnasnet0_5(layers, pooling="avg"):
-    return _nst_pipeline(models.mnasnet0_5(pretrained=True), layers, pooling)
-
-
-def mnasnet0_75(layers, pooling="avg"):
-    return _nst_pipeline(models.mnasnet0_75(pretrained=True), layers, pooling)
-
-
-def mnasnet1_0(layers, pooling="avg"):
-    return _nst_pipeline(models.mnasnet1_0(pretrained=True), layers, pooling)
-
-
-def mnasnet1_3(layers, pooling="avg"):
-    return _nst_pipeline(models.mnasnet1_3(pretrained=True), layers, pooling)
-
-
-def mobilenet_v2(layers, pooling="avg"):
-    return _nst_pipeline(models.mobilenet_v2(pretrained=True), layers, pooling)
+class ActivationCollector:
+    """
+    Collects the outputs of a model's hooked layers, in config order
+
+    Notes
+    -----
+    - Every hooked module writes into a slot allocated once, when the hooks are attached, so a forward pass costs no
+      Python work beyond the hooks themselves
+    - collect() hands the activations over and empties the slots, so no tensor (or autograd graph) outlives the
+      step that produced it
+    - The forward pass is truncated after the deepest hooked module (see _truncate_forward)
+    - Hook-free parts of the model can be checkpointed (see _checkpoint_hook_free_runs)
+    - remove() detaches everything, so the model can be hooked again for another trial
+    """
+    def __init__(self, model: nn.Module, layers: dict):
+        self.model = model
+        self.layers = layers
+        self.keys = layer_keys(layers)
+        self.slots = [None] * len(self.keys)
+        self.stop = None
+        self.checkpointed = []
+
+        slot_of = {key: i for i, key in enumerate(self.keys)}
+        hooked_modules = [None] * len(self.keys)
+        self._handles = []
+        layer_counter = {k: 0 for k in layers.keys()}
+        for _, module in model.named_modules():
+            layer_name = type(module).__name__
+            if layer_name in layers.keys():
+                key = (layer_name, layer_counter[layer_name])
+                if key in slot_of:
+                    self._handles.append(module.register_forward_hook(_SlotHook(self.slots, slot_of[key])))
+                    hooked_modules[slot_of[key]] = module
+                layer_counter[layer_name] += 1
+        self.hooked_modules = hooked_modules
+        _truncate_forward(self)
+
+    def collect(self) -> list:
+        activations = list(self.slots)
+        self.clear()
+        return activations
+
+    def clear(self):
+        for i in range(len(self.slots)):
+            self.slots[i] = None
+        if self.stop is not None:
+            self.stop.seen = 0
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        for container in self.checkpointed:
+            del container.forward  # back to the class' forward
+        self.checkpointed = []
+        self.clear()
+
+
+def _add_hooks_to_model(model: nn.Module, layers: dict, checkpoint_segments: int = None) -> ActivationCollector:
+    """
+    Utility function
 
+    Attaches a new ActivationCollector, stored as model._nst_collector for get_activations. Hooks from a
+    previous call are detached first, so they never pile up. With checkpoint_segments, the parts of the model
+    without hooks are also checkpointed (see _checkpoint_hook_free_runs).
+    """
+    remove_hooks(model)
+    _execution_order(model)  # dry run before any hook is attached
+    model._nst_collector = ActivationCollector(model, layers)
+    if checkpoint_segments:
+        _checkpoint_hook_free_runs(model._nst_collector, checkpoint_segments)
+    return model._nst_collector
 
-def resnet101(layers, pooling="avg"):
-    return _nst_pipeline(models.resnet101(pretrained=True), layers, pooling)
 
+def remove_hooks(model: nn.Module) -> nn.Module:
+    """
+    Detach the hooks added by _add_hooks_to_model, along with the activations they stored
+    """
+    collector = getattr(model, "_nst_collector", None)
+    if collector is not None:
+        collector.remove()
+    model._nst_collector = None
+    return model
 
-def resnet152(layers, pooling="avg"):
-    return _nst_pipeline(models.resnet152(pretrained=True), layers, pooling)
 
+class _StopForward(Exception):
+    """
+    Raised once every hooked module has produced its output, so that get_activations can skip the rest of the model
+    """
 
-def resnet18(layers, pooling="avg"):
-    return _nst_pipeline(models.resnet18(pretrained=True), layers, pooling)
 
+class _StopAfterCalls:
+    """
+    Forward hook raising _StopForward on the n-th call of a module within a forward pass (modules such as
+    torchvision's resnet blocks call the same ReLU several times, and the activation kept is the last one)
+    """
+    def __init__(self, calls: int):
+        self.calls = calls
+        self.seen = 0
 
-def resnet34(layers, pooling="avg"):
-    return _nst_pipeline(models.resnet34(pretrained=True), layers, pooling)
+    def __call__(self, module, input, output):
+        self.seen += 1
+        if self.seen == self.calls:
+            self.seen = 0
+            raise _StopForward
 
 
-def resnet50(layers, pooling="avg"):
-    return _nst_pipeline(models.resnet50(pretrained=True), layers, pooling)
+def _execution_order(model: nn.Module) -> list:
+    """
+    Modules in the order in which they return during a forward pass, with repetitions.
 
+    Registration order (named_modules) does not always match the order of execution for non-Sequential models,
+    so this is recorded once with a dry run and stored on the model.
+    """
+    if getattr(model, "_nst_execution_order", None) is None:
+        order = []
+        handles = [
+            module.register_forward_hook(lambda module, input, output: order.append(module))
+            for module in model.modules() if module is not model
+        ]
+        device = next(model.parameters()).device
+        try:
+            with torch.no_grad():
+                model(torch.zeros(1, 3, 224, 224, device=device))
+        finally:
+            for handle in handles:
+                handle.remove()
+        model._nst_execution_order = order
+    return model._nst_execution_order
+
+
+def _truncate_forward(collector: ActivationCollector) -> ActivationCollector:
+    """
+    Stop the forward pass right after the last call of the deepest hooked module, whatever the architecture.
 
-def resnext101_32x8d(layers, pooling="avg"):
-    return _nst_pipeline(models.resnext101_32x8d(pretrained=True), layers, pooling)
+    Anything computed after that point (deeper blocks, classifier head) cannot influence the activations,
+    so shallow layer selections only pay for the part of the network they use.
+    """
+    hooked_modules = set(collector.hooked_modules)
+    if not hooked_modules:
+        return collector
 
+    order = _execution_order(collector.model)
+    deepest = next(module for module in reversed(order) if module in hooked_modules)
+    collector.stop = _StopAfterCalls(calls=sum(module is deepest for module in order))
+    collector._handles.append(deepest.register_forward_hook(collector.stop))
+    return collector
 
-def resnext50_32x4d(layers, pooling="avg"):
-    return _nst_pipeline(models.resnext50_32x4d(pretrained=True), layers, pooling)
 
+# the backbone is in eval mode, so there is no randomness to replay; reentrant checkpoints behave the same in every
+# torch version (use_reentrant only exists, and must be passed explicitly, in recent ones)
+_CHECKPOINT_KWARGS = {"preserve_rng_state": False}
+if "use_reentrant" in inspect.signature(checkpoint).parameters:
+    _CHECKPOINT_KWARGS["use_reentrant"] = True
 
-def shufflenet_v2_x0_5(layers, pooling="avg"):
-    return _nst_pipeline(models.shufflenet_v2_x0_5(pretrained=True), layers, pooling)
 
+def _run_segment(modules: list):
+    def run(input):
+        # a copy, so that in-place modules (e.g. ReLU(inplace=True)) never modify the checkpoint's saved input
+        input = input.clone()
+        for module in modules:
+            input = module(input)
+        return input
+    return run
 
-def shufflenet_v2_x1_0(layers, pooling="avg"):
-    return _nst_pipeline(models.shufflenet_v2_x1_0(pretrained=True), layers, pooling)
 
+class _CheckpointedSequential:
+    """
+    Replacement forward of an nn.Sequential, running runs of hook-free children as checkpointed segments
+    """
+    def __init__(self, plan: list):
+        self.plan = plan  # (checkpointed, modules)
 
-def shufflenet_v2_x1_5(layers, pooling="avg"):
-    return _nst_pipeline(models.shufflenet_v2_x1_5(pretrained=True), layers, pooling)
+    def __call__(self, input):
+        for checkpointed, modules in self.plan:
+            if checkpointed and torch.is_grad_enabled() and input.requires_grad:
+                input = checkpoint(_run_segment(modules), input, **_CHECKPOINT_KWARGS)
+            else:
+                for module in modules:
+                    input = module(input)
+        return input
 
 
-def shufflenet_v2_x2_0(layers, pooling="avg"):
-    return _nst_pipeline(models.shufflenet_v2_x2_0(pretrained=True), layers, pooling)
+class _CheckpointedModule:
+    """
+    Replacement forward of a hook-free block called by a non-Sequential parent, running it as one checkpointed
+    segment when its input is a tensor, or a list of tensors (e.g. densenet's layers), which requires gradients
+    """
+    def __init__(self, forward):
+        self.forward = forward
+
+    def __call__(self, *args, **kwargs):
+        if len(args) != 1 or kwargs or not torch.is_grad_enabled():
+            return self.forward(*args, **kwargs)
+        input = args[0]
+        if isinstance(input, torch.Tensor):
+            if not input.requires_grad:
+                return self.forward(input)
+            return checkpoint(lambda i: self.forward(i.clone()), input, **_CHECKPOINT_KWARGS)
+        if isinstance(input, (list, tuple)) and input and all(isinstance(i, torch.Tensor) for i in input):
+            if not any(i.requires_grad for i in input):
+                return self.forward(input)
+            # copies, as for a single tensor, so that the block can never modify the checkpoint's saved inputs
+            return checkpoint(lambda *i: self.forward([j.clone() for j in i]), *input, **_CHECKPOINT_KWARGS)
+        return self.forward(*args)
+
+
+def _checkpoint_hook_free_runs(collector: ActivationCollector, segments: int) -> ActivationCollector:
+    """
+    Gradient checkpointing of the parts of the model which no hook needs to see.
+
+    Within every nn.Sequential on the way to the hooked modules, consecutive children without hooked modules
+    are split into (at most) `segments` checkpointed segments: only their inputs are kept for the backward pass,
+    and their activations are recomputed when it reaches them, trading compute for activation memory.
+    Hooked modules always run normally, so their hooks fire once per forward pass. So do in-place modules (e.g.
+    ReLU(inplace=True)) at the start of a run: they modify the output of the module before them, which may be a
+    hooked one, and must keep doing so for it to record the same activation as without checkpointing.
+
+    Other containers (e.g. resnet's top level or densenet's dense blocks) call their children in their own forward,
+    so the children cannot be regrouped. Their hook-free children which are blocks themselves (modules with
+    children, e.g. resnet's layer3 or a dense layer) are checkpointed one by one instead, while hook-free leaves
+    (a single convolution or normalization) are left alone, since checkpointing them alone saves nothing, and so
+    are blocks which only run after the forward pass is truncated.
+    """
+    hooked = set(collector.hooked_modules)
+    order = _execution_order(collector.model)
+    deepest = max((i for i, module in enumerate(order) if module in hooked), default=-1)
+    # modules which run before the forward pass is truncated (see _truncate_forward)
+    reached = set(order[:deepest])
+
+    def has_hooks(module):
+        return any(i in hooked for i in module.modules())
+
+    def visit(module):
+        if not has_hooks(module):
+            return
+        if not isinstance(module, nn.Sequential):
+            for child in module.children():
+                if has_hooks(child):
+                    visit(child)
+                elif next(child.children(), None) is not None and child in reached:
+                    child.forward = _CheckpointedModule(child.forward)
+                    collector.checkpointed.append(child)
+            return
+
+        plan, run = [], []
+
+        def flush():
+            while run and getattr(run[0], "inplace", False):
+                plan.append((False, [run.pop(0)]))
+            if not run:
+                return
+            size = -(-len(run) // segments)
+            plan.extend((True, run[i:i + size]) for i in range(0, len(run), size))
+            run.clear()
+
+        for child in module:
+            if has_hooks(child):
+                flush()
+                plan.append((False, [child]))
+                visit(child)
+            else:
+                run.append(child)
+        flush()
+        if any(checkpointed for checkpointed, _ in plan):
+            module.forward = _CheckpointedSequential(plan)
+            collector.checkpointed.append(module)
+
+    visit(collector.model)
+    return collector
 
 
-def squeezenet1_0(layers, pooling="avg"):
-    return _nst_pipeline(models.squeezenet1_0(pretrained=True), layers, pooling)
+def _replace_max_with_avg(model):
+    for name, module in list(model.named_modules()):
+        if type(module).__name__ == "MaxPool2d":
+            replacement = torch.nn.AvgPool2d(
+                kernel_size=module.kernel_size,
+                stride=module.stride,
+                padding=module.padding,
+            )
+            # works for any nesting, e.g. "maxpool" (resnet), "4" (nn.Sequential) or "features.4" (vgg)
+            *parents, attr = name.split('.')
+            setattr(reduce(getattr, parents, model), attr, replacement)
+    return model
 
 
-def squeezenet1_1(layers, pooling="avg"):
-    return _nst_pipeline(models.squeezenet1_1(pretrained=True), layers, pooling)
+def _nst_pipeline(model, layers, pooling, checkpoint_segments=None):
+    """
+    todo - replace pooling if kwarg
 
+    checkpoint_segments trades recompute for activation memory (see _checkpoint_hook_free_runs)
+    """
+    validate_layers(model, layers)
+    model = _prepare_backbone(model, pooling)
+    _add_hooks_to_model(model, layers, checkpoint_segments)
+    return model
 
-def vgg11(layers, pooling="avg"):
-    return _nst_pipeline(models.vgg11(pretrained=True), layers, pooling)
 
+def _prepare_backbone(model, pooling):
+    """
+    Everything in _nst_pipeline that does not depend on the layers, so that the result can be shared between trials
+    """
+    if pooling=="avg":
+        model = _replace_max_with_avg(model)
 
-def vgg11_bn(layers, pooling="avg"):
-    return _nst_pipeline(models.vgg11_bn(pretrained=True), layers, pooling)
+    # frozen feature extractor: batch norm must use running stats so that images stacked along the
+    # batch dimension (see nst_main.main_batched) do not influence each other
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad = False
+    if torch.cuda.is_available():
+        model.cuda(device=CUDA)
+    return model
 
 
-def vgg13(layers, pooling="avg"):
-    return _nst_pipeline(models.vgg13(pretrained=True), layers, pooling)
+def torchvision_model(name, pretrained=True):
+    """
+    torchvision model `name`, with its pretrained weights memory-mapped from the weight store when it is enabled
+    (NST_WEIGHT_STORE, see weight_store), so that neither the network nor torchvision's checkpoints are touched
+    """
+    from torchvision import models
+    if not pretrained or not weight_store.directory:
+        return getattr(models, name)(pretrained=pretrained)
+    with uninitialized():
+        model = getattr(models, name)(pretrained=False, **PRETRAINED_KWARGS.get(name, {}))
+    return weight_store.load_into(model, name)
 
 
-def vgg13_bn(layers, pooling="avg"):
-    return _nst_pipeline(models.vgg13_bn(pretrained=True), layers, pooling)
+def backbone(name, pooling="avg", pretrained=True):
+    """
+    Frozen, hook-free version of the model returned by the factory function `name` (see model_cache)
+    """
+    return _prepare_backbone(torchvision_model(name, pretrained), pooling)
 
 
-def vgg16(layers, pooling="avg"):
-    return _nst_pipeline(models.vgg16(pretrained=True), layers, pooling)
+def model_nbytes(model: nn.Module) -> int:
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(i.numel() * i.element_size() for i in tensors)
 
 
-def vgg16_bn(layers, pooling="avg"):
-    return _nst_pipeline(models.vgg16_bn(pretrained=True), layers, pooling)
+PRECISIONS = ("fp32", "bf16")
 
 
-def vgg19(layers, pooling="avg"):
-    return _nst_pipeline(models.vgg19(pretrained=True), layers, pooling)
+def set_execution_mode(model: nn.Module, precision: str = "fp32", channels_last: bool = False) -> nn.Module:
+    """
+    Run the forward passes of get_activations in bfloat16 autocast and/or with a channels_last memory format
 
+    Notes
+    -----
+    - Activations are still returned in fp32 and contiguous, so gram matrices and losses are accumulated in fp32
+    - bf16 requires torch.autocast (torch >= 1.10)
+    - set_execution_mode(model) restores the default fp32, contiguous mode
+    """
+    precision = precision or "fp32"
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got {precision!r}")
+    if precision != "fp32" and not hasattr(torch, "autocast"):
+        raise RuntimeError(f"precision={precision!r} requires torch.autocast (torch>=1.10), found {torch.__version__}")
+
+    channels_last = bool(channels_last)
+    if getattr(model, "_nst_channels_last", False) != channels_last:
+        model.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+    model._nst_precision = precision
+    model._nst_channels_last = channels_last
+    return model
 
-def vgg19_bn(layers, pooling="avg"):
-    return _nst_pipeline(models.vgg19_bn(pretrained=True), layers, pooling)
 
+def _autocast(precision: str, device_type: str):
+    if precision == "bf16":
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+    return nullcontext()
 
-def wide_resnet101_2(layers, pooling="avg"):
-    return _nst_pipeline(models.wide_resnet101_2(pretrained=True), layers, pooling)
 
+def get_activations(model, image):
+    """
+    do a forward pass (ignore the output), then return the hooked activations in config order
 
-def wide_resnet50_2(layers, pooling="avg"):
-    return _nst_pipeline(models.wide_resnet50_2(pretrained=True), layers, pooling)
+    The forward pass is interrupted after the deepest hooked module (see _truncate_forward), and runs in the
+    model's execution mode (see set_execution_mode)
+    """
+    collector = model._nst_collector
+    collector.clear()
+    precision = getattr(model, "_nst_precision", "fp32")
+    channels_last = getattr(model, "_nst_channels_last", False)
+    if channels_last:
+        image = image.contiguous(memory_format=torch.channels_last)
+    with get_telemetry().timer("forward"), _autocast(precision, image.device.type):
+        try:
+            _ = model(image)
+        except _StopForward:
+            pass
+    activations = collector.collect()
+    if precision != "fp32" or channels_last:
+        activations = [i.float().contiguous() for i in activations]
+    return activations
+
+
+# every torchvision model with a factory function in this module (see __getattr__)
+ARCHITECTURES = (
+    "alexnet",
+    "densenet121",
+    "densenet161",
+    "densenet169",
+    "densenet201",
+    "googlenet",
+    "inception_v3",
+    "mnasnet0_5",
+    "mnasnet0_75",
+    "mnasnet1_0",
+    "mnasnet1_3",
+    "mobilenet_v2",
+    "resnet101",
+    "resnet152",
+    "resnet18",
+    "resnet34",
+    "resnet50",
+    "resnext101_32x8d",
+    "resnext50_32x4d",
+    "shufflenet_v2_x0_5",
+    "shufflenet_v2_x1_0",
+    "shufflenet_v2_x1_5",
+    "shufflenet_v2_x2_0",
+    "squeezenet1_0",
+    "squeezenet1_1",
+    "vgg11",
+    "vgg11_bn",
+    "vgg13",
+    "vgg13_bn",
+    "vgg16",
+    "vgg16_bn",
+    "vgg19",
+    "vgg19_bn",
+    "wide_resnet101_2",
+    "wide_resnet50_2",
+)
+
+
+def _factory(name):
+    def factory(layers, pooling="avg", pretrained=True):
+        return _nst_pipeline(torchvision_model(name, pretrained), layers, pooling)
+    factory.__name__ = factory.__qualname__ = name
+    factory.__doc__ = f"{name} hooked on `layers`, with its max pooling replaced when pooling is 'avg'"
+    return factory
+
+
+def __getattr__(name):
+    """
+    Factory function of every architecture in ARCHITECTURES, e.g. models.vgg19(layers, pooling, pretrained), built on
+    first use
+    """
+    if name in ARCHITECTURES:
+        globals()[name] = _factory(name)
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
+def __dir__():
+    return sorted(set(globals()) | set(ARCHITECTURES))
@@ -1,49 +1,327 @@
 from nst_zoo.config import NSTConfig
-from nst_zoo.image_processing import BaseProcessor, noise_of_same_type
-from nst_zoo.loss import GramMatrix, style_loss, NSTLoss, NormalizedGramMatrix
+from nst_zoo.image_processing import BaseProcessor, noise_of_same_type, resize_like, blur
+from nst_zoo.loss import NSTLoss, BatchedNSTLoss
 from nst_zoo import models, loss
 from nst_zoo.models import get_activations
-from nst_zoo.optimization import optimize
+from nst_zoo.model_cache import model_cache
+from nst_zoo.gram_cache import gram_cache
+from nst_zoo.snapshots import snapshots
+from nst_zoo.optimization import optimize, activation_objective, StoppingCriteria
+from nst_zoo.telemetry import get_telemetry
+from nst_zoo.tiling import TiledStyleObjective, tiled_grams, DEFAULT_OVERLAP
+from dataclasses import asdict
+from typing import List, Optional, Tuple
+import os
+import json
 import torch
 
+# configurations can only share a batch if they share the backbone, the style target, the optimizer and the
+# stopping criteria
+_BATCH_SHARED_FIELDS = (
+    "model", "pool", "style_img", "optimization_method", "optimization_kwargs",
+    "image_size", "pyramid_levels", "pyramid_evals", "precision", "channels_last", "checkpoint_segments",
+    "max_evals", "tolerance_change", "patience", "max_seconds"
+)
 
-def main(nst_config: NSTConfig) -> None:
+INITIALIZATIONS = ("noise", "content", "blurred", "previous")
+
+# standard deviation, in pixels at 256px (the shorter side, as image_size), of the blur of the "blurred" initialization
+BLUR_SIGMA = 4.
+
+
+def main(nst_config: NSTConfig) -> StoppingCriteria:
     """
-    1) Preprocess image in accordance with torchvision model subset
+    1) Preprocess image in accordance with torchvision model subset. The model itself comes from the process-wide
+    model_cache, so repeated calls (e.g. a worker processing a queue) only build it once
 
     2) Store target gram matrices once (only requires 1 forward pass, so calculating before optimizing
-    safes on compute (since the generated image requires a forward pass on each iteration)
+    safes on compute (since the generated image requires a forward pass on each iteration). They are also
+    cached on disk across runs when NST_GRAM_CACHE_DIR is set (see gram_cache), as are the activations of the
+    content image at content_layers
 
     3) Define loss function (MSE of gram matrices  at corresponding ReLU activation - generated vs target)
-        - 200 iterations by default but can be adjusted with a kwarg
+        - with content_img and content_layers, plus the MSE of activations at the content layers, weighted by alpha
+        - the generated image starts from nst_config.initialization (see initial_image): starting from the content
+          image (or a blurred copy) rather than noise reaches a given loss in fewer evaluations
+        - 200 iterations by default but can be adjusted with max_evals, along with convergence and time-based
+          stopping criteria (see optimization.StoppingCriteria)
         - LBFGS optimization by default but all optimization methods are supported
+        - with pyramid_levels, steps 1-3 are repeated from a low resolution up to image_size, each level starting
+          from the upsampled result of the previous one (see _pyramid)
+        - with tile_size, images larger than a tile go through the network tile by tile, so that memory does not
+          grow with image_size (see tiling.TiledStyleObjective)
+        - with NST_SNAPSHOT_DIR set, the optimization is snapshotted periodically and an interrupted run of the same
+          configuration resumes from its latest snapshot (see snapshots)
 
     4) Reverse the preprocessing from step 1 and save an image in nst_zoo/data/generated/
-    """
-    bp = BaseProcessor()
-    style_img = bp.preprocess(nst_config.style_img)
-    noise_img = noise_of_same_type(style_img)
 
-    model_fn = getattr(models, nst_config.model)
-    model = model_fn(layers=nst_config.layers, pooling=nst_config.pool)
+    Returns the stopping criteria, which report why and after how many evaluations the optimization stopped
+    """
+    _validate_content(nst_config)
+    key = nst_config._md5()
+    get_telemetry().start_run(key)
+    get_telemetry().event("config", **vars(nst_config))
+    snapshot = snapshots.load(key)
+    generated_image, reports = None, []
+    if snapshot is not None:
+        reports = [StoppingCriteria(**i) for i in snapshot["reports"]]
+    style_positions = models.layer_positions(nst_config.layers, nst_config.style_layers)
+    content_positions = models.layer_positions(nst_config.layers, nst_config.content_layers)
+    with model_cache.hooked(
+            nst_config.model, nst_config.pool, nst_config.layers, nst_config.precision, nst_config.channels_last,
+            nst_config.checkpoint_segments
+    ) as model:
+        for level, (size, max_evals) in enumerate(_pyramid(nst_config)):
+            bp = BaseProcessor(size)
+            if snapshot is not None and level < snapshot["level"]:
+                continue  # finished before the interruption
+            style_img = bp.preprocess(nst_config.style_img)
+            content_img = bp.preprocess(nst_config.content_img) if nst_config.content_img else None
+            # the generated image takes the shape of the content image when there is one
+            reference = style_img if content_img is None else content_img
+            if snapshot is not None and level == snapshot["level"]:
+                noise_img = snapshot["image"].clone().requires_grad_()
+            elif generated_image is None:
+                noise_img = initial_image(nst_config, reference, content_img, bp)
+            else:
+                noise_img = resize_like(generated_image, reference)
 
-    # single forward pass to save target activations
-    target_style_activations = get_activations(model, style_img)
-    gram_class = getattr(loss, nst_config.style_gram_class)
-    target_style_grams = [gram_class()(i) for i in target_style_activations]
+            # single forward pass to save target activations, skipped when the gram matrices are cached
+            gram_class = loss.get_gram_class(nst_config.style_gram_class, nst_config.style_gram_kwargs)
+            overlap = nst_config.tile_overlap or DEFAULT_OVERLAP
+            if nst_config.tile_size:
+                compute_targets = lambda: tiled_grams(model, style_img, gram_class, nst_config.tile_size, overlap)
+            else:
+                compute_targets = lambda: _style_grams(get_activations(model, style_img), style_positions, gram_class)
+            target_style_grams = gram_cache.get_or_compute(
+                gram_cache.key(
+                    nst_config.style_img, nst_config.model, nst_config.pool, nst_config.style_layers,
+                    nst_config.style_gram_class, processor=bp, precision=nst_config.precision,
+                    gram_kwargs=nst_config.style_gram_kwargs,
+                    tiling=(nst_config.tile_size, overlap) if nst_config.tile_size else None
+                ),
+                compute_targets
+            )
+            target_content_activations = None
+            if content_positions:
+                # activations rather than gram matrices, under their own gram_class tag
+                target_content_activations = gram_cache.get_or_compute(
+                    gram_cache.key(
+                        nst_config.content_img, nst_config.model, nst_config.pool, nst_config.content_layers,
+                        "activations", processor=bp, precision=nst_config.precision
+                    ),
+                    lambda: _target_activations(model, content_img, content_positions)
+                )
 
-    nst_loss = NSTLoss(
-        style_targets=target_style_grams,
-        style_weights=nst_config.style_layer_weights,
-        style_loss_fn=loss.style_loss,
-        style_gram_class=gram_class
-    )
+            nst_loss = NSTLoss(
+                style_targets=target_style_grams,
+                style_weights=nst_config.style_layer_weights,
+                style_gram_class=gram_class,
+                content_targets=target_content_activations,
+                alpha=nst_config.alpha
+            )
 
-    optimization_fn = getattr(torch.optim, nst_config.optimization_method)
-    optimizer = optimization_fn([noise_img], **nst_config.optimization_kwargs)
-    generated_image = optimize(optimizer, noise_img, model, nst_loss)
+            optimization_fn = getattr(torch.optim, nst_config.optimization_method)
+            optimizer = optimization_fn([noise_img], **nst_config.optimization_kwargs)
+            stopping = StoppingCriteria.from_config(nst_config, max_evals=max_evals, reports=reports)
+            if snapshot is not None and level == snapshot["level"]:
+                optimizer.load_state_dict(snapshot["optimizer"])
+                stopping.resume_from(**snapshot["stopping"])
+            if nst_config.tile_size:
+                objective = TiledStyleObjective(
+                    model, target_style_grams, nst_config.style_layer_weights, gram_class,
+                    tile_size=nst_config.tile_size, overlap=overlap
+                )
+            else:
+                objective = activation_objective(model, nst_loss, style_positions, content_positions)
+            generated_image = optimize(
+                optimizer, noise_img, model, nst_loss, stopping=stopping, objective=objective,
+                snapshot=snapshots.periodic(key, level=level, reports=[asdict(i) for i in reports])
+            )
+            reports.append(stopping)
 
     bp.save(generated_image, fp=nst_config.output_filepath)
+    snapshots.remove(key)
+    return StoppingCriteria.combine(reports)
+
+
+def main_batched(nst_configs: List[NSTConfig]) -> StoppingCriteria:
+    """
+    Same as main(), but optimizes one generated image per configuration in a single run:
+
+    1) Fetch the model once, hooked with the union of every configuration's layers
+
+    2) Compute the target activations with a single forward pass of the style image, then pick each
+    configuration's layers out of them to build its gram matrices
+
+    3) Stack one noise image per configuration along the batch dimension, so every optimization step is a
+    single forward/backward pass for all of them. Each configuration keeps its own layers, weights and gram class.
+
+    4) Save each image of the batch to its configuration's output_filepath
+
+    Notes
+    -----
+    - All configurations must share the fields in _BATCH_SHARED_FIELDS
+    - The optimizer sees a single tensor, so e.g. LBFGS line searches are shared between the images
+    - Stopping criteria (shared by every configuration) apply to the sum of the losses
+    - Tiled configurations (see tiling) and configurations with a content image or an initialization other than
+      noise must be optimized one at a time with main()
+    """
+    reference = nst_configs[0]
+    if any(i.tile_size for i in nst_configs):
+        raise ValueError("Tiled configurations cannot be batched, use main()")
+    if any(not _batchable(i) for i in nst_configs):
+        raise ValueError("Configurations with content targets or initializations cannot be batched, use main()")
+    for field in _BATCH_SHARED_FIELDS:
+        if any(getattr(i, field) != getattr(reference, field) for i in nst_configs):
+            raise ValueError(f"All configurations in a batch must share the same {field}")
+
+    # the records of a batch belong to all of its configurations
+    get_telemetry().start_run("+".join(i._md5() for i in nst_configs))
+    for nst_config in nst_configs:
+        get_telemetry().event("config", **vars(nst_config))
+    generated_images, reports = None, []
+    layers = models.merge_layers(*[i.style_layers for i in nst_configs])
+    with model_cache.hooked(
+            reference.model, reference.pool, layers, reference.precision, reference.channels_last,
+            reference.checkpoint_segments
+    ) as model:
+        for size, max_evals in _pyramid(reference):
+            bp = BaseProcessor(size)
+            style_img = bp.preprocess(reference.style_img)
+            if generated_images is None:
+                noise_img = noise_of_same_type(style_img.expand(len(nst_configs), -1, -1, -1))
+            else:
+                noise_img = resize_like(generated_images, style_img)
+
+            # single forward pass to save target activations for every configuration, skipped when all of their
+            # gram matrices are cached
+            target_style_activations = []
+
+            def target_style_grams(layer_positions, gram_class):
+                if not target_style_activations:
+                    target_style_activations.extend(get_activations(model, style_img))
+                return [gram_class()(target_style_activations[i]) for i in layer_positions]
+
+            losses, positions = [], []
+            for nst_config in nst_configs:
+                layer_positions = models.layer_positions(layers, nst_config.style_layers)
+                gram_class = loss.get_gram_class(nst_config.style_gram_class, nst_config.style_gram_kwargs)
+                losses.append(NSTLoss(
+                    style_targets=gram_cache.get_or_compute(
+                        gram_cache.key(
+                            reference.style_img, reference.model, reference.pool, nst_config.style_layers,
+                            nst_config.style_gram_class, processor=bp, precision=reference.precision,
+                            gram_kwargs=nst_config.style_gram_kwargs
+                        ),
+                        lambda: target_style_grams(layer_positions, gram_class)
+                    ),
+                    style_weights=nst_config.style_layer_weights,
+                    style_gram_class=gram_class,
+                    alpha=nst_config.alpha
+                ))
+                positions.append(layer_positions)
+            nst_loss = BatchedNSTLoss(losses, positions)
+
+            optimization_fn = getattr(torch.optim, reference.optimization_method)
+            optimizer = optimization_fn([noise_img], **reference.optimization_kwargs)
+            stopping = StoppingCriteria.from_config(reference, max_evals=max_evals, reports=reports)
+            generated_images = optimize(optimizer, noise_img, model, nst_loss, stopping=stopping)
+            reports.append(stopping)
+
+    for i, nst_config in enumerate(nst_configs):
+        bp.save(generated_images[i:i + 1], fp=nst_config.output_filepath)
+    return StoppingCriteria.combine(reports)
+
+
+def initial_image(
+        nst_config: NSTConfig,
+        reference: torch.Tensor,
+        content_img: Optional[torch.Tensor] = None,
+        bp: Optional[BaseProcessor] = None
+) -> torch.Tensor:
+    """
+    Image the optimization starts from, shaped like the (preprocessed) reference image
+
+    Notes
+    -----
+    - "noise" (the default): gaussian noise, as in Gatys et al. 2015
+    - "content": the content image itself, so only the style has to be added. Far fewer evaluations reach a given
+      loss, at the cost of outputs closer to the content image (the content loss starts at 0)
+    - "blurred": the content image blurred, which keeps its layout but leaves its textures to the style
+    - "previous": the image at init_img (output_filepath by default), e.g. to refine an earlier result with other
+      weights; noise when there is no such image yet
+    """
+    initialization = nst_config.initialization or "noise"
+    if initialization == "content":
+        return content_img.detach().clone().requires_grad_()
+    if initialization == "blurred":
+        return blur(content_img, BLUR_SIGMA * min(content_img.shape[-2:]) / 256)
+    if initialization == "previous":
+        init_img = nst_config.init_img or nst_config.output_filepath
+        if init_img and os.path.exists(init_img):
+            return resize_like((bp or BaseProcessor()).preprocess(init_img), reference)
+    return noise_of_same_type(reference)
+
+
+def _style_grams(activations: List[torch.Tensor], positions: List[int], gram_class) -> List[torch.Tensor]:
+    return [gram_class()(activations[i]) for i in positions]
+
+
+def _target_activations(model, image: torch.Tensor, positions: List[int]) -> List[torch.Tensor]:
+    """
+    Activations of image at positions, from a single forward pass without autograd
+    """
+    with torch.no_grad():
+        activations = get_activations(model, image)
+    return [activations[i] for i in positions]
+
+
+def _validate_content(nst_config: NSTConfig) -> None:
+    initialization = nst_config.initialization or "noise"
+    if initialization not in INITIALIZATIONS:
+        raise ValueError(f"initialization must be one of {INITIALIZATIONS}, not {initialization}")
+    if nst_config.content_layers and not nst_config.content_img:
+        raise ValueError("content_layers require a content_img")
+    if initialization in ("content", "blurred") and not nst_config.content_img:
+        raise ValueError(f"The {initialization} initialization requires a content_img")
+    if nst_config.tile_size and nst_config.content_layers:
+        raise ValueError("Tiled configurations do not support content_layers")
+
+
+def batch_key(nst_config: NSTConfig) -> Optional[str]:
+    """
+    Configurations with the same key can be optimized together by main_batched, tiled ones and ones with content
+    targets or initializations (None) cannot
+    """
+    if nst_config.tile_size or not _batchable(nst_config):
+        return None
+    return json.dumps([getattr(nst_config, i) for i in _BATCH_SHARED_FIELDS], sort_keys=True, default=str)
+
+
+def _batchable(nst_config: NSTConfig) -> bool:
+    return not (nst_config.content_img or nst_config.content_layers or nst_config.initialization not in (None, "noise"))
+
+
+def _pyramid(nst_config: NSTConfig) -> List[Tuple[Optional[int], int]]:
+    """
+    (image size, max evaluations) of every optimization level, coarsest first
+
+    A single level at image_size unless pyramid_levels is set. The size then doubles at every level up to image_size,
+    and, unless pyramid_evals is given, every level gets half the evaluations of the previous one, starting from
+    max_evals. Low resolution levels are cheap, so most of the work happens there and the full resolution level
+    only refines the upsampled result.
+    """
+    max_evals = nst_config.max_evals or StoppingCriteria.max_evals
+    levels = nst_config.pyramid_levels or 1
+    if levels == 1:
+        return [(nst_config.image_size, max_evals)]
+
+    evals = nst_config.pyramid_evals or [max(1, max_evals // 2 ** i) for i in range(levels)]
+    if len(evals) != levels:
+        raise ValueError(f"pyramid_evals must have one entry per level ({levels})")
+    size = nst_config.image_size or 256
+    return [(size // 2 ** (levels - 1 - i), level_evals) for i, level_evals in enumerate(evals)]
 
 
 if __name__ == '__main__':
@@ -57,8 +335,8 @@ if __name__ == '__main__':
         "e": [0, 2, 4, 8, 12]
     }
 
-    for style_id, cnn_layers in gatys_style_config.items():
-        nst_config = NSTConfig(
+    nst_configs = [
+        NSTConfig(
             model="vgg19",
             pool="avg",
             style_img="nst_zoo/data/style/vangogh_starry_night.jpg",
@@ -70,4 +348,7 @@ if __name__ == '__main__':
             save_as="hash",
             #output_filepath=f"nst_zoo/data/generated/vangogh_style_{style_id}.jpg"
         )
-        main(nst_config)
+        for style_id, cnn_layers in gatys_style_config.items()
+    ]
+    # all styles share the model and the style image, so they can be optimized together
+    main_batched(nst_configs)
@@ -1,34 +1,242 @@
 from nst_zoo.loss import NSTLoss
 from nst_zoo.models import get_activations
+from nst_zoo.telemetry import get_telemetry
 from torch import optim
 from torch.optim.lbfgs import LBFGS
 from functools import singledispatch
+from dataclasses import dataclass, replace
+from typing import Callable, List, Optional
+import time
+import torch
+
+
+@dataclass
+class StoppingCriteria:
+    """
+    When optimize should stop, and (once it returns) why it stopped.
+
+    Notes
+    -----
+    - max_evals and max_seconds are hard budgets on loss evaluations and wall-clock time
+    - a step improves the loss when the best loss drops by more than tolerance_change (relative to the previous best,
+      0 by default). The run has converged after `patience` steps in a row without improvement (1 by default when
+      only tolerance_change is set, never when neither is set)
+    - for LBFGS a step is a call to optimizer.step, which may evaluate the loss several times
+    """
+    max_evals: int = 200
+    tolerance_change: Optional[float] = None
+    patience: Optional[int] = None
+    max_seconds: Optional[float] = None
+
+    # report, filled in by optimize
+    n_evals: int = 0
+    n_steps: int = 0
+    best_loss: Optional[float] = None
+    stop_reason: Optional[str] = None
+    seconds: float = 0.
+
+    @classmethod
+    def from_config(cls, nst_config, max_evals=None, reports=()) -> "StoppingCriteria":
+        """
+        max_evals overrides the configuration's, and the time spent in `reports` (e.g. previous pyramid levels)
+        is deducted from max_seconds
+        """
+        max_seconds = nst_config.max_seconds
+        if max_seconds is not None:
+            max_seconds -= sum(i.seconds for i in reports)
+        return cls(
+            max_evals=max_evals or nst_config.max_evals or cls.max_evals,
+            tolerance_change=nst_config.tolerance_change,
+            patience=nst_config.patience,
+            max_seconds=max_seconds,
+        )
+
+    @classmethod
+    def combine(cls, reports: List["StoppingCriteria"]) -> "StoppingCriteria":
+        """
+        Report of consecutive runs (e.g. pyramid levels): the last run's, with evaluations, steps and time summed
+        """
+        return replace(
+            reports[-1],
+            n_evals=sum(i.n_evals for i in reports),
+            n_steps=sum(i.n_steps for i in reports),
+            seconds=sum(i.seconds for i in reports),
+        )
+
+    def resume_from(self, n_evals: int, n_steps: int, best_loss: Optional[float], seconds: float):
+        """
+        Continue the counters of an interrupted run (see snapshots) rather than starting from zero
+        """
+        self._resumed = (n_evals, n_steps, best_loss, seconds)
+
+    def start(self):
+        self.n_evals, self.n_steps, self.best_loss, seconds = getattr(self, "_resumed", None) or (0, 0, None, 0.)
+        self.stop_reason = None
+        self._started = time.perf_counter() - seconds
+        self._steps_without_improvement = 0
+
+    def budget_exhausted(self) -> bool:
+        self.seconds = time.perf_counter() - self._started
+        if self.n_evals >= self.max_evals:
+            self.stop_reason = "max_evals"
+        elif self.max_seconds is not None and self.seconds >= self.max_seconds:
+            self.stop_reason = "max_seconds"
+        return self.stop_reason is not None
+
+    def evaluated(self, loss: float) -> bool:
+        """
+        Count an evaluation of the loss, return whether it is the best one so far
+        """
+        self.n_evals += 1
+        if self.best_loss is None or loss < self.best_loss:
+            self.best_loss = loss
+            return True
+        return False
+
+    def step(self, best_loss_before: Optional[float]) -> bool:
+        """
+        Account for a finished optimizer step, return whether optimize should stop
+        """
+        self.n_steps += 1
+        if best_loss_before is not None:
+            threshold = abs(best_loss_before) * (self.tolerance_change or 0.)
+            if best_loss_before - self.best_loss > threshold:
+                self._steps_without_improvement = 0
+            else:
+                self._steps_without_improvement += 1
+
+        patience = self.patience or (1 if self.tolerance_change is not None else None)
+        if patience is not None and self._steps_without_improvement >= patience:
+            self.stop_reason = "converged"
+        return self.stop_reason is not None or self.budget_exhausted()
+
+
+class _BudgetExhausted(Exception):
+    """
+    Raised from an LBFGS closure, which cannot otherwise interrupt a step
+    """
+
+
+def activation_objective(
+        model,
+        nst_loss: NSTLoss,
+        style_positions: Optional[List[int]] = None,
+        content_positions: Optional[List[int]] = None
+) -> Callable[[torch.Tensor], torch.Tensor]:
+    """
+    Default objective of optimize: a forward pass of the whole image through the hooked model, then a backward pass
+
+    An objective takes the image being optimized, fills in its gradient and returns the loss (see tiling for another)
+
+    Every activation is a style activation unless style_positions is given; the activations at content_positions
+    (see models.layer_positions) go to the content loss
+    """
+    telemetry = get_telemetry()
+
+    def objective(image):
+        activations = get_activations(model, image)
+        style = activations if style_positions is None else [activations[i] for i in style_positions]
+        content = [activations[i] for i in content_positions or []]
+        loss = nst_loss(generated_style_activations=style, generated_content_activations=content)
+        with telemetry.timer("backward"):
+            loss.backward()
+        return loss
+    return objective
 
 
 @singledispatch
-def optimize(optimizer: optim.Optimizer, noise_img, model, nst_loss: NSTLoss, epochs=200):
-    epoch = 0
-    while epoch < epochs:
+def optimize(
+        optimizer: optim.Optimizer,
+        noise_img,
+        model,
+        nst_loss: NSTLoss,
+        epochs=200,
+        stopping=None,
+        objective=None,
+        snapshot=None
+):
+    """
+    objective defaults to activation_objective(model, nst_loss). snapshot, when given, is called with the image, the
+    optimizer and the stopping criteria after every step (see snapshots.SnapshotStore.periodic)
+    """
+    stopping = stopping or StoppingCriteria(max_evals=epochs)
+    objective = objective or activation_objective(model, nst_loss)
+    stopping.start()
+    telemetry = get_telemetry()
+    while not stopping.budget_exhausted():
+        best_loss_before = stopping.best_loss
+        telemetry.begin()
         optimizer.zero_grad()
-        activations = get_activations(model, noise_img)
-        loss = nst_loss(style_activations=activations)
-        loss.backward()
-        epoch += 1
-        optimizer.step()
+        loss = objective(noise_img)
+        stopping.evaluated(float(loss))
+        with telemetry.timer("step"):
+            optimizer.step()
+        telemetry.end(loss=float(loss), n_evals=stopping.n_evals)
+        if stopping.step(best_loss_before):
+            break
+        if snapshot is not None:
+            snapshot(noise_img, optimizer, stopping)
+    _report(stopping)
     return noise_img
 
 
 @optimize.register(LBFGS)
-def _(optimizer: optim.Optimizer, noise_img, model, nst_loss: NSTLoss, epochs=200):
-    epoch = 0
-    while epoch < epochs:
-        def closure():
-            nonlocal epoch
-            optimizer.zero_grad()
-            activations = get_activations(model, noise_img)
-            loss = nst_loss(generated_style_activations=activations)
-            loss.backward()
-            epoch += 1
-            return loss
-        optimizer.step(closure)
+def _(
+        optimizer: optim.Optimizer,
+        noise_img,
+        model,
+        nst_loss: NSTLoss,
+        epochs=200,
+        stopping=None,
+        objective=None,
+        snapshot=None
+):
+    """
+    The budgets are checked before every evaluation of the loss. When one runs out in the middle of a step
+    (e.g. during a line search), the image is reset to the best point evaluated so far.
+    """
+    stopping = stopping or StoppingCriteria(max_evals=epochs)
+    objective = objective or activation_objective(model, nst_loss)
+    stopping.start()
+    telemetry = get_telemetry()
+    best_img = noise_img.detach().clone()
+
+    def closure():
+        if stopping.budget_exhausted():
+            raise _BudgetExhausted
+        telemetry.begin()
+        optimizer.zero_grad()
+        loss = objective(noise_img)
+        if stopping.evaluated(float(loss)):
+            best_img.copy_(noise_img.detach())
+        telemetry.end(loss=float(loss), n_evals=stopping.n_evals)
+        return loss
+
+    while True:
+        best_loss_before = stopping.best_loss
+        try:
+            # an LBFGS step spans several iterations, so it gets a record of its own, sampled like iterations
+            started = time.perf_counter()
+            optimizer.step(closure)
+            if telemetry.sample(stopping.n_steps + 1):
+                telemetry.event("step", step=stopping.n_steps + 1, seconds=time.perf_counter() - started)
+        except _BudgetExhausted:
+            noise_img.data.copy_(best_img)
+            break
+        if stopping.step(best_loss_before):
+            break
+        if snapshot is not None:
+            snapshot(noise_img, optimizer, stopping)
+    _report(stopping)
     return noise_img
+
+
+def _report(stopping: StoppingCriteria):
+    get_telemetry().event(
+        "optimization",
+        stop_reason=stopping.stop_reason,
+        n_evals=stopping.n_evals,
+        n_steps=stopping.n_steps,
+        best_loss=stopping.best_loss,
+        seconds=stopping.seconds,
+    )
@@ -0,0 +1,295 @@
+from nst_zoo.config import NSTConfig, SERVICE_QUEUE_SIZE, SERVICE_MAX_BATCH, SERVICE_BATCH_WINDOW_MS
+from nst_zoo.model_cache import model_cache
+from nst_zoo.nst_main import main, main_batched, batch_key
+from nst_zoo.telemetry import get_telemetry
+
+import json
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import List, Optional
+
+import click
+
+# requests larger than this are rejected before being parsed
+MAX_BODY_BYTES = 2 ** 20
+
+_REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable"
+}
+
+
+@dataclass
+class _Request:
+    nst_config: NSTConfig
+    future: asyncio.Future
+    received: float = field(default_factory=time.perf_counter)
+    started: Optional[float] = None
+    batch_size: int = 1
+
+
+class _HTTPError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[dict] = None):
+        super(_HTTPError, self).__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class StylizationService:
+    """
+    Stylization over HTTP, with the models kept warm in the process-wide model_cache
+
+    Notes
+    -----
+    - POST /stylize with a JSON NSTConfig runs it and answers with its output_filepath and optimization report
+      (output_filepath defaults to the configuration's hash, as with save_as="hash")
+    - Requests wait in a queue of at most `queue_size`; beyond that they are rejected with a 503 and Retry-After,
+      so that clients back off instead of piling up work
+    - The first waiting request is coalesced with the ones arriving within `batch_window_ms` which can share its
+      batch (see batch_key), up to `max_batch` of them, and they are optimized together by main_batched. The other
+      requests keep their place in the queue. The loss of a batch is the sum of its images' losses, so coalesced
+      requests are reported without a best_loss.
+    - Optimizations run one at a time in a worker thread, since a hooked backbone is used by one run at a time, so
+      the event loop keeps accepting requests and answering /metrics meanwhile
+    - GET /metrics reports the queue depth and latency percentiles over the last `window` requests
+    """
+    def __init__(
+            self,
+            queue_size: int = SERVICE_QUEUE_SIZE,
+            max_batch: int = SERVICE_MAX_BATCH,
+            batch_window_ms: float = SERVICE_BATCH_WINDOW_MS,
+            window: int = 1000
+    ):
+        self.queue_size = queue_size
+        self.max_batch = max(1, max_batch)
+        self.batch_window = batch_window_ms / 1000
+        self.queue = None
+        self._waiting = deque()  # taken off the queue while filling a batch, but not part of it
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._latencies = deque(maxlen=window)
+        self._queue_seconds = deque(maxlen=window)
+        self._batch_sizes = deque(maxlen=window)
+        self._counts = {"requests": 0, "rejected": 0, "failed": 0, "batches": 0}
+        self._running = 0
+
+    def queue_depth(self) -> int:
+        return (self.queue.qsize() if self.queue else 0) + len(self._waiting)
+
+    def submit(self, nst_config: NSTConfig) -> asyncio.Future:
+        """
+        Queue a configuration, return the future of its report; raises asyncio.QueueFull when the queue is full
+        """
+        if self.queue_depth() >= self.queue_size:
+            raise asyncio.QueueFull
+        request = _Request(nst_config, asyncio.get_running_loop().create_future())
+        self.queue.put_nowait(request)
+        self._counts["requests"] += 1
+        return request.future
+
+    async def _next_batch(self) -> List[_Request]:
+        first = self._waiting.popleft() if self._waiting else await self.queue.get()
+        batch, key = [first], batch_key(first.nst_config)
+        if key is None:
+            return batch
+        for request in list(self._waiting):
+            if len(batch) < self.max_batch and batch_key(request.nst_config) == key:
+                self._waiting.remove(request)
+                batch.append(request)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if batch_key(request.nst_config) == key:
+                batch.append(request)
+            else:
+                self._waiting.append(request)
+        return batch
+
+    async def run(self):
+        """
+        Serve queued requests until cancelled
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            nst_configs = [i.nst_config for i in batch]
+            for request in batch:
+                request.started = time.perf_counter()
+                request.batch_size = len(batch)
+            self._running = len(batch)
+            self._counts["batches"] += 1
+            self._batch_sizes.append(len(batch))
+            try:
+                if len(batch) == 1:
+                    report = await loop.run_in_executor(self._executor, main, nst_configs[0])
+                else:
+                    report = await loop.run_in_executor(self._executor, main_batched, nst_configs)
+                    report = replace(report, best_loss=None)
+            except Exception as e:
+                self._counts["failed"] += len(batch)
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+            else:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_result(report)
+            finally:
+                self._running = 0
+                for request in batch:
+                    self._finished(request)
+
+    def _finished(self, request: _Request):
+        now = time.perf_counter()
+        self._latencies.append(now - request.received)
+        self._queue_seconds.append(request.started - request.received)
+        get_telemetry().event(
+            "request",
+            run=request.nst_config._md5(),
+            output_filepath=request.nst_config.output_filepath,
+            seconds=now - request.received,
+            queue_seconds=request.started - request.received,
+            batch_size=request.batch_size,
+        )
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "queue_size": self.queue_size,
+            "running": self._running,
+            **self._counts,
+            "latency_seconds": _percentiles(self._latencies),
+            "queue_seconds": _percentiles(self._queue_seconds),
+            "mean_batch_size": sum(self._batch_sizes) / len(self._batch_sizes) if self._batch_sizes else None,
+            "models": [f"{model}/{pool}" for model, pool in model_cache.keys()],
+        }
+
+    async def stylize(self, body: bytes) -> dict:
+        try:
+            fields = json.loads(body or b"{}")
+            if not fields.get("output_filepath"):
+                fields.setdefault("save_as", "hash")
+            nst_config = NSTConfig(**fields)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise _HTTPError(400, f"invalid configuration: {e}")
+        try:
+            future = self.submit(nst_config)
+        except asyncio.QueueFull:
+            self._counts["rejected"] += 1
+            raise _HTTPError(503, "queue full", {"Retry-After": "1"})
+        try:
+            report = await future
+        except ValueError as e:
+            raise _HTTPError(400, str(e))
+        return {
+            "output_filepath": nst_config.output_filepath,
+            "stop_reason": report.stop_reason,
+            "n_evals": report.n_evals,
+            "best_loss": report.best_loss,
+            "seconds": report.seconds,
+        }
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Minimal HTTP/1.1: one request per connection, JSON in and out
+        """
+        status, payload, headers = 200, None, {}
+        try:
+            method, path, headers_in = await _read_head(reader)
+            length = int(headers_in.get("content-length", 0))
+            if length > MAX_BODY_BYTES:
+                raise _HTTPError(413, f"request bodies are limited to {MAX_BODY_BYTES} bytes")
+            body = await reader.readexactly(length) if length else b""
+            route = path.split("?")[0]
+            if route == "/stylize":
+                if method != "POST":
+                    raise _HTTPError(405, "POST a configuration to /stylize")
+                payload = await self.stylize(body)
+            elif route == "/metrics":
+                payload = self.metrics()
+            elif route == "/health":
+                payload = {"status": "ok"}
+            else:
+                raise _HTTPError(404, f"no route {route}")
+        except _HTTPError as e:
+            status, payload, headers = e.status, {"error": str(e)}, e.headers
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as e:
+            status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+
+        body = json.dumps(payload, default=str).encode("utf-8")
+        head = [f"HTTP/1.1 {status} {_REASONS[status]}", "Content-Type: application/json",
+                f"Content-Length: {len(body)}", "Connection: close"]
+        head += [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000, preload: tuple = ()):
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        for model in preload:
+            name, _, pool = model.partition("/")
+            await loop.run_in_executor(self._executor, model_cache.get, name, pool or "avg")
+        server = await asyncio.start_server(self.handle, host, port)
+        worker = asyncio.ensure_future(self.run())
+        try:
+            await server.serve_forever()
+        finally:
+            worker.cancel()
+            server.close()
+
+
+async def _read_head(reader: asyncio.StreamReader):
+    request_line = (await reader.readline()).decode("latin-1").split()
+    if len(request_line) != 3:
+        raise _HTTPError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return request_line[0].upper(), request_line[1], headers
+
+
+def _percentiles(values) -> Optional[dict]:
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def percentile(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"p50": percentile(.5), "p95": percentile(.95), "p99": percentile(.99), "max": ordered[-1]}
+
+
+@click.command(name="nst-service")
+@click.option("--host", "-h", default="127.0.0.1", type=str)
+@click.option("--port", "-p", default=8000, type=int)
+@click.option("--queue-size", "-q", default=SERVICE_QUEUE_SIZE, type=int, help="Requests waiting before rejecting")
+@click.option("--max-batch", "-b", default=SERVICE_MAX_BATCH, type=int, help="Requests optimized together")
+@click.option("--batch-window-ms", default=SERVICE_BATCH_WINDOW_MS, type=float, help="Wait to coalesce requests")
+@click.option("--preload", multiple=True, help="model/pool to load before serving, e.g. vgg19/avg")
+def cli(host, port, queue_size, max_batch, batch_window_ms, preload):
+    service = StylizationService(queue_size, max_batch, batch_window_ms)
+    asyncio.run(service.serve(host, port, preload))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,92 @@
+from .config import CUDA, SNAPSHOT_DIR, SNAPSHOT_SECONDS
+
+import os
+import time
+import uuid
+from typing import Callable, Optional
+
+import torch
+
+# bump whenever the content of a snapshot changes
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotStore:
+    """
+    Periodic snapshots of running optimizations, so that a restarted trial resumes where it stopped
+
+    Notes
+    -----
+    - A snapshot holds the generated image, the optimizer's state_dict (e.g. the LBFGS history), the pyramid level,
+      the stopping criteria's counters and the reports of the finished levels
+    - Snapshots are keyed by NSTConfig._md5, written to a temporary file and moved into place with os.replace, so a
+      snapshot is either the previous one or the new one, never a partial file
+    - Disabled (nothing is saved or loaded) when no directory is given
+    """
+    def __init__(self, directory: Optional[str] = SNAPSHOT_DIR, every_seconds: float = SNAPSHOT_SECONDS):
+        self.directory = directory
+        self.every_seconds = every_seconds
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pt")
+
+    def load(self, key: str) -> Optional[dict]:
+        if not self.directory:
+            return None
+        try:
+            snapshot = torch.load(self.path(key), map_location=f"cuda:{CUDA}" if torch.cuda.is_available() else "cpu")
+        except (OSError, EOFError, RuntimeError):
+            return None
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            return None
+        return snapshot
+
+    def save(self, key: str, snapshot: dict) -> None:
+        if not self.directory:
+            return
+        tmp = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+        with open(tmp, "wb") as fd:
+            torch.save({**snapshot, "version": SNAPSHOT_VERSION}, fd)
+            fd.flush()
+            os.fsync(fd.fileno())  # on disk before it replaces the previous snapshot
+        os.replace(tmp, self.path(key))
+
+    def remove(self, key: str) -> None:
+        if not self.directory:
+            return
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def periodic(self, key: str, **extra) -> Optional[Callable]:
+        """
+        Callback for optimization.optimize, saving a snapshot (along with `extra`) at most every every_seconds
+        """
+        if not self.directory:
+            return None
+        last_saved = time.perf_counter()
+
+        def snapshot(image, optimizer, stopping):
+            nonlocal last_saved
+            if time.perf_counter() - last_saved < self.every_seconds:
+                return
+            self.save(key, {
+                **extra,
+                "image": image.detach(),
+                "optimizer": optimizer.state_dict(),
+                "stopping": {
+                    "n_evals": stopping.n_evals,
+                    "n_steps": stopping.n_steps,
+                    "best_loss": stopping.best_loss,
+                    "seconds": stopping.seconds,
+                },
+            })
+            last_saved = time.perf_counter()
+        return snapshot
+
+
+# process-wide store used by nst_main
+snapshots = SnapshotStore()
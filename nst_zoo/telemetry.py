@@ -0,0 +1,159 @@
+from .config import TELEMETRY_PATH, TELEMETRY_SAMPLE_EVERY
+
+import os
+import json
+import resource
+import time
+from typing import Optional
+
+
+class NullSink:
+    """
+    Discards records; telemetry is disabled altogether with this sink
+    """
+    def write(self, record: dict):
+        pass
+
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record: dict):
+        self.records.append(record)
+
+
+class JSONLSink:
+    """
+    Appends one JSON record per line to `path` (append mode, so several workers may share a file)
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = open(path, "a", buffering=1)
+
+    def write(self, record: dict):
+        self._fd.write(json.dumps(record, default=str) + "\n")
+
+    def close(self):
+        self._fd.close()
+
+
+class _Timer:
+    __slots__ = ("telemetry", "name", "started")
+
+    def __init__(self, telemetry: "Telemetry", name: str):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        timings = self.telemetry._record
+        timings[self.name] = timings.get(self.name, 0.) + time.perf_counter() - self.started
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Telemetry:
+    """
+    Structured records of every optimization iteration (one evaluation of the loss)
+
+    Notes
+    -----
+    - An iteration is delimited by begin() and end(). Within it, timer(name) accumulates seconds under `name`
+      ("forward" in get_activations, "gram" in the style loss, "backward" and "step" in optimize) and update()
+      adds fields (e.g. the per-layer losses)
+    - Only one iteration in `sample_every` is recorded; the others (and everything when the sink is a NullSink)
+      cost a counter increment and no-op timers. Other repeated records (e.g. LBFGS steps) check sample(index).
+    - event() writes a one-off record (configuration, run summary) whenever the sink is enabled
+    - start_run(run) is called when a run (e.g. nst_main.main) starts: records carry `run` (the configuration's
+      NSTConfig._md5) and `pid`, so that the records of workers sharing a file can be told apart, and iterations
+      are numbered from 1 again
+    - Iteration records also carry the peak resident memory of the process (and of CUDA, when available)
+    """
+    def __init__(self, sink=None, sample_every: int = 1):
+        self.sink = sink or NullSink()
+        self.enabled = not isinstance(self.sink, NullSink)
+        self.sample_every = max(1, sample_every)
+        self.iteration = 0
+        self.run = None
+        self.sampled = False
+        self._record = None
+
+    def start_run(self, run: Optional[str]):
+        self.run = run
+        self.iteration = 0
+
+    def sample(self, index: int) -> bool:
+        """
+        Whether the index-th occurrence of a repeated record is recorded
+        """
+        return self.enabled and index % self.sample_every == 0
+
+    def begin(self):
+        self.iteration += 1
+        self.sampled = self.sample(self.iteration)
+        if self.sampled:
+            self._record = {"type": "iteration", "iteration": self.iteration}
+
+    def timer(self, name: str):
+        if self.sampled:
+            return _Timer(self, name)
+        return _NULL_TIMER
+
+    def update(self, **fields):
+        if self.sampled:
+            self._record.update(fields)
+
+    def end(self, **fields):
+        if self.sampled:
+            self._record.update(fields)
+            self._record.update(peak_memory())
+            self._record["time"] = time.time()
+            self._write(self._record)
+        self.sampled = False
+        self._record = None
+
+    def event(self, event_type: str, **fields):
+        if self.enabled:
+            self._write({"type": event_type, "time": time.time(), **fields})
+
+    def _write(self, record: dict):
+        # fields passed explicitly (e.g. the run of a request, see service) take precedence
+        self.sink.write({"run": self.run, "pid": os.getpid(), **record})
+
+
+def peak_memory() -> dict:
+    memory = {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    import torch
+    if torch.cuda.is_available():
+        memory["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return memory
+
+
+_telemetry = Telemetry(JSONLSink(TELEMETRY_PATH) if TELEMETRY_PATH else None, TELEMETRY_SAMPLE_EVERY)
+
+
+def get_telemetry() -> Telemetry:
+    return _telemetry
+
+
+def set_telemetry(telemetry: Optional[Telemetry] = None) -> Telemetry:
+    """
+    Replace the process-wide telemetry (disable it when None), return the previous one
+    """
+    global _telemetry
+    previous, _telemetry = _telemetry, telemetry or Telemetry()
+    return previous
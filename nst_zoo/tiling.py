@@ -0,0 +1,174 @@
+from nst_zoo.loss import GramMatrix
+from nst_zoo.models import get_activations
+from nst_zoo.telemetry import get_telemetry
+
+import math
+from typing import List, Optional, Tuple
+
+import torch
+from torch import nn
+from torch.nn import functional
+
+# overlap between neighbouring tiles when not given, in pixels
+DEFAULT_OVERLAP = 64
+
+
+def tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    """
+    Offsets of the tiles covering `length` pixels with at least `overlap` pixels shared between neighbours
+    """
+    if length <= tile_size:
+        return [0]
+    n_tiles = math.ceil((length - overlap) / (tile_size - overlap))
+    return [round(i * (length - tile_size) / (n_tiles - 1)) for i in range(n_tiles)]
+
+
+def _ramp(length: int, overlap: int) -> torch.Tensor:
+    distance_to_edge = torch.min(torch.arange(1., length + 1), torch.arange(float(length), 0., -1.))
+    return (distance_to_edge / max(overlap, 1)).clamp(max=1.)
+
+
+def tiles(height: int, width: int, tile_size: int, overlap: int = DEFAULT_OVERLAP) -> List[Tuple[tuple, torch.Tensor]]:
+    """
+    (window, mask) of every tile of a height x width image
+
+    Notes
+    -----
+    - window indexes a (b, c, h, w) image, mask is the tile's (1, 1, tile h, tile w) weight
+    - Weights ramp up linearly over `overlap` pixels from the edges of a tile and are normalized so that the masks sum
+      to 1 at every pixel: features near the edges of a tile, which see its zero padding, are faded out in favour of
+      the neighbouring tile, which blends the seams
+    """
+    if overlap >= tile_size:
+        raise ValueError(f"tile overlap ({overlap}) must be smaller than the tile size ({tile_size})")
+    windows, weights = [], []
+    for top in tile_starts(height, tile_size, overlap):
+        for left in tile_starts(width, tile_size, overlap):
+            rows = slice(top, min(top + tile_size, height))
+            columns = slice(left, min(left + tile_size, width))
+            windows.append((slice(None), slice(None), rows, columns))
+            tile_h, tile_w = rows.stop - rows.start, columns.stop - columns.start
+            weights.append(torch.ger(_ramp(tile_h, overlap), _ramp(tile_w, overlap))[None, None])
+
+    total = torch.zeros(1, 1, height, width)
+    for window, weight in zip(windows, weights):
+        total[window] += weight
+    return [(window, weight / total[window]) for window, weight in zip(windows, weights)]
+
+
+def tiled_grams(
+        model: nn.Module,
+        image: torch.Tensor,
+        gram_class: nn.Module = GramMatrix,
+        tile_size: int = 512,
+        overlap: int = DEFAULT_OVERLAP
+) -> List[torch.Tensor]:
+    """
+    Gram matrices of a (e.g. style) image too large for a single forward pass (see TiledStyleObjective)
+    """
+    return TiledStyleObjective(model, [], gram_class=gram_class, tile_size=tile_size, overlap=overlap).grams(image)
+
+
+class TiledStyleObjective:
+    """
+    Style loss of an image too large for a single forward pass, against global target gram matrices
+
+    Notes
+    -----
+    - The gram matrix of the whole image is accumulated over tiles without autograd, as the mask-weighted sum
+      F diag(mask) F^T of every tile's features divided by the total weight. The loss is the same weighted MSE as
+      loss.FusedStyleLoss.
+    - Gradients are then backpropagated one tile at a time, from the gradient of the loss with respect to each tile's
+      features, 4 * scale / n * (G - target) F diag(mask), and summed into the image's gradient
+    - Only one tile's activations are alive at any time, so peak memory depends on tile_size rather than the image
+    - Gram classes computing statistics (e.g. NormalizedGramMatrix) compute them per tile. Channel projections
+      (RandomProjectionGramMatrix) are fine, spatial subsampling is not.
+    - Usable as the objective of optimization.optimize, with a model hooked on the style layers
+    """
+    def __init__(
+            self,
+            model: nn.Module,
+            style_targets: List[torch.Tensor],
+            style_weights: Optional[List[float]] = None,
+            gram_class: nn.Module = GramMatrix,
+            tile_size: int = 512,
+            overlap: int = DEFAULT_OVERLAP
+    ):
+        if not style_weights:
+            style_weights = [1 / len(style_targets) for _ in style_targets]
+        self.model = model
+        self.style_targets = style_targets
+        self.gram = gram_class()
+        if getattr(self.gram, "sample_rate", 1.) < 1:
+            raise ValueError("Spatially subsampled gram matrices cannot be accumulated over tiles")
+        self.tile_size = tile_size
+        self.overlap = overlap
+        # MSE is a mean over the c x c entries of every gram matrix in the batch
+        self.scales = [weight / target[0].numel() for weight, target in zip(style_weights, style_targets)]
+        self._tiles = {}
+
+    def tiles(self, image: torch.Tensor) -> List[Tuple[tuple, torch.Tensor]]:
+        height, width = image.shape[-2:]
+        if (height, width) not in self._tiles:
+            self._tiles[height, width] = [
+                (window, mask.to(image.device))
+                for window, mask in tiles(height, width, self.tile_size, self.overlap)
+            ]
+        return self._tiles[height, width]
+
+    def _features(self, image: torch.Tensor, mask: torch.Tensor) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        (features, mask resized to the features) of every hooked layer
+        """
+        features = []
+        for activation in get_activations(self.model, image):
+            layer_mask = functional.adaptive_avg_pool2d(mask, activation.shape[-2:])
+            features.append((self.gram.features(activation), layer_mask.view(1, 1, -1)))
+        return features
+
+    def grams(self, image: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Gram matrices of the whole image, accumulated tile by tile
+        """
+        grams, weights = self._accumulate(image)
+        return [gram / weight for gram, weight in zip(grams, weights)]
+
+    def _accumulate(self, image: torch.Tensor) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """
+        Unnormalized gram matrices of the whole image, and their total weight (the number of positions)
+        """
+        grams, weights = None, None
+        with torch.no_grad():
+            for window, mask in self.tiles(image):
+                features = self._features(image[window], mask)
+                if grams is None:
+                    grams, weights = [0] * len(features), [0] * len(features)
+                for i, (F, layer_mask) in enumerate(features):
+                    grams[i] = grams[i] + torch.bmm(F * layer_mask, F.transpose(1, 2))
+                    weights[i] = weights[i] + layer_mask.sum()
+        return grams, weights
+
+    def __call__(self, image: torch.Tensor) -> torch.Tensor:
+        batch = image.shape[0]
+        grams, weights = self._accumulate(image)
+        differences, coefficients, loss = [], [], 0.
+        for gram, weight, target, scale in zip(grams, weights, self.style_targets, self.scales):
+            D = gram / weight - target
+            differences.append(D)
+            coefficients.append(4 * scale / batch / weight)
+            loss = loss + torch.dot(D.view(-1), D.view(-1)) * scale / batch
+
+        if image.grad is None:
+            image.grad = torch.zeros_like(image)
+        telemetry = get_telemetry()
+        for window, mask in self.tiles(image):
+            tile = image[window].detach().requires_grad_()
+            features = self._features(tile, mask)
+            with telemetry.timer("backward"):
+                gradients = [
+                    torch.bmm(D, F.detach()).mul_(layer_mask * coefficient)
+                    for (F, layer_mask), D, coefficient in zip(features, differences, coefficients)
+                ]
+                torch.autograd.backward([F for F, _ in features], gradients)
+            image.grad[window] += tile.grad
+        return loss
@@ -0,0 +1,195 @@
+from .config import WEIGHT_STORE
+
+import os
+import json
+import uuid
+import shutil
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import click
+import numpy as np
+import torch
+from torch import nn
+
+# bump whenever the layout of a converted model changes
+STORE_VERSION = 1
+
+# tensors start on multiples of this many bytes in the weight file
+_ALIGNMENT = 64
+
+# arguments torchvision passes to these architectures when building them with pretrained weights
+PRETRAINED_KWARGS = {
+    "googlenet": {"transform_input": True, "aux_logits": False, "init_weights": False},
+    "inception_v3": {"transform_input": True, "aux_logits": False, "init_weights": False},
+}
+
+_INIT_FUNCTIONS = (
+    "uniform_", "normal_", "trunc_normal_", "constant_", "ones_", "zeros_", "xavier_uniform_", "xavier_normal_",
+    "kaiming_uniform_", "kaiming_normal_", "orthogonal_",
+)
+
+
+@contextmanager
+def uninitialized():
+    """
+    Build modules without running their (costly, for large models) random initialization, for weights which are about
+    to be replaced anyway. Not thread-safe: it swaps the functions of torch.nn.init while active.
+    """
+    original = {name: getattr(nn.init, name) for name in _INIT_FUNCTIONS if hasattr(nn.init, name)}
+    for name in original:
+        setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, function in original.items():
+            setattr(nn.init, name, function)
+
+
+class WeightStore:
+    """
+    Pretrained weights converted once into raw files which are memory-mapped when loaded
+
+    Notes
+    -----
+    - Every model `name` is a directory holding `weights.bin`, the tensors of its state dict one after the other, and
+      `index.json`, their dtype, shape and offset in it. index.json is written last, so a model only exists once it
+      is fully converted.
+    - Loading maps the file copy-on-write and wraps it in tensors without reading or copying anything: pages are read
+      from disk when first used, and shared through the page cache by every process loading the same model
+    - A disabled store (no directory, e.g. NST_WEIGHT_STORE not set) has no models
+    """
+    def __init__(self, directory: Optional[str] = WEIGHT_STORE):
+        self.directory = directory
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def has(self, name: str) -> bool:
+        return bool(self.directory) and os.path.exists(os.path.join(self.path(name), "index.json"))
+
+    def names(self) -> List[str]:
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        return sorted(i for i in os.listdir(self.directory) if self.has(i))
+
+    def save(self, name: str, state_dict: Dict[str, torch.Tensor]):
+        path = self.path(name)
+        os.makedirs(path, exist_ok=True)
+        tmp = os.path.join(path, f".tmp-{uuid.uuid4().hex}")
+        index, offset = {}, 0
+        with open(tmp, "wb") as fd:
+            for key, tensor in state_dict.items():
+                array = tensor.detach().cpu().contiguous().numpy()
+                padding = -offset % _ALIGNMENT
+                fd.write(b"\0" * padding)
+                offset += padding
+                index[key] = {"dtype": str(array.dtype), "shape": list(array.shape), "offset": offset}
+                fd.write(array.tobytes())
+                offset += array.nbytes
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp, os.path.join(path, "weights.bin"))
+
+        tmp = os.path.join(path, f".tmp-{uuid.uuid4().hex}")
+        with open(tmp, "w") as fd:
+            json.dump({"version": STORE_VERSION, "tensors": index}, fd)
+        os.replace(tmp, os.path.join(path, "index.json"))
+
+    def load(self, name: str) -> Dict[str, torch.Tensor]:
+        """
+        State dict of a converted model, as tensors mapping its weight file
+        """
+        if not self.has(name):
+            raise FileNotFoundError(
+                f"{name} is not in the weight store {self.directory}, convert it with "
+                f"`python -m nst_zoo.weight_store convert {name}`"
+            )
+        with open(os.path.join(self.path(name), "index.json"), "r") as fd:
+            index = json.load(fd)
+        if index.get("version") != STORE_VERSION:
+            raise ValueError(f"{name} was converted by an incompatible version of {__name__}, convert it again")
+        weights = np.memmap(os.path.join(self.path(name), "weights.bin"), dtype=np.uint8, mode="c")
+        state_dict = {}
+        for key, spec in index["tensors"].items():
+            dtype = np.dtype(spec["dtype"])
+            count = int(np.prod(spec["shape"], dtype=np.int64))
+            array = weights[spec["offset"]:spec["offset"] + count * dtype.itemsize].view(dtype)
+            state_dict[key] = torch.from_numpy(array.reshape(spec["shape"]))
+        return state_dict
+
+    def load_into(self, model: nn.Module, name: str) -> nn.Module:
+        """
+        Make the parameters and buffers of model the memory-mapped tensors of `name`, without copying them
+        """
+        state_dict = self.load(name)
+        expected = set(model.state_dict())
+        if expected != set(state_dict):
+            missing, unexpected = sorted(expected - set(state_dict)), sorted(set(state_dict) - expected)
+            raise ValueError(
+                f"{name} in the weight store does not match the model: missing {missing}, unexpected {unexpected}"
+            )
+        for module_name, module in model.named_modules():
+            prefix = f"{module_name}." if module_name else ""
+            for key, parameter in list(module._parameters.items()):
+                if parameter is not None:
+                    module._parameters[key] = nn.Parameter(state_dict[prefix + key], requires_grad=False)
+            for key, buffer in list(module._buffers.items()):
+                if buffer is not None and prefix + key in state_dict:
+                    module._buffers[key] = state_dict[prefix + key]
+        return model
+
+    def remove(self, name: str):
+        shutil.rmtree(self.path(name), ignore_errors=True)
+
+
+# process-wide store used by models.torchvision_model
+weight_store = WeightStore()
+
+
+@click.group(name="nst-weight-store")
+def cli():
+    return
+
+
+@cli.command()
+@click.argument("names", nargs=-1, required=True)
+@click.option("--directory", "-d", envvar="NST_WEIGHT_STORE", required=True, help="Weight store (NST_WEIGHT_STORE)")
+@click.option(
+    "--checkpoint",
+    "-c",
+    default=None,
+    help="Local torchvision checkpoint (.pth) to convert instead of downloading the weights, with a single name"
+)
+def convert(names, directory, checkpoint):
+    """
+    Convert the pretrained weights of torchvision models (e.g. vgg19 resnet152) into the weight store
+    """
+    from torchvision import models
+    if checkpoint and len(names) != 1:
+        raise click.BadParameter("--checkpoint converts a single model")
+    store = WeightStore(directory)
+    for name in names:
+        if checkpoint:
+            with uninitialized():
+                model = getattr(models, name)(pretrained=False, **PRETRAINED_KWARGS.get(name, {}))
+            # auxiliary classifiers of googlenet and inception_v3 are dropped, like torchvision does
+            missing, _ = model.load_state_dict(torch.load(checkpoint, map_location="cpu"), strict=False)
+            if missing:
+                raise click.ClickException(f"{checkpoint} does not have the weights of {name}: {missing}")
+            state_dict = model.state_dict()
+        else:
+            state_dict = getattr(models, name)(pretrained=True).state_dict()
+        store.save(name, state_dict)
+        click.echo(f"{name}: {sum(i.numel() * i.element_size() for i in state_dict.values()) / 2 ** 20:.0f}MB")
+
+
+@cli.command(name="list")
+@click.option("--directory", "-d", envvar="NST_WEIGHT_STORE", required=True, help="Weight store (NST_WEIGHT_STORE)")
+def list_models(directory):
+    for name in WeightStore(directory).names():
+        click.echo(name)
+
+
+if __name__ == '__main__':
+    cli()
@@ -5,5 +5,6 @@ setup(
     entry_points="""
     [console_scripts]
     nst-processor=nst_zoo.batch_processing.io:cli
+    nst-service=nst_zoo.service:cli
     """
 )
\ No newline at end of file
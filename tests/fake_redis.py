@@ -0,0 +1,111 @@
+import fnmatch
+import time
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the subset of redis.Redis used by the batch processing worker
+    """
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _get(self, key, default):
+        key = self._str(key)
+        if key in self.expires and self.expires[key] <= time.time():
+            self.delete(key)
+        return self.data.setdefault(key, default)
+
+    @staticmethod
+    def _str(key):
+        return key.decode() if isinstance(key, bytes) else key
+
+    @staticmethod
+    def _bytes(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    # lists, left is index 0
+    def lpush(self, key, *values):
+        items = self._get(key, [])
+        for value in values:
+            items.insert(0, self._bytes(value))
+        return len(items)
+
+    def rpoplpush(self, src, dst):
+        items = self._get(src, [])
+        if not items:
+            return None
+        value = items.pop()
+        self._get(dst, []).insert(0, value)
+        return value
+
+    def brpoplpush(self, src, dst, timeout=0):
+        return self.rpoplpush(src, dst)
+
+    def lrange(self, key, start, end):
+        items = self._get(key, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    def lrem(self, key, count, value):
+        items = self._get(key, [])
+        value = self._bytes(value)
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    def llen(self, key):
+        return len(self._get(key, []))
+
+    # strings
+    def set(self, key, value, ex=None):
+        key = self._str(key)
+        self.data[key] = self._bytes(value)
+        if ex is not None:
+            self.expires[key] = time.time() + ex
+
+    def exists(self, key):
+        self._get(key, None)
+        return int(self.data.get(self._str(key)) is not None)
+
+    def delete(self, *keys):
+        for key in map(self._str, keys):
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+
+    # hashes
+    def hset(self, key, field, value):
+        self._get(key, {})[self._bytes(field)] = self._bytes(value)
+
+    def hget(self, key, field):
+        return self._get(key, {}).get(self._bytes(field))
+
+    def hgetall(self, key):
+        return dict(self._get(key, {}))
+
+    def hincrby(self, key, field, amount=1):
+        hash_, field = self._get(key, {}), self._bytes(field)
+        hash_[field] = self._bytes(int(hash_.get(field, 0)) + amount)
+        return int(hash_[field])
+
+    def scan_iter(self, match=None):
+        return [key.encode() for key in list(self.data) if self.data[key] and fnmatch.fnmatch(key, match or "*")]
+
+    def pipeline(self):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((getattr(self.redis, name), args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
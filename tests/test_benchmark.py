@@ -0,0 +1,42 @@
+from nst_zoo.benchmark import BenchmarkCase, compare, against_reference, against_exact_gram
+from dataclasses import asdict
+
+
+def _result(evals_per_second, peak_rss_mb, **kwargs):
+    case = BenchmarkCase("vgg19", {"Conv2d": [0]}, "GramMatrix", 128, "LBFGS", **kwargs)
+    return {**asdict(case), "evals_per_second": evals_per_second, "peak_rss_mb": peak_rss_mb}
+
+
+def test_compare_reports_regressions():
+    baseline = {"results": [_result(10., 500.)]}
+
+    assert compare(baseline, {"results": [_result(9.5, 520.)]}) == []
+    regressions = compare(baseline, {"results": [_result(5., 800.)]})
+    assert len(regressions) == 2
+
+
+def test_compare_accepts_results_without_new_fields():
+    baseline = _result(10., 500.)
+    del baseline["precision"], baseline["channels_last"]
+    assert len(compare({"results": [baseline]}, {"results": [_result(5., 500.)]})) == 1
+
+
+def test_reduced_precision_is_reported_against_fp32():
+    reference = {**_result(10., 500.), "first_loss": 100., "best_loss": 10.}
+    fast = {**_result(25., 400., precision="bf16", channels_last=True), "first_loss": 101., "best_loss": 10.5}
+    against_reference([fast, reference])
+
+    assert "speedup" not in reference
+    assert fast["speedup"] == 2.5
+    assert abs(fast["first_loss_deviation"] - .01) < 1e-9
+    assert abs(fast["best_loss_deviation"] - .05) < 1e-9
+
+
+def test_approximate_grams_are_reported_against_the_exact_one():
+    exact = _result(10., 500.)
+    approximate = {**_result(30., 500.), "gram_class": "RandomProjectionGramMatrix", "gram_kwargs": {"rank": 64}}
+    approximate.update(gram_loss_error=.02, gram_gradient_cosine=.9)
+    against_exact_gram([exact, approximate])
+
+    assert "gram_speedup" not in exact
+    assert approximate["gram_speedup"] == 3.
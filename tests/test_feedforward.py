@@ -0,0 +1,75 @@
+from nst_zoo.feedforward import TransformerNet, fit, save_network, load_network, stylize, target_grams, _crop_batches
+from nst_zoo.loss import NSTLoss, GramMatrix, content_loss
+from nst_zoo.models import _nst_pipeline, get_activations
+from torch import nn
+import torch
+
+
+def _tiny_model():
+    layers = {"ReLU": [0, 1]}
+    return _nst_pipeline(nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU(), nn.Conv2d(4, 8, 3), nn.ReLU()), layers, "avg")
+
+
+def test_output_keeps_input_size():
+    net = TransformerNet(channels=4, residual_blocks=1)
+    for size in [(32, 32), (30, 45)]:
+        assert net(torch.rand(2, 3, *size)).shape == (2, 3, *size)
+
+
+def test_content_loss_broadcasts_target():
+    generated = [torch.ones(2, 4, 5, 5)]
+    assert float(content_loss(generated, [torch.zeros(1, 4, 5, 5)])[0]) == 1.
+
+
+def test_fit_lowers_loss():
+    torch.manual_seed(0)
+    model = _tiny_model()
+    targets = [GramMatrix()(i) for i in get_activations(model, torch.rand(1, 3, 32, 32))]
+    nst_loss = NSTLoss(style_targets=targets, style_gram_class=GramMatrix)
+    net = TransformerNet(channels=4, residual_blocks=1)
+    batches = iter(lambda: torch.rand(2, 3, 32, 32), None)
+
+    losses = fit(net, model, nst_loss, [0, 1], [1], batches, iterations=30, lr=1e-2)
+
+    assert len(losses) == 30
+    assert sum(losses[-5:]) < sum(losses[:5])
+    assert not net.training
+
+
+def test_target_grams_take_one_forward_pass():
+    model = _tiny_model()
+    style_img = torch.rand(1, 3, 32, 32)
+    expected = [GramMatrix()(i) for i in get_activations(model, style_img)]
+    calls = []
+    model[0].register_forward_hook(lambda module, input, output: calls.append(output.requires_grad))
+
+    grams = target_grams(model, style_img, [1, 0], GramMatrix)
+
+    assert calls == [False]
+    assert torch.allclose(grams[0], expected[1]) and torch.allclose(grams[1], expected[0])
+
+
+def test_save_load_roundtrip(tmpdir):
+    net = TransformerNet(channels=4, residual_blocks=2)
+    fp = str(tmpdir.join("nets", "style.pt"))
+    save_network(net, fp)
+    loaded = load_network(fp)
+    image = torch.rand(3, 24, 32)
+    assert torch.equal(stylize(loaded, image), stylize(net.eval(), image))
+
+
+def test_crop_batches_decode_each_image_once_per_epoch():
+    decoded = []
+
+    class Processor:
+        def preprocess(self, path):
+            decoded.append(path)
+            return torch.rand(1, 3, 12, 16)
+
+    paths = ["a.jpg", "b.jpg", "c.jpg"]
+    batches = _crop_batches(Processor(), paths, 8, 2)
+    first_epoch = [next(batches) for _ in range(2)]
+    assert sorted(decoded) == paths
+    assert all(batch.shape == (2, 3, 8, 8) for batch in first_epoch)
+    next(batches)
+    assert len(decoded) == 5
@@ -0,0 +1,49 @@
+from nst_zoo.gram_cache import StyleGramCache
+from nst_zoo.image_processing import BaseProcessor
+from torchvision import transforms
+import torch
+
+STYLE_IMG = "nst_zoo/data/style/vangogh_starry_night.jpg"
+
+
+def _key(cache, layers):
+    return cache.key(STYLE_IMG, "vgg19", "avg", layers, "NormalizedGramMatrix")
+
+
+def test_roundtrip(tmp_path):
+    cache = StyleGramCache(directory=str(tmp_path))
+    grams = [torch.rand(1, 4, 4), torch.rand(1, 8, 8)]
+    key = _key(cache, {"ReLU": [0, 2]})
+
+    assert cache.get_or_compute(key, lambda: grams) is grams
+    cached = cache.get_or_compute(key, lambda: None)
+    assert all(torch.equal(i, j) for i, j in zip(grams, cached))
+    assert key != _key(cache, {"ReLU": [0]})
+
+
+def test_preprocessing_change_invalidates(tmp_path, monkeypatch):
+    cache = StyleGramCache(directory=str(tmp_path))
+    key = _key(cache, {"ReLU": [0]})
+
+    assert cache.key(STYLE_IMG, "vgg19", "avg", {"ReLU": [0]}, "NormalizedGramMatrix", BaseProcessor(512)) != key
+    monkeypatch.setattr(BaseProcessor, "preprocessing_steps", [transforms.Normalize(mean=[0] * 3, std=[1] * 3)])
+    assert _key(cache, {"ReLU": [0]}) != key
+
+
+def test_size_bounded_eviction(tmp_path):
+    cache = StyleGramCache(directory=str(tmp_path), max_mb=1)
+    one_third_mb = [torch.rand(1, 256, 341)]
+    for i in range(4):
+        cache.put(str(i), one_third_mb)
+    assert cache.get("0") is None
+    assert cache.get("3") is not None
+
+
+def test_tiled_targets_have_their_own_key():
+    cache = StyleGramCache(directory=None)
+    key = _key(cache, {"ReLU": [0]})
+    tiled = cache.key(STYLE_IMG, "vgg19", "avg", {"ReLU": [0]}, "NormalizedGramMatrix", tiling=(256, 32))
+
+    assert tiled != key
+    assert tiled != cache.key(STYLE_IMG, "vgg19", "avg", {"ReLU": [0]}, "NormalizedGramMatrix", tiling=(256, 64))
+    assert cache.key(STYLE_IMG, "vgg19", "avg", {"ReLU": [0]}, "NormalizedGramMatrix", tiling=None) == key
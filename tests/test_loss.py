@@ -0,0 +1,100 @@
+from nst_zoo.loss import NSTLoss, BatchedNSTLoss, FusedStyleLoss, NormalizedGramMatrix, style_loss
+from nst_zoo.loss import GramMatrix, RandomProjectionGramMatrix, SubsampledGramMatrix, get_gram_class
+import torch
+
+
+def test_batched_loss_matches_individual_losses():
+    """
+    Stacking images along the batch dimension should not change any individual loss, even for gram classes
+    that compute statistics across the batch
+    """
+    torch.manual_seed(0)
+    targets = [torch.rand(1, 4, 8, 8), torch.rand(1, 6, 4, 4)]
+    generated = [torch.rand(2, 4, 8, 8), torch.rand(2, 6, 4, 4)]
+    gram = NormalizedGramMatrix
+
+    first = NSTLoss([gram()(targets[0])], [1.], style_loss, gram)
+    second = NSTLoss([gram()(i) for i in targets], [.5, .5], style_loss, gram)
+    batched = BatchedNSTLoss([first, second], [[0], [0, 1]])
+
+    expected = (
+        first(generated_style_activations=[generated[0][0:1]])
+        + second(generated_style_activations=[i[1:2] for i in generated])
+    )
+    assert torch.allclose(batched(generated_style_activations=generated), expected)
+
+
+def test_fused_style_loss_matches_style_loss():
+    torch.manual_seed(0)
+    gram = NormalizedGramMatrix
+    targets = [gram()(torch.rand(1, 4, 8, 8)), gram()(torch.rand(1, 6, 4, 4))]
+    generated = [torch.rand(1, 4, 8, 8, requires_grad=True), torch.rand(1, 6, 4, 4, requires_grad=True)]
+    weights = [.3, .7]
+
+    expected = sum(weight * i for weight, i in zip(weights, style_loss(generated, targets, gram)))
+    expected_grads = torch.autograd.grad(expected, generated)
+
+    total, breakdown = FusedStyleLoss(targets, weights, gram)(generated, breakdown=True)
+    grads = torch.autograd.grad(total, generated)
+
+    assert torch.allclose(total, expected)
+    assert torch.allclose(sum(breakdown), expected)
+    assert all(torch.allclose(i, j, atol=1e-6) for i, j in zip(grads, expected_grads))
+
+
+def _exact_and_approximate(gram_class, channels=256, runs=20):
+    """
+    Exact loss and gradient, and the average of `runs` approximations
+    """
+    torch.manual_seed(0)
+    target = torch.rand(1, channels, 16, 16) * 2
+    generated = torch.rand(1, channels, 16, 16, requires_grad=True)
+    exact = FusedStyleLoss([GramMatrix()(target)], gram_class=GramMatrix)([generated])
+    losses, gradient = 0, 0
+    for seed in range(runs):
+        approximate = FusedStyleLoss([gram_class(seed)(target)], gram_class=lambda: gram_class(seed))([generated])
+        losses += float(approximate) / runs
+        gradient = gradient + torch.autograd.grad(approximate, generated)[0]
+    exact_gradient = torch.autograd.grad(exact, generated)[0]
+    cosine = torch.nn.functional.cosine_similarity(exact_gradient.view(-1), gradient.view(-1), dim=0)
+    return abs(losses - float(exact)) / float(exact), float(cosine)
+
+
+def test_random_projection_estimates_the_exact_loss():
+    loss_error, cosine = _exact_and_approximate(lambda seed: RandomProjectionGramMatrix(rank=64, seed=seed))
+    assert loss_error < .1 and cosine > .8
+
+    gram = RandomProjectionGramMatrix(rank=64)
+    assert gram(torch.rand(2, 512, 4, 4)).shape == (2, 64, 64)
+    # narrow layers are left exact
+    activation = torch.rand(1, 32, 4, 4)
+    assert torch.equal(gram(activation), GramMatrix()(activation))
+
+
+def test_subsampling_estimates_the_exact_loss():
+    loss_error, cosine = _exact_and_approximate(lambda seed: SubsampledGramMatrix(.25, seed=seed))
+    assert loss_error < .1 and cosine > .8
+
+    # targets (which do not require gradients) are exact
+    activation = torch.rand(1, 4, 8, 8)
+    assert torch.equal(SubsampledGramMatrix(.25)(activation), GramMatrix()(activation))
+    assert SubsampledGramMatrix(.25).features(activation.requires_grad_()).shape == (1, 4, 16)
+
+
+def test_gram_class_kwargs():
+    gram = get_gram_class("RandomProjectionGramMatrix", {"rank": 8})()
+    assert gram.rank == 8
+    assert get_gram_class("GramMatrix", None) is GramMatrix
+
+
+def test_content_loss_with_style_loss():
+    torch.manual_seed(0)
+    gram = GramMatrix
+    style_target, content_target = torch.rand(1, 4, 8, 8), torch.rand(1, 6, 4, 4)
+    generated = [torch.rand(1, 4, 8, 8), torch.rand(1, 6, 4, 4)]
+    nst_loss = NSTLoss([gram()(style_target)], [1.], style_loss, gram, content_targets=[content_target], alpha=.25)
+
+    style = style_loss(generated[:1], [gram()(style_target)], gram)[0]
+    content = torch.nn.functional.mse_loss(generated[1], content_target)
+    loss = nst_loss(generated_style_activations=generated[:1], generated_content_activations=generated[1:])
+    assert torch.allclose(loss, .25 * content + .75 * style)
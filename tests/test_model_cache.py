@@ -0,0 +1,37 @@
+from nst_zoo import models
+from nst_zoo.model_cache import ModelCache
+from nst_zoo.models import get_activations, _prepare_backbone
+from tests.util import get_tiny_model
+import torch
+
+
+def _tiny_backbone(name, pooling="avg"):
+    return _prepare_backbone(get_tiny_model(), pooling)
+
+
+def test_backbones_are_reused_and_evicted(monkeypatch):
+    monkeypatch.setattr(models, "backbone", _tiny_backbone)
+    cache = ModelCache(max_models=2)
+
+    first = cache.get("vgg19", "avg")
+    assert cache.get("vgg19", "avg") is first
+
+    cache.get("vgg19", "max")
+    cache.get("vgg11", "avg")  # evicts the least recently used ("vgg19", "avg")
+    assert cache.get("vgg19", "avg") is not first
+    assert cache.keys() == [("vgg11", "avg"), ("vgg19", "avg")]
+
+
+def test_hooks_do_not_leak_between_trials(monkeypatch):
+    monkeypatch.setattr(models, "backbone", _tiny_backbone)
+    cache = ModelCache()
+    image = torch.rand(1, 3, 16, 16)
+
+    with cache.hooked("vgg19", "avg", {"ReLU": [0, 1, 2]}) as model:
+        assert len(get_activations(model, image)) == 3
+
+    with cache.hooked("vgg19", "avg", {"ReLU": [2]}) as model:
+        activations = get_activations(model, image)
+    assert [i.shape[1] for i in activations] == [8]
+    assert model._nst_collector is None
+    assert all(not i._forward_hooks for i in model.modules())
@@ -0,0 +1,106 @@
+from nst_zoo.models import _nst_pipeline, _add_hooks_to_model, get_activations, set_execution_mode, remove_hooks
+from torchvision import models
+import pytest
+import torch
+
+
+def test_truncated_forward_matches_full_forward():
+    """
+    resnet is not sequential and reuses the same ReLU module several times within a block
+    """
+    torch.manual_seed(0)
+    image = torch.rand(1, 3, 64, 64)
+    layers = {"ReLU": [0, 3]}
+    model = _nst_pipeline(models.resnet18(), layers, pooling="avg")
+
+    head_calls = []
+    model.fc.register_forward_hook(lambda module, input, output: head_calls.append(output))
+    truncated = get_activations(model, image)
+    assert not head_calls
+
+    model._nst_collector._handles.pop().remove()  # the truncation hook is attached last
+    full = get_activations(model, image)
+    assert head_calls
+    assert all(torch.equal(i, j) for i, j in zip(truncated, full))
+
+
+def test_activations_are_returned_in_config_order():
+    model = _nst_pipeline(models.vgg11(), {"ReLU": [3, 0], "Conv2d": [1]}, pooling="avg")
+    activations = get_activations(model, torch.rand(1, 3, 32, 32))
+
+    assert [i.shape[1] for i in activations] == [256, 64, 128]
+    assert model._nst_collector.slots == [None, None, None]
+
+
+def test_bf16_channels_last_activations_stay_close_to_fp32():
+    torch.manual_seed(0)
+    image = torch.rand(1, 3, 32, 32)
+    model = _nst_pipeline(models.vgg11(), {"ReLU": [0, 3]}, pooling="avg")
+    reference = get_activations(model, image)
+
+    set_execution_mode(model, "bf16", channels_last=True)
+    activations = get_activations(model, image)
+    for i, j in zip(activations, reference):
+        assert i.dtype == torch.float32 and i.is_contiguous()
+        assert torch.allclose(i, j, rtol=.05, atol=.05)
+
+    set_execution_mode(model)
+    assert model.features[0].weight.is_contiguous()
+    assert all(torch.equal(i, j) for i, j in zip(get_activations(model, image), reference))
+
+
+@pytest.mark.parametrize("layers", [{"ReLU": [1, 5]}, {"Conv2d": [0, 3]}])
+def test_checkpointed_segments_give_the_same_gradients_and_are_reversible(layers):
+    """
+    Conv2d layers of vgg are followed by in-place ReLUs, which modify the hooked activations with and without
+    checkpointing alike
+    """
+    torch.manual_seed(0)
+    image = torch.rand(1, 3, 32, 32, requires_grad=True)
+    model = _nst_pipeline(models.vgg11(), layers, pooling="avg")
+
+    def gradient():
+        image.grad = None
+        activations = get_activations(model, image)
+        sum(i.pow(2).sum() for i in activations).backward()
+        return [i.detach().clone() for i in activations], image.grad
+
+    expected_activations, expected = gradient()
+    collector = _add_hooks_to_model(model, layers, checkpoint_segments=2)
+    assert collector.checkpointed == [model.features]
+    activations, checkpointed = gradient()
+    assert all(torch.allclose(i, j) for i, j in zip(activations, expected_activations))
+    assert torch.allclose(checkpointed, expected)
+
+    remove_hooks(model)
+    assert "forward" not in vars(model.features)
+
+
+def test_hook_free_blocks_of_other_containers_are_checkpointed():
+    torch.manual_seed(0)
+    layers = {"ReLU": [0, 5]}  # the stem's ReLU and one in layer3
+    image = torch.rand(1, 3, 32, 32, requires_grad=True)
+    model = _nst_pipeline(models.resnet18(), layers, pooling="avg")
+
+    def gradient():
+        image.grad = None
+        sum(i.pow(2).sum() for i in get_activations(model, image)).backward()
+        return image.grad
+
+    expected = gradient()
+    collector = _add_hooks_to_model(model, layers, checkpoint_segments=2)
+    assert model.layer1 in collector.checkpointed and model.layer2 in collector.checkpointed
+    assert torch.allclose(gradient(), expected, rtol=1e-4)
+
+    remove_hooks(model)
+    assert all("forward" not in vars(i) for i in model.modules())
+
+
+def test_factories_are_resolved_from_the_registry():
+    from nst_zoo import models as nst_models
+    assert set(nst_models.ARCHITECTURES) <= set(dir(nst_models))
+    model = nst_models.vgg11({"ReLU": [0]}, pooling="avg", pretrained=False)
+    assert len(get_activations(model, torch.rand(1, 3, 32, 32))) == 1
+    assert nst_models.vgg11 is nst_models.vgg11
+    with pytest.raises(AttributeError):
+        nst_models.not_a_model
@@ -0,0 +1,103 @@
+from nst_zoo.config import NSTConfig
+from nst_zoo.models import get_activations, _nst_pipeline
+from nst_zoo.nst_main import _pyramid, _target_activations, _validate_content, initial_image, main_batched
+from torch import nn
+import pytest
+import torch
+
+
+def test_pyramid_levels():
+    nst_config = NSTConfig(style_layers={"ReLU": [0]}, save_as="hash", image_size=1024, pyramid_levels=3)
+    assert _pyramid(nst_config) == [(256, 200), (512, 100), (1024, 50)]
+
+    nst_config = NSTConfig(style_layers={"ReLU": [0]}, save_as="hash", max_evals=50)
+    assert _pyramid(nst_config) == [(None, 50)]
+
+
+def test_content_configuration():
+    nst_config = NSTConfig(
+        style_img="style/a.jpg", content_img="content/b.jpg",
+        style_layers={"ReLU": [4, 0]}, content_layers={"ReLU": [2], "Conv2d": [1]}
+    )
+    assert nst_config.layers == {"ReLU": [4, 0, 2], "Conv2d": [1]}
+    assert nst_config.output_filepath == "nst_zoo/data/generated/b_a.jpg"
+
+    # style-only configurations are hooked on their style layers, in their order
+    assert NSTConfig(style_layers={"ReLU": [4, 0]}, save_as="hash").layers == {"ReLU": [4, 0]}
+
+
+def test_initial_image(tmp_path):
+    content = torch.rand(1, 3, 16, 24)
+    nst_config = NSTConfig(style_layers={"ReLU": [0]}, content_img="b.jpg", initialization="content")
+    image = initial_image(nst_config, content, content)
+    assert torch.equal(image, content) and image.requires_grad
+
+    nst_config = NSTConfig(style_layers={"ReLU": [0]}, content_img="b.jpg", initialization="blurred")
+    blurred = initial_image(nst_config, content, content)
+    assert blurred.shape == content.shape and blurred.std() < content.std()
+
+    # nothing to refine yet
+    nst_config = NSTConfig(
+        style_layers={"ReLU": [0]}, initialization="previous", output_filepath=str(tmp_path / "missing.jpg")
+    )
+    assert initial_image(nst_config, content).shape == content.shape
+
+
+def test_content_validation():
+    with pytest.raises(ValueError):
+        _validate_content(NSTConfig(style_layers={"ReLU": [0]}, content_layers={"ReLU": [2]}, save_as="hash"))
+    with pytest.raises(ValueError):
+        _validate_content(NSTConfig(style_layers={"ReLU": [0]}, initialization="blurred", save_as="hash"))
+    with pytest.raises(ValueError):
+        _validate_content(NSTConfig(style_layers={"ReLU": [0]}, initialization="zeros", save_as="hash"))
+    with pytest.raises(ValueError):
+        main_batched([NSTConfig(style_layers={"ReLU": [0]}, content_img="b.jpg", save_as="hash")])
+
+
+def test_content_targets_take_one_forward_pass():
+    backbone = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU(), nn.Conv2d(4, 8, 3), nn.ReLU())
+    model = _nst_pipeline(backbone, {"ReLU": [0, 1]}, "avg")
+    content_img = torch.rand(1, 3, 16, 16)
+    expected = get_activations(model, content_img)
+    calls = []
+    model[0].register_forward_hook(lambda module, input, output: calls.append(output.requires_grad))
+
+    activations = _target_activations(model, content_img, [1, 0])
+
+    assert calls == [False]
+    assert torch.equal(activations[0], expected[1]) and torch.equal(activations[1], expected[0])
+
+
+def test_batched_losses_are_weighted_like_solo_ones(monkeypatch):
+    from contextlib import contextmanager
+    from nst_zoo import nst_main
+    backbone = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU(), nn.Conv2d(4, 8, 3), nn.ReLU())
+
+    @contextmanager
+    def hooked(model, pool, layers, *args):
+        yield _nst_pipeline(backbone, layers, pool)
+
+    class Captured(Exception):
+        pass
+
+    def batched_loss(losses, positions):
+        raise Captured(losses)
+    monkeypatch.setattr(nst_main.model_cache, "hooked", hooked)
+    monkeypatch.setattr(nst_main, "BatchedNSTLoss", batched_loss)
+    nst_configs = [
+        NSTConfig(style_img="nst_zoo/data/style/vangogh_starry_night.jpg", style_layers={"ReLU": [0]}, alpha=alpha,
+                  style_gram_class="GramMatrix", image_size=16, save_as="hash")
+        for alpha in (None, .25)
+    ]
+    with pytest.raises(Captured) as captured:
+        main_batched(nst_configs)
+    assert [i.alpha for i in captured.value.args[0]] == [None, .25]
+
+
+def test_blur_scales_with_the_shorter_side(monkeypatch):
+    from nst_zoo import nst_main
+    sigmas = []
+    monkeypatch.setattr(nst_main, "blur", lambda image, sigma: sigmas.append(sigma))
+    nst_config = NSTConfig(style_layers={"ReLU": [0]}, content_img="b.jpg", initialization="blurred")
+    initial_image(nst_config, torch.rand(1, 3, 512, 1024), torch.rand(1, 3, 512, 1024))
+    assert sigmas == [nst_main.BLUR_SIGMA * 2]
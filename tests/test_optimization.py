@@ -0,0 +1,33 @@
+from nst_zoo.optimization import optimize, StoppingCriteria
+from nst_zoo.loss import NSTLoss, GramMatrix
+from nst_zoo.models import _prepare_backbone, _add_hooks_to_model, get_activations
+from tests.util import get_tiny_model
+from torch.optim import LBFGS, Adam
+import torch
+
+
+def _problem():
+    torch.manual_seed(0)
+    model = _prepare_backbone(get_tiny_model(), pooling="avg")
+    _add_hooks_to_model(model, {"ReLU": [0, 1]})
+    targets = [GramMatrix()(i) for i in get_activations(model, torch.rand(1, 3, 16, 16))]
+    noise_img = torch.randn(1, 3, 16, 16, requires_grad=True)
+    return noise_img, model, NSTLoss(style_targets=targets, style_gram_class=GramMatrix)
+
+
+def test_lbfgs_stops_exactly_at_max_evals():
+    noise_img, model, nst_loss = _problem()
+    stopping = StoppingCriteria(max_evals=7)
+    optimize(LBFGS([noise_img], line_search_fn="strong_wolfe"), noise_img, model, nst_loss, stopping=stopping)
+
+    assert stopping.n_evals == 7
+    assert stopping.stop_reason == "max_evals"
+
+
+def test_plateau_stops_before_max_evals():
+    noise_img, model, nst_loss = _problem()
+    stopping = StoppingCriteria(max_evals=10000, tolerance_change=1e-2, patience=3)
+    optimize(Adam([noise_img], lr=1e-5), noise_img, model, nst_loss, stopping=stopping)
+
+    assert stopping.stop_reason == "converged"
+    assert stopping.n_evals < 10000
@@ -0,0 +1,30 @@
+from nst_zoo.batch_processing.result_index import ResultIndex
+from nst_zoo.config import NSTConfig
+from nst_zoo.optimization import StoppingCriteria
+
+
+def _config(tmp_path, **kwargs):
+    return NSTConfig(style_img="a.jpg", output_filepath=str(tmp_path / "out.jpg"), **kwargs)
+
+
+def test_completed_trials_are_found_while_their_output_exists(tmp_path):
+    index = ResultIndex(str(tmp_path / "results.sqlite"))
+    nst_config = _config(tmp_path)
+    assert index.completed(nst_config) is None
+
+    index.record(nst_config, StoppingCriteria(n_evals=10, best_loss=1.5, seconds=2.))
+    # recorded, but no output
+    assert index.completed(nst_config) is None
+
+    (tmp_path / "out.jpg").write_bytes(b"")
+    record = index.completed(nst_config)
+    assert (record["final_loss"], record["n_evals"], record["seconds"]) == (1.5, 10, 2.)
+    assert index.completed(_config(tmp_path, max_evals=20)) is None
+
+
+def test_disabled_without_path(tmp_path):
+    index = ResultIndex(None)
+    nst_config = _config(tmp_path)
+    (tmp_path / "out.jpg").write_bytes(b"")
+    index.record(nst_config, StoppingCriteria())
+    assert index.completed(nst_config) is None
@@ -0,0 +1,37 @@
+from nst_zoo.batch_processing.io import _parameter_grid
+from nst_zoo.batch_processing.scheduling import affinity_batches, AFFINITY_FIELDS
+from nst_zoo.nst_main import _BATCH_SHARED_FIELDS
+import json
+
+
+def _trial(model, style_img="a.jpg", **kwargs):
+    return {"model": model, "pool": "avg", "style_img": style_img, "style_layers": {"ReLU": [0]}, **kwargs}
+
+
+def test_trials_are_grouped_by_shared_state_heaviest_first():
+    trials = [
+        _trial("vgg19", gram_class="GramMatrix"),
+        _trial("resnet18", gram_class="GramMatrix"),
+        _trial("vgg19", gram_class="NormalizedGramMatrix"),
+        _trial("vgg19", style_img="b.jpg"),
+        _trial("resnet18", gram_class="NormalizedGramMatrix", style_layers={"ReLU": [0, 2]}),
+        _trial("resnet18", max_evals=1000),
+    ]
+    batches = affinity_batches(trials)
+    # trials asking for other stopping criteria cannot share a batch
+    assert batches == [[trials[5]], [trials[0], trials[2]], [trials[1], trials[4]], [trials[3]]]
+
+
+def test_affinity_batches_can_be_optimized_together():
+    assert set(AFFINITY_FIELDS) == set(_BATCH_SHARED_FIELDS)
+    with open("nst_zoo/batch_processing/data/config.json", "r") as fd:
+        trials = list(_parameter_grid(json.load(fd)))
+    # one batch of every style layer selection per model and pool
+    assert sorted(len(i) for i in affinity_batches(trials)) == [5] * 8
+
+
+def test_large_groups_are_split():
+    trials = [_trial("vgg19", seed=i) for i in range(5)]
+    batches = affinity_batches(trials, batch_size=2)
+    assert [len(i) for i in batches] == [2, 2, 1]
+    assert [i for batch in batches for i in batch] == trials
@@ -0,0 +1,96 @@
+from nst_zoo import service
+from nst_zoo.config import NSTConfig
+from nst_zoo.optimization import StoppingCriteria
+from nst_zoo.service import StylizationService, batch_key
+import asyncio
+import json
+import pytest
+
+
+def _config(style_img="style.jpg", **kwargs):
+    return NSTConfig(style_img=style_img, style_layers={"ReLU": [0]}, save_as="hash", **kwargs)
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    runs = []
+
+    def main_batched(nst_configs):
+        runs.append([i.style_img for i in nst_configs])
+        return StoppingCriteria(n_evals=1, best_loss=float(len(nst_configs)), stop_reason="max_evals")
+    monkeypatch.setattr(service, "main", lambda nst_config: main_batched([nst_config]))
+    monkeypatch.setattr(service, "main_batched", main_batched)
+    return runs
+
+
+def test_batch_key():
+    assert batch_key(_config(style_gram_class="GramMatrix")) == batch_key(_config())
+    assert batch_key(_config()) != batch_key(_config("other.jpg"))
+    # each request gets the evaluations and time budget it asked for
+    assert batch_key(_config(max_evals=10)) != batch_key(_config(max_evals=20))
+    assert batch_key(_config(max_seconds=5.)) != batch_key(_config())
+    assert batch_key(_config(tile_size=256)) is None
+
+
+def test_requests_sharing_a_batch_are_coalesced(runs):
+    async def scenario():
+        stylization = StylizationService(queue_size=8, max_batch=3, batch_window_ms=50)
+        stylization.queue = asyncio.Queue()
+        futures = [stylization.submit(_config(i)) for i in ["a", "b", "a", "a", "a"]]
+        worker = asyncio.ensure_future(stylization.run())
+        reports = await asyncio.gather(*futures)
+        worker.cancel()
+        return stylization, reports
+
+    stylization, reports = asyncio.run(scenario())
+    # the first request's batch fills up first, the others keep their order
+    assert runs == [["a", "a", "a"], ["b"], ["a"]]
+    assert all(i.n_evals == 1 for i in reports)
+    # only the requests optimized on their own have a loss of their own
+    assert [i.best_loss for i in reports] == [None, 1., None, None, 1.]
+    metrics = stylization.metrics()
+    assert metrics["requests"] == 5 and metrics["batches"] == 3 and metrics["queue_depth"] == 0
+    assert metrics["latency_seconds"]["max"] >= metrics["latency_seconds"]["p50"]
+
+
+def test_full_queue_rejects_requests(runs):
+    async def scenario():
+        stylization = StylizationService(queue_size=1)
+        stylization.queue = asyncio.Queue()
+        stylization.submit(_config())
+        with pytest.raises(asyncio.QueueFull):
+            stylization.submit(_config())
+
+    asyncio.run(scenario())
+
+
+def test_http(runs):
+    async def request(port, raw):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(raw)
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b"\r\n\r\n")
+        return int(head.split()[1]), json.loads(body)
+
+    async def scenario():
+        stylization = StylizationService(batch_window_ms=0)
+        stylization.queue = asyncio.Queue()
+        server = await asyncio.start_server(stylization.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        worker = asyncio.ensure_future(stylization.run())
+        body = json.dumps({"style_img": "a.jpg", "style_layers": {"ReLU": [0]}}).encode()
+        responses = [
+            await request(port, b"POST /stylize HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body),
+            await request(port, b"POST /stylize HTTP/1.1\r\nContent-Length: 9\r\n\r\n{\"bad\": 1"),
+            await request(port, b"GET /metrics HTTP/1.1\r\n\r\n"),
+        ]
+        worker.cancel()
+        server.close()
+        return responses
+
+    (status, report), (bad_status, _), (_, metrics) = asyncio.run(scenario())
+    assert status == 200 and report["output_filepath"].endswith(".jpg") and report["n_evals"] == 1
+    assert report["best_loss"] == 1.
+    assert bad_status == 400
+    assert metrics["requests"] == 1
@@ -0,0 +1,45 @@
+from nst_zoo.optimization import optimize, StoppingCriteria
+from nst_zoo.snapshots import SnapshotStore
+from tests.test_optimization import _problem
+from torch.optim import Adam
+import torch
+
+
+def test_resumed_optimization_matches_uninterrupted_one(tmp_path):
+    noise_img, model, nst_loss = _problem()
+    initial = noise_img.detach().clone()
+    optimize(Adam([noise_img], lr=0.1), noise_img, model, nst_loss, stopping=StoppingCriteria(max_evals=10))
+    expected = noise_img.detach().clone()
+
+    # interrupted during the 5th evaluation: the last snapshot was taken after the 4th
+    store = SnapshotStore(str(tmp_path), every_seconds=0)
+    noise_img = initial.clone().requires_grad_()
+    optimizer = Adam([noise_img], lr=0.1)
+    optimize(
+        optimizer, noise_img, model, nst_loss, stopping=StoppingCriteria(max_evals=5),
+        snapshot=store.periodic("trial", level=0)
+    )
+
+    snapshot = store.load("trial")
+    assert snapshot["level"] == 0 and snapshot["stopping"]["n_evals"] == 4
+    noise_img = snapshot["image"].clone().requires_grad_()
+    optimizer = Adam([noise_img], lr=0.1)
+    optimizer.load_state_dict(snapshot["optimizer"])
+    stopping = StoppingCriteria(max_evals=10)
+    stopping.resume_from(**snapshot["stopping"])
+    optimize(optimizer, noise_img, model, nst_loss, stopping=stopping)
+
+    assert stopping.n_evals == 10
+    assert torch.allclose(noise_img, expected)
+
+
+def test_snapshots_are_replaced_atomically_and_removed(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    store.save("trial", {"level": 0})
+    store.save("trial", {"level": 1})
+    assert store.load("trial")["level"] == 1
+    assert sorted(i.name for i in tmp_path.iterdir()) == ["trial.pt"]
+
+    store.remove("trial")
+    assert store.load("trial") is None
+    assert SnapshotStore(None).periodic("trial") is None
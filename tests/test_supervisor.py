@@ -0,0 +1,47 @@
+from nst_zoo import models
+from nst_zoo.batch_processing.supervisor import Supervisor, parse_models
+from nst_zoo.model_cache import model_cache
+from nst_zoo.models import _prepare_backbone
+from tests.util import get_tiny_model
+import json
+import os
+import sys
+
+
+def _tiny_backbone(name, pooling="avg"):
+    return _prepare_backbone(get_tiny_model(), pooling)
+
+
+def test_parse_models():
+    assert parse_models(["vgg19", "resnet152/max"]) == [("vgg19", "avg"), ("resnet152", "max")]
+
+
+def test_workers_share_preloaded_backbones(monkeypatch, tmpdir):
+    monkeypatch.setattr(models, "backbone", _tiny_backbone)
+    monkeypatch.setattr(model_cache, "max_models", 0)
+    model_cache.clear()
+
+    def work(index):
+        tensors = list(model_cache.get("vgg19", "avg").state_dict().values())
+        with open(os.path.join(str(tmpdir), f"{index}.json"), "w") as fd:
+            json.dump({"cached": len(model_cache._backbones), "shared": all(i.is_shared() for i in tensors)}, fd)
+
+    try:
+        restarts = Supervisor(work, workers=2, models=[("vgg19", "avg")], poll_interval=.01).run()
+    finally:
+        model_cache.clear()
+    assert restarts == {0: 0, 1: 0}
+    for index in range(2):
+        with open(os.path.join(str(tmpdir), f"{index}.json")) as fd:
+            assert json.load(fd) == {"cached": 1, "shared": True}
+
+
+def test_crashed_workers_are_restarted(tmpdir):
+    def work(index):
+        marker = os.path.join(str(tmpdir), str(index))
+        if index == 1 and not os.path.exists(marker):
+            open(marker, "w").close()
+            sys.exit(1)
+
+    assert Supervisor(work, workers=2, poll_interval=.01).run() == {0: 0, 1: 1}
+    assert Supervisor(lambda index: sys.exit(1), workers=1, max_restarts=2, poll_interval=.01).run() == {0: 2}
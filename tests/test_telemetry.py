@@ -0,0 +1,65 @@
+from nst_zoo.optimization import optimize, StoppingCriteria
+from nst_zoo.telemetry import Telemetry, MemorySink, set_telemetry
+from tests.test_optimization import _problem
+from torch.optim import LBFGS
+import os
+
+
+def test_sampled_iteration_records():
+    noise_img, model, nst_loss = _problem()
+    sink = MemorySink()
+    previous = set_telemetry(Telemetry(sink, sample_every=2))
+    try:
+        optimize(LBFGS([noise_img]), noise_img, model, nst_loss, stopping=StoppingCriteria(max_evals=6))
+    finally:
+        set_telemetry(previous)
+
+    iterations = [i for i in sink.records if i["type"] == "iteration"]
+    assert [i["iteration"] for i in iterations] == [2, 4, 6]
+    assert all({"forward", "gram", "backward", "loss", "style_losses", "peak_rss_mb"} <= set(i) for i in iterations)
+    assert sink.records[-1]["type"] == "optimization"
+
+
+def test_sampled_step_records():
+    noise_img, model, nst_loss = _problem()
+    sink = MemorySink()
+    previous = set_telemetry(Telemetry(sink, sample_every=2))
+    try:
+        optimize(LBFGS([noise_img], max_iter=1), noise_img, model, nst_loss, stopping=StoppingCriteria(max_evals=8))
+    finally:
+        set_telemetry(previous)
+
+    steps = [i["step"] for i in sink.records if i["type"] == "step"]
+    assert steps and all(i % 2 == 0 for i in steps)
+
+
+def test_unsampled_iterations_do_not_read_losses(monkeypatch):
+    from nst_zoo.loss import NSTLoss, GramMatrix, style_loss
+    import torch
+    generated = torch.rand(1, 4, 8, 8)
+    nst_loss = NSTLoss([GramMatrix()(torch.rand(1, 4, 8, 8))], [1.], style_loss, GramMatrix)
+    telemetry = Telemetry(MemorySink(), sample_every=2)
+    monkeypatch.setattr(telemetry, "update", lambda **fields: fields.pop("unexpected"))
+    previous = set_telemetry(telemetry)
+    try:
+        telemetry.begin()  # iteration 1, not sampled
+        nst_loss(generated_style_activations=[generated])
+    finally:
+        set_telemetry(previous)
+
+
+def test_records_are_attributed_to_their_run():
+    sink = MemorySink()
+    telemetry = Telemetry(sink)
+    for run in ["a", "b"]:
+        telemetry.start_run(run)
+        telemetry.event("config")
+        for _ in range(2):
+            telemetry.begin()
+            telemetry.end()
+
+    assert [(i["run"], i["type"], i.get("iteration")) for i in sink.records] == [
+        ("a", "config", None), ("a", "iteration", 1), ("a", "iteration", 2),
+        ("b", "config", None), ("b", "iteration", 1), ("b", "iteration", 2),
+    ]
+    assert all(i["pid"] == os.getpid() for i in sink.records)
@@ -0,0 +1,33 @@
+from nst_zoo.loss import NSTLoss, GramMatrix
+from nst_zoo.models import _nst_pipeline, get_activations
+from nst_zoo.optimization import activation_objective
+from nst_zoo.tiling import TiledStyleObjective, tiles
+from torch import nn
+import torch
+
+
+def test_masks_sum_to_one():
+    total = torch.zeros(1, 1, 70, 90)
+    windows = tiles(70, 90, tile_size=32, overlap=8)
+    for window, mask in windows:
+        total[window] += mask
+    assert len(windows) == 12
+    assert torch.allclose(total, torch.ones_like(total))
+
+
+def test_tiled_objective_matches_whole_image():
+    """
+    With pointwise features, tiles see exactly what the whole image sees
+    """
+    torch.manual_seed(0)
+    layers = {"ReLU": [0, 1]}
+    model = _nst_pipeline(nn.Sequential(nn.Conv2d(3, 4, 1), nn.ReLU(), nn.Conv2d(4, 8, 1), nn.ReLU()), layers, "avg")
+    targets = [GramMatrix()(i) for i in get_activations(model, torch.rand(1, 3, 40, 40))]
+    image = torch.rand(1, 3, 70, 90, requires_grad=True)
+
+    loss = activation_objective(model, NSTLoss(style_targets=targets, style_gram_class=GramMatrix))(image)
+    grad, image.grad = image.grad.clone(), None
+    tiled_loss = TiledStyleObjective(model, targets, gram_class=GramMatrix, tile_size=32, overlap=8)(image)
+
+    assert torch.allclose(tiled_loss, loss, rtol=1e-4)
+    assert torch.allclose(image.grad, grad, rtol=1e-4, atol=1e-12)
@@ -0,0 +1,48 @@
+from nst_zoo import models
+from nst_zoo.weight_store import WeightStore, weight_store, uninitialized
+from torchvision import models as torchvision_models
+from torch import nn
+import pytest
+import torch
+
+
+def _model():
+    return nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4), nn.ReLU(), nn.Conv2d(4, 2, 1))
+
+
+def test_roundtrip(tmpdir):
+    store = WeightStore(str(tmpdir))
+    reference = _model().eval()
+    reference[1].running_mean.uniform_()
+    store.save("tiny", reference.state_dict())
+    assert store.names() == ["tiny"]
+
+    with uninitialized():
+        model = _model()
+    store.load_into(model, "tiny").eval()
+    image = torch.rand(1, 3, 8, 8)
+    assert torch.equal(model(image), reference(image))
+    assert not any(i.requires_grad for i in model.parameters())
+    assert model[1].num_batches_tracked.dtype == torch.int64
+
+    with pytest.raises(ValueError):
+        store.load_into(nn.Sequential(nn.Conv2d(3, 4, 3)), "tiny")
+    with pytest.raises(FileNotFoundError):
+        store.load("vgg19")
+
+
+def test_uninitialized_restores_init():
+    kaiming_normal_ = nn.init.kaiming_normal_
+    with uninitialized():
+        assert nn.init.kaiming_normal_ is not kaiming_normal_
+    assert nn.init.kaiming_normal_ is kaiming_normal_
+
+
+def test_torchvision_model_loads_from_the_store(monkeypatch, tmpdir):
+    reference = torchvision_models.resnet18()
+    WeightStore(str(tmpdir)).save("resnet18", reference.state_dict())
+    monkeypatch.setattr(weight_store, "directory", str(tmpdir))
+
+    model = models.torchvision_model("resnet18")
+    for (name, expected), actual in zip(reference.state_dict().items(), model.state_dict().values()):
+        assert torch.equal(actual, expected), name
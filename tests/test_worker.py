@@ -0,0 +1,114 @@
+from nst_zoo.batch_processing.worker import Worker, run_batch
+from tests.fake_redis import FakeRedis
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+
+def _results(redis, name="trials"):
+    return {k.decode(): json.loads(v) for k, v in redis.hgetall(f"{name}:results").items()}
+
+
+def _trial_id(trial):
+    return hashlib.md5(json.dumps(trial).encode()).hexdigest()
+
+
+def _run_trial(config_kwargs):
+    if config_kwargs.get("fail"):
+        return {"status": "failed", "error": "boom"}
+    return {"status": "done", "seconds": 0.}
+
+
+def test_worker_processes_and_acknowledges_every_trial():
+    redis = FakeRedis()
+    trials = [{"trial": i} for i in range(5)] + [{"fail": True}]
+    redis.lpush("trials", *[json.dumps(i) for i in trials])
+
+    worker = Worker(redis, "trials", worker_id="a", prefetch=2, run_trial=_run_trial)
+    assert worker.run() == 6
+
+    results = _results(redis)
+    assert [results[_trial_id(i)]["status"] for i in trials] == ["done"] * 5 + ["failed"]
+    assert redis.llen("trials") == 0
+    assert redis.llen(worker.processing_key) == 0
+    assert not redis.exists(worker.heartbeat_key)
+
+
+def test_trials_of_dead_workers_are_requeued():
+    redis = FakeRedis()
+    trial = {"trial": 0}
+    # claimed by a worker which died: no heartbeat
+    redis.lpush("trials:processing:dead", json.dumps(trial))
+    # claimed by a live worker
+    redis.lpush("trials:processing:alive", json.dumps({"trial": 1}))
+    redis.set("trials:heartbeat:alive", 0, ex=60)
+
+    assert Worker(redis, "trials", worker_id="b", run_trial=_run_trial).run() == 1
+    assert _results(redis)[_trial_id(trial)]["status"] == "done"
+    assert redis.llen("trials:processing:alive") == 1
+
+
+def test_poison_trials_are_given_up():
+    redis = FakeRedis()
+    trial = json.dumps({"trial": 0})
+    redis.lpush("trials", trial)
+    redis.hset("trials:attempts", hashlib.md5(trial.encode()).hexdigest(), 3)
+
+    Worker(redis, "trials", worker_id="c", max_attempts=3, run_trial=_run_trial).run()
+    assert "gave up" in _results(redis)[_trial_id({"trial": 0})]["error"]
+
+
+def test_batches_are_processed_together():
+    redis = FakeRedis()
+    batch = [{"trial": 0}, {"fail": True}]
+    redis.lpush("trials", json.dumps(batch), json.dumps({"trial": 1}))
+
+    ran = []
+    worker = Worker(redis, "trials", worker_id="d", run_trial=lambda i: ran.append(i) or _run_trial(i))
+    assert worker.run() == 3
+
+    assert ran == batch + [{"trial": 1}]
+    results = _results(redis)
+    assert [results[_trial_id(i)]["status"] for i in batch] == ["done", "failed"]
+    assert redis.llen(worker.processing_key) == 0
+
+
+def test_queue_commands_do_not_import_torch():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    imported = subprocess.check_output(
+        [sys.executable, "-c", "import sys, nst_zoo.batch_processing.io; print('torch' in sys.modules)"],
+        env={**os.environ, "PYTHONPATH": root}
+    )
+    assert imported.strip() == b"False"
+
+
+def _config(**kwargs):
+    return {"style_img": "style.jpg", "style_layers": {"ReLU": [0]}, "save_as": "hash", **kwargs}
+
+
+def test_trials_sharing_a_batch_are_optimized_together(monkeypatch):
+    from nst_zoo import nst_main
+    from nst_zoo.optimization import StoppingCriteria
+    runs = []
+
+    def main_batched(nst_configs):
+        runs.append(len(nst_configs))
+        if any(i.max_evals == 1 for i in nst_configs):
+            raise RuntimeError("boom")
+        return StoppingCriteria(n_evals=10, best_loss=2., stop_reason="max_evals")
+    monkeypatch.setattr(nst_main, "main_batched", main_batched)
+    monkeypatch.setattr(nst_main, "main", lambda nst_config: main_batched([nst_config]) if nst_config.max_evals != 1
+                        else StoppingCriteria(n_evals=1, stop_reason="max_evals"))
+
+    trials = [
+        _config(), _config(style_gram_class="GramMatrix"), _config(max_evals=5), _config(tile_size=64),
+        _config(max_evals=1), _config(max_evals=1, style_gram_class="GramMatrix"),
+    ]
+    results = run_batch(trials)
+
+    # one batch of 2, two trials on their own, then a failed batch of 2 run again one by one
+    assert runs == [2, 1, 1, 2]
+    assert [i["status"] for i in results] == ["done"] * 6
+    assert [i.get("batch_size") for i in results] == [2, 2, None, None, None, None]
@@ -1,6 +1,7 @@
 from PIL import Image
 from nst_zoo.image_processing import BaseProcessor
 from torchvision import transforms
+from torch import nn
 
 
 def get_content_img():
@@ -19,3 +20,14 @@ def get_preprocessed_content():
 def get_preprocessed_style():
     bp = BaseProcessor()
     return bp.preprocess(transforms.ToTensor()(get_style_img()))
+
+
+def get_tiny_model():
+    """
+    Small randomly initialized stand-in for a torchvision model (no download needed)
+    """
+    return nn.Sequential(
+        nn.Conv2d(3, 4, 3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+        nn.Conv2d(4, 8, 3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+        nn.Conv2d(8, 8, 3, padding=1), nn.ReLU()
+    )